@@ -1,19 +1,34 @@
 # ---------- BALAJI DAIRY (Elegant White + Emerald + Glass Frosted UI | Responsive) ----------
 from flask import (
-    Flask, render_template, render_template_string, request, redirect,
-    url_for, session, g, flash, jsonify, send_from_directory
+    Flask, render_template, request, redirect,
+    url_for, session, g, flash, jsonify, send_file, make_response, abort,
+    Response, stream_with_context
 )
-import os, json, pytz, psycopg2, psycopg2.extras, re
-from werkzeug.security import generate_password_hash, check_password_hash
+import os, io, csv, json, pytz, psycopg2, psycopg2.extras, psycopg2.pool, re, threading, time, base64, hashlib, mimetypes, tempfile, shutil
+from urllib.parse import quote
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
-from functools import wraps
-from jinja2 import DictLoader
+from functools import wraps, lru_cache
+from jinja2 import DictLoader, FileSystemBytecodeCache
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict, OrderedDict
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import smtplib
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; uploads are served as-is without it
+    Image = ImageOps = None
+try:
+    import boto3
+except ImportError:  # only needed for UPLOAD_STORAGE=s3
+    boto3 = None
+try:
+    import xlsxwriter
+except ImportError:  # only needed for XLSX order exports
+    xlsxwriter = None
 
 # ---------- CONFIG ----------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -28,27 +43,353 @@ DB_CONFIG = {
     "port": os.environ.get("DB_PORT", "5432"),
 }
 
+# Connection pool sizing. DB_POOL_MODE is "threaded" for long-running WSGI
+# servers, "serverless" for per-invocation runtimes (Vercel) or "off" to open
+# a fresh connection per request like before.
+DB_POOL_CONFIG = {
+    "mode": os.environ.get("DB_POOL_MODE", "threaded").lower(),
+    "minconn": int(os.environ.get("DB_POOL_MIN", "1")),
+    "maxconn": int(os.environ.get("DB_POOL_MAX", "10")),
+    "timeout": float(os.environ.get("DB_POOL_TIMEOUT", "5")),
+    "max_lifetime": float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800")),
+    "health_check_after": float(os.environ.get("DB_POOL_HEALTH_CHECK_AFTER", "30")),
+}
+
+# Seconds a logged-in user's row may be served from the in-process cache
+# across requests (0 = only cache within a single request).
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "0"))
+
+# Seconds the admin quick stats (users/orders/revenue) are cached per date range
+ADMIN_STATS_TTL = float(os.environ.get("ADMIN_STATS_TTL", "30"))
+
+# Seconds the rendered storefront product grid is reused before re-querying
+# (admin product edits and stock changes invalidate it immediately).
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "60"))
+
+# Where logged-in carts live: "session" (the signed cookie) or "db" (one carts
+# row per user, fronted by an in-process LRU of CART_CACHE_SIZE entries that
+# are trusted for CART_CACHE_TTL seconds). Anonymous carts stay in the session
+# and are merged into the stored cart on login.
+CART_STORE = os.environ.get("CART_STORE", "session").lower()
+CART_CACHE_SIZE = int(os.environ.get("CART_CACHE_SIZE", "1024"))
+CART_CACHE_TTL = float(os.environ.get("CART_CACHE_TTL", "30"))
+
+# Resized variants generated for uploaded images (CSS pixel widths)
+PRODUCT_IMAGE_WIDTHS = (320, 640, 1024)
+AVATAR_IMAGE_WIDTHS = (48, 96, 192)
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "0" if DB_POOL_CONFIG["mode"] == "serverless" else "2"))
+
+# Serving /uploads. Upload names are never reused for different content, so
+# responses are cacheable forever. UPLOADS_ACCEL hands the transfer to the
+# front server: "nginx" (X-Accel-Redirect to an internal location mapped to
+# UPLOAD_DIR at UPLOADS_ACCEL_PREFIX) or "sendfile" (X-Sendfile for Apache/lighttpd).
+UPLOADS_CONFIG = {
+    "max_age": int(os.environ.get("UPLOADS_MAX_AGE", str(365 * 24 * 3600))),
+    "accel": os.environ.get("UPLOADS_ACCEL", "").lower(),
+    "accel_prefix": os.environ.get("UPLOADS_ACCEL_PREFIX", "/_uploads/"),
+    # Serve name.br / name.gz next to a file when the client accepts that encoding
+    "precompressed": os.environ.get("UPLOADS_PRECOMPRESSED", "true").lower() == "true",
+    # Unreferenced uploads are deleted once they have been orphaned for orphan_grace seconds
+    "orphan_grace": int(os.environ.get("UPLOAD_ORPHAN_GRACE", "3600")),
+    "sweep_interval": int(os.environ.get("UPLOAD_SWEEP_INTERVAL", "0" if DB_POOL_CONFIG["mode"] == "serverless" else "3600")),
+}
+
+# Where uploads live. "local" keeps them in UPLOAD_DIR; "s3" uses any
+# S3-compatible bucket (AWS, MinIO, R2 via S3_ENDPOINT_URL), which serverless
+# deployments need because their local disk is ephemeral and per-instance.
+UPLOAD_STORAGE_CONFIG = {
+    "backend": os.environ.get("UPLOAD_STORAGE", "local").lower(),
+    "bucket": os.environ.get("S3_BUCKET", ""),
+    "prefix": os.environ.get("S3_PREFIX", "uploads/"),
+    "endpoint_url": os.environ.get("S3_ENDPOINT_URL") or None,
+    "region": os.environ.get("S3_REGION") or None,
+    # Public/CDN base URL for the bucket; without it clients get presigned URLs
+    "public_url": os.environ.get("S3_PUBLIC_URL", "").rstrip("/"),
+    "url_expiry": int(os.environ.get("S3_URL_EXPIRY", str(24 * 3600))),
+}
+
+# Outbound mail. MAIL_BACKEND is "smtp" or "memory" (a local sink that keeps
+# messages in MAIL_OUTBOX instead of sending them, for development and tests).
+MAIL_CONFIG = {
+    "backend": os.environ.get("MAIL_BACKEND", "smtp").lower(),
+    "host": os.environ.get("MAIL_HOST", "smtp.gmail.com"),
+    "port": int(os.environ.get("MAIL_PORT", "465")),
+    "workers": int(os.environ.get("MAIL_WORKERS", "0" if DB_POOL_CONFIG["mode"] == "serverless" else "2")),
+    "batch_size": int(os.environ.get("MAIL_BATCH_SIZE", "20")),
+    "max_attempts": int(os.environ.get("MAIL_MAX_ATTEMPTS", "5")),
+    "retry_base": float(os.environ.get("MAIL_RETRY_BASE", "10")),
+    "poll_interval": float(os.environ.get("MAIL_POLL_INTERVAL", "15")),
+    "smtp_idle_timeout": float(os.environ.get("MAIL_SMTP_IDLE_TIMEOUT", "60")),
+    # Sent and failed rows (OTP bodies included) are deleted after this many seconds
+    "retention": float(os.environ.get("MAIL_RETENTION", str(24 * 3600))),
+}
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("FRESHMILK_SECRET") or "replace-this-with-a-secure-random-string"
 app.config.update(
     DEBUG=os.environ.get("FLASK_DEBUG", "False").lower() == "true",
     UPLOAD_DIR=UPLOAD_DIR,
     MAX_CONTENT_LENGTH=2 * 1024 * 1024,
+    USE_X_SENDFILE=UPLOADS_CONFIG["accel"] == "sendfile",
 )
 
+# ---------- DB CONNECTION POOL ----------
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+class ConnectionPool:
+    """
+    Thread-safe PostgreSQL connection pool.
+    - Borrowers wait up to `timeout` seconds when all `maxconn` connections are in use
+    - Connections idle for longer than `health_check_after` are pinged before reuse
+    - Connections older than `max_lifetime` are closed instead of being reused
+    """
+    def __init__(self, minconn, maxconn, timeout=5.0, max_lifetime=1800.0,
+                 health_check_after=30.0, **conn_kwargs):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.conn_kwargs = conn_kwargs
+        self._cond = threading.Condition()
+        self._idle = []         # [(conn, created_at, returned_at)], most recent last
+        self._born = {}         # id(conn) -> created_at for checked-out connections
+        self._connecting = 0
+        self._closed = False
+        self._stats = {
+            'created': 0, 'discarded': 0, 'recycled': 0, 'borrowed': 0,
+            'waits': 0, 'timeouts': 0, 'wait_time_total': 0.0, 'wait_time_max': 0.0,
+        }
+        for _ in range(self.minconn):
+            conn = self._connect()
+            self._idle.append((conn, time.monotonic(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.conn_kwargs)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _expired(self, created_at):
+        return self.max_lifetime > 0 and time.monotonic() - created_at > self.max_lifetime
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats['discarded'] += 1
+        try: conn.close()
+        except psycopg2.Error: pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited_from = None
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.pool.PoolError("connection pool is closed")
+                    if self._idle:
+                        conn, created_at, returned_at = self._idle.pop()
+                        # Keep its slot reserved while it is checked outside the lock
+                        self._connecting += 1
+                        break
+                    if len(self._born) + self._connecting < self.maxconn:
+                        # Reserve the slot, then connect without holding the lock
+                        self._connecting += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f"no connection available within {self.timeout:.1f}s "
+                                          f"({self.maxconn} in use)")
+                    if waited_from is None:
+                        waited_from = time.monotonic()
+                        self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+
+            # Health pings, closes and connects can block on the network: never under the lock
+            try:
+                if conn is None:
+                    conn = self._connect()
+                    created_at = time.monotonic()
+                elif self._expired(created_at):
+                    with self._cond:
+                        self._stats['recycled'] += 1
+                    self._discard(conn); conn = None
+                elif not self._healthy(conn, returned_at):
+                    self._discard(conn); conn = None
+            finally:
+                with self._cond:
+                    self._connecting -= 1
+                    if conn is not None:
+                        if waited_from is not None:
+                            waited = time.monotonic() - waited_from
+                            self._stats['wait_time_total'] += waited
+                            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+                        self._born[id(conn)] = created_at
+                        self._stats['borrowed'] += 1
+                    self._cond.notify()
+            if conn is not None:
+                return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            created_at = self._born.pop(id(conn), None)
+            self._connecting += 1  # the slot stays taken while the connection is reset
+        keep = False
+        try:
+            try:
+                if not close and not conn.closed and \
+                        conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+            with self._cond:
+                if close or conn.closed or self._closed or created_at is None:
+                    pass
+                elif self._expired(created_at):
+                    self._stats['recycled'] += 1
+                else:
+                    self._idle.append((conn, created_at, time.monotonic()))
+                    keep = True
+        finally:
+            with self._cond:
+                self._connecting -= 1
+                self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            in_use = len(self._born)
+            s = dict(self._stats)
+            s.update({
+                'in_use': in_use, 'idle': len(self._idle), 'size': in_use + len(self._idle),
+                'minconn': self.minconn, 'maxconn': self.maxconn,
+                'wait_time_avg': (s['wait_time_total'] / s['waits']) if s['waits'] else 0.0,
+            })
+            return s
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Create the process-wide pool on first use (None when pooling is off)."""
+    global _pool
+    mode = DB_POOL_CONFIG['mode']
+    if mode == 'off':
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                minconn, maxconn = DB_POOL_CONFIG['minconn'], DB_POOL_CONFIG['maxconn']
+                if mode == 'serverless':
+                    # One invocation at a time per instance: keep a single warm
+                    # connection and never pre-connect during a cold start.
+                    minconn, maxconn = 0, 1
+                _pool = ConnectionPool(
+                    minconn, maxconn,
+                    timeout=DB_POOL_CONFIG['timeout'],
+                    max_lifetime=DB_POOL_CONFIG['max_lifetime'],
+                    health_check_after=DB_POOL_CONFIG['health_check_after'],
+                    **DB_CONFIG
+                )
+    return _pool
+
+def pool_stats():
+    pool = get_pool()
+    return dict(pool.stats(), mode=DB_POOL_CONFIG['mode']) if pool else {'mode': 'off'}
+
 # ---------- DB CONNECTION ----------
 def get_conn():
     if not hasattr(g, "pg_conn"):
-        g.pg_conn = psycopg2.connect(**DB_CONFIG)
+        pool = get_pool()
+        g.pg_conn = pool.getconn() if pool else psycopg2.connect(**DB_CONFIG)
     return g.pg_conn
 
 @app.teardown_appcontext
 def close_conn(exception):
     if hasattr(g, "pg_conn"):
-        g.pg_conn.close()
+        pool = get_pool()
+        if pool:
+            pool.putconn(g.pg_conn)
+        else:
+            g.pg_conn.close()
         del g.pg_conn
 
 # ---------- DATABASE INIT ----------
+# Indexes managed by init_db(): name -> "table (columns)"
+DB_INDEXES = {
+    "idx_orders_created_at": "orders (created_at DESC, id DESC)",
+    "idx_orders_user_created_id": "orders (user_id, created_at DESC, id DESC)",
+    "idx_orders_status_created": "orders (status, created_at DESC)",
+    "idx_reset_otps_user": "reset_otps (user_id)",
+    "idx_mail_queue_due": "mail_queue (status, next_attempt_at)",
+    "idx_products_search": "products USING GIN (search_tsv)",
+    "idx_products_price": "products (price, id)",
+    "idx_products_name": "products (name, id)",
+    "idx_uploads_orphaned": "uploads (orphaned_at) WHERE refcount <= 0",
+    "idx_order_items_product": "order_items (product_id)",
+    # Empty once summaries are backfilled, so init_db's probe is a lookup, not a scan of orders
+    "idx_orders_summary_missing": "orders (id) WHERE items_summary IS NULL",
+}
+
+# Columns added after the original schema: (table, column) -> ALTER TABLE clause.
+# init_db() only issues the ones the catalog says are missing, so a cold start does
+# not queue an ACCESS EXCLUSIVE lock behind long-running exports and streams.
+DB_COLUMNS = {
+    # Responsive image variants written by the image workers
+    ("products", "image_variants"): "ADD COLUMN image_variants JSONB",
+    ("users", "avatar_variants"): "ADD COLUMN avatar_variants JSONB",
+    # Full-text search document for the storefront search box
+    ("products", "search_tsv"): """ADD COLUMN search_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(description, ''))) STORED""",
+    # Listing summary ("Milk x2, Curd x1...") and unit count, written at checkout
+    ("orders", "items_summary"): "ADD COLUMN items_summary TEXT",
+    ("orders", "item_count"): "ADD COLUMN item_count INTEGER",
+}
+
+def migrate_schema(cur):
+    """Add missing DB_COLUMNS / DB_INDEXES and fix the orders.created_at default, touching only what is missing."""
+    cur.execute("""
+        SELECT table_name, column_name, column_default FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name IN ('orders', 'products', 'users')
+    """)
+    columns = {(t, c): default for t, c, default in cur.fetchall()}
+    for (table, column), clause in DB_COLUMNS.items():
+        if (table, column) not in columns:
+            cur.execute(f"ALTER TABLE {table} {clause}")
+    # created_at is naive UTC regardless of the database server's time zone
+    if "'utc'" not in (columns.get(("orders", "created_at")) or ''):
+        cur.execute("ALTER TABLE orders ALTER COLUMN created_at SET DEFAULT (now() AT TIME ZONE 'utc')")
+    cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()")
+    existing = {r[0] for r in cur.fetchall()}
+    for name, ddl in DB_INDEXES.items():
+        if name not in existing:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {ddl}")
+
 def init_db():
     conn = get_conn()
     cur = conn.cursor()
@@ -86,6 +427,26 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS carts (
+            user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+            items JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+        );
+    """)
+    # One row per order line; orders.items keeps the JSONB copy for the original readers.
+    # product_id has no foreign key so deleting a product keeps its sales history.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id INTEGER NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+            line_no SMALLINT NOT NULL,
+            product_id INTEGER,
+            name TEXT,
+            qty INTEGER NOT NULL,
+            price NUMERIC(10,2) NOT NULL,
+            PRIMARY KEY (order_id, line_no)
+        );
+    """)
     cur.execute("""
         CREATE TABLE IF NOT EXISTS reset_otps (
             id SERIAL PRIMARY KEY,
@@ -96,8 +457,78 @@ def init_db():
             verified BOOLEAN DEFAULT FALSE
         );
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS mail_queue (
+            id SERIAL PRIMARY KEY,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            html TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            claimed_at TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            sent_at TIMESTAMP
+        );
+    """)
+    # Pre-aggregated per-IST-day sales, maintained by the rollup_* helpers
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_sales (
+            day DATE PRIMARY KEY,
+            order_count INTEGER NOT NULL DEFAULT 0,
+            revenue NUMERIC(12,2) NOT NULL DEFAULT 0
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_sales_status (
+            day DATE NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            order_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, status)
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_product_sales (
+            day DATE NOT NULL,
+            product_id INTEGER NOT NULL,
+            units INTEGER NOT NULL DEFAULT 0,
+            revenue NUMERIC(12,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        );
+    """)
+    # Reference counts for content-addressed files in UPLOAD_DIR
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS uploads (
+            filename TEXT PRIMARY KEY,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            orphaned_at TIMESTAMP
+        );
+    """)
+    migrate_schema(cur)
     conn.commit()
+    cur.execute("SELECT NOT EXISTS (SELECT 1 FROM order_items) AND EXISTS (SELECT 1 FROM orders)")
+    needs_order_items = cur.fetchone()[0]
+    cur.execute("SELECT EXISTS (SELECT 1 FROM orders WHERE items_summary IS NULL)")
+    needs_summaries = cur.fetchone()[0]
+    cur.execute("SELECT NOT EXISTS (SELECT 1 FROM daily_sales) AND EXISTS (SELECT 1 FROM orders)")
+    needs_backfill = cur.fetchone()[0]
+    cur.execute("""
+        SELECT NOT EXISTS (SELECT 1 FROM uploads)
+           AND (EXISTS (SELECT 1 FROM users WHERE avatar IS NOT NULL)
+                OR EXISTS (SELECT 1 FROM products WHERE image LIKE '%/uploads/%'))
+    """)
+    needs_upload_refs = cur.fetchone()[0]
     cur.close()
+    if needs_order_items:
+        backfill_order_items()
+    if needs_summaries:
+        backfill_order_summaries()
+    if needs_backfill:
+        rebuild_daily_sales()
+    if needs_upload_refs:
+        rebuild_upload_refs()
 
 # ---------- HELPERS ----------
 def allowed_file(filename):
@@ -131,19 +562,51 @@ def validate_password_strength(password):
     
     return True, ""
 
+# ---------- CURRENT USER CACHE ----------
+# Columns needed for identity/navbar/checkout; the password hash is never cached.
+USER_COLUMNS = "id, username, full_name, email, address, phone, is_admin, avatar, avatar_variants"
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def invalidate_user_cache(uid=None):
+    """Drop a user's cached row (all users when uid is None) after it changes."""
+    with _user_cache_lock:
+        if uid is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(uid, None)
+    if g and hasattr(g, "current_user_row") and (uid is None or g.current_user_row[0] == uid):
+        del g.current_user_row
+
 def get_current_user():
     uid = session.get('user_id')
     if not uid: return None
-    conn = get_conn()
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM users WHERE id=%s", (uid,))
-        user = cur.fetchone()
+    # Request scope: the context processor and admin_required share one lookup
+    cached = getattr(g, "current_user_row", None)
+    if cached and cached[0] == uid:
+        return cached[1]
+
+    user = None
+    if USER_CACHE_TTL > 0:
+        with _user_cache_lock:
+            hit = _user_cache.get(uid)
+        if hit and hit[0] > time.monotonic():
+            user = hit[1]
+    if user is None:
+        conn = get_conn()
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(f"SELECT {USER_COLUMNS} FROM users WHERE id=%s", (uid,))
+            user = cur.fetchone()
+        if user and USER_CACHE_TTL > 0:
+            with _user_cache_lock:
+                _user_cache[uid] = (time.monotonic() + USER_CACHE_TTL, user)
+    g.current_user_row = (uid, user)
     return user
 
 @app.context_processor
 def inject_user_and_cartcount():
     user = get_current_user()
-    cart = session.get('cart', {})
+    cart = get_cart()
     total_items = sum(int(v) for v in cart.values()) if cart else 0
     if not user:
         return dict(current_user=None, cart_count=total_items)
@@ -155,9 +618,481 @@ def inject_user_and_cartcount():
     u.full_name = user.get('full_name')
     u.is_admin = bool(user['is_admin'])
     u.avatar = user.get('avatar')
+    u.avatar_variants = user.get('avatar_variants')
     u.initial = (u.username[0].upper() if u.username else '?')
     return dict(current_user=u, cart_count=total_items)
 
+# ---------- CART STORE ----------
+# Carts are {"<product id>": qty}. With CART_STORE=db a logged-in user's cart is
+# a single JSONB row updated atomically in SQL, so it follows them across
+# devices; everyone else keeps the cart in session['cart'].
+_cart_cache = OrderedDict()  # user_id -> (expires_at, cart)
+_cart_cache_lock = threading.Lock()
+
+def _stored_cart_user():
+    return session.get('user_id') if CART_STORE == 'db' else None
+
+def _cache_cart(uid, cart):
+    with _cart_cache_lock:
+        if cart is None:
+            _cart_cache.pop(uid, None)
+            return
+        _cart_cache[uid] = (time.monotonic() + CART_CACHE_TTL, cart)
+        _cart_cache.move_to_end(uid)
+        while len(_cart_cache) > CART_CACHE_SIZE:
+            _cart_cache.popitem(last=False)
+
+def get_cart(fresh=False):
+    """
+    The current visitor's cart. The per-process LRU may lag changes made in
+    another worker, so it only serves the navbar badge; the cart page and
+    checkout pass fresh=True to read the row (and refresh the LRU).
+    """
+    uid = _stored_cart_user()
+    if not uid:
+        return session.get('cart', {})
+    if not fresh:
+        with _cart_cache_lock:
+            hit = _cart_cache.get(uid)
+        if hit and hit[0] > time.monotonic():
+            return dict(hit[1])
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("SELECT items FROM carts WHERE user_id=%s", (uid,))
+        row = cur.fetchone()
+    cart = row[0] if row else {}
+    _cache_cart(uid, cart)
+    return dict(cart)
+
+def cart_add(product_id, qty):
+    """Add qty of a product to the cart. Returns the updated cart."""
+    uid = _stored_cart_user()
+    if not uid:
+        cart = session.get('cart', {})
+        cart[str(product_id)] = cart.get(str(product_id), 0) + qty
+        session['cart'] = cart
+        return cart
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO carts (user_id, items) VALUES (%(uid)s, jsonb_build_object(%(pid)s::text, %(qty)s))
+            ON CONFLICT (user_id) DO UPDATE
+            SET items = jsonb_set(carts.items, ARRAY[%(pid)s::text],
+                                  to_jsonb(COALESCE((carts.items->>%(pid)s)::int, 0) + %(qty)s)),
+                updated_at = now() AT TIME ZONE 'utc'
+            RETURNING items
+        """, {'uid': uid, 'pid': str(product_id), 'qty': qty})
+        cart = cur.fetchone()[0]
+    conn.commit()
+    _cache_cart(uid, cart)
+    return dict(cart)
+
+def cart_remove(product_id):
+    uid = _stored_cart_user()
+    if not uid:
+        cart = session.get('cart', {})
+        cart.pop(str(product_id), None)
+        session['cart'] = cart
+        return
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE carts SET items = items - %s::text, updated_at = now() AT TIME ZONE 'utc'
+            WHERE user_id=%s RETURNING items
+        """, (str(product_id), uid))
+        row = cur.fetchone()
+    conn.commit()
+    _cache_cart(uid, row[0] if row else {})
+
+def clear_cart():
+    session['cart'] = {}
+    uid = _stored_cart_user()
+    if not uid:
+        return
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM carts WHERE user_id=%s", (uid,))
+    conn.commit()
+    _cache_cart(uid, None)
+
+def merge_session_cart(uid):
+    """On login, fold the anonymous session cart into the user's stored cart."""
+    if CART_STORE != 'db' or not session.get('cart'):
+        return
+    pending = session.pop('cart')
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("SELECT items FROM carts WHERE user_id=%s FOR UPDATE", (uid,))
+        row = cur.fetchone()
+        cart = dict(row[0]) if row else {}
+        for pid, qty in pending.items():
+            cart[pid] = cart.get(pid, 0) + int(qty)
+        cur.execute("""
+            INSERT INTO carts (user_id, items) VALUES (%s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET items = EXCLUDED.items, updated_at = now() AT TIME ZONE 'utc'
+        """, (uid, json.dumps(cart)))
+    conn.commit()
+    _cache_cart(uid, cart)
+
+# ---------- CART PRICING ----------
+def load_products(product_ids):
+    """Fetch the given products in one round trip. Returns {id: row}."""
+    ids = sorted({int(pid) for pid in product_ids})
+    if not ids:
+        return {}
+    conn = get_conn()
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ANY(%s)", (ids,))
+        return {p['id']: p for p in cur.fetchall()}
+
+def price_cart(cart):
+    """
+    Resolve a {product_id: qty} cart against the products table in a single query.
+    Returns dict(items, total, total_items, short) where each item is
+    {'product', 'qty', 'subtotal'} in cart order and `short` lists items whose
+    quantity exceeds current stock. Unknown product ids are skipped.
+    """
+    lines = []
+    for pid_str, qty in (cart or {}).items():
+        try: lines.append((int(pid_str), int(qty)))
+        except (ValueError, TypeError): continue
+    products = load_products(pid for pid, _ in lines)
+
+    items, short, total = [], [], 0.0
+    for pid, qty in lines:
+        p = products.get(pid)
+        if not p: continue
+        subtotal = float(p['price']) * qty
+        item = {'product': dict(p), 'qty': qty, 'subtotal': subtotal}
+        items.append(item)
+        total += subtotal
+        if int(p['stock'] or 0) < qty:
+            short.append(item)
+    return {'items': items, 'total': total, 'total_items': sum(it['qty'] for it in items), 'short': short}
+
+# Locks the wanted rows in id order (so concurrent checkouts can't deadlock),
+# then decrements every line that still has enough stock in the same statement.
+RESERVE_STOCK_SQL = """
+    WITH wanted(id, qty) AS (
+        SELECT * FROM unnest(%s::int[], %s::int[])
+    ), locked AS (
+        SELECT p.id, p.stock
+        FROM products p JOIN wanted w ON w.id = p.id
+        ORDER BY p.id
+        FOR UPDATE OF p
+    )
+    UPDATE products p
+    SET stock = p.stock - w.qty
+    FROM wanted w JOIN locked l ON l.id = w.id
+    WHERE p.id = w.id AND l.stock >= w.qty
+    RETURNING p.id
+"""
+
+def reserve_stock(cur, lines):
+    """
+    Atomically decrement stock for [(product_id, qty), ...] in one statement.
+    Returns the list of product ids that could not be reserved; when it is
+    non-empty the caller must roll back, since the other lines were decremented.
+    """
+    wanted = defaultdict(int)
+    for pid, qty in lines:
+        wanted[int(pid)] += int(qty)
+    if not wanted:
+        return []
+    ids = sorted(wanted)
+    cur.execute(RESERVE_STOCK_SQL, (ids, [wanted[pid] for pid in ids]))
+    reserved = {row['id'] if isinstance(row, dict) else row[0] for row in cur.fetchall()}
+    return [pid for pid in ids if pid not in reserved]
+
+# Locks rows in the same id order as RESERVE_STOCK_SQL, so a cancel and a
+# checkout touching the same products cannot deadlock.
+RESTOCK_SQL = """
+    WITH returned(id, qty) AS (
+        SELECT * FROM unnest(%s::int[], %s::int[])
+    ), locked AS (
+        SELECT p.id
+        FROM products p JOIN returned r ON r.id = p.id
+        ORDER BY p.id
+        FOR UPDATE OF p
+    )
+    UPDATE products p
+    SET stock = p.stock + r.qty
+    FROM returned r JOIN locked l ON l.id = r.id
+    WHERE p.id = r.id
+"""
+
+def restock(cur, lines):
+    """Give back stock for [(product_id, qty), ...]; lines without a product id are skipped."""
+    returned = defaultdict(int)
+    for pid, qty in lines:
+        if pid is not None:
+            returned[int(pid)] += int(qty)
+    if returned:
+        ids = sorted(returned)
+        cur.execute(RESTOCK_SQL, (ids, [returned[pid] for pid in ids]))
+
+# ---------- CATALOGUE QUERY ----------
+PRODUCTS_PAGE_SIZE = int(os.environ.get("PRODUCTS_PAGE_SIZE", "24"))
+ADMIN_PRODUCTS_PAGE_SIZE = int(os.environ.get("ADMIN_PRODUCTS_PAGE_SIZE", "50"))
+PRODUCT_COLUMNS = "id, name, description, price, image, stock, image_variants"
+
+# sort name -> (key column, direction); id breaks ties so keyset pages are stable
+PRODUCT_SORTS = {
+    'newest':     (None, 'DESC'),
+    'price_asc':  ('price', 'ASC'),
+    'price_desc': ('price', 'DESC'),
+    'name':       ('name', 'ASC'),
+}
+
+def product_filters(args):
+    """Normalise storefront query-string filters (q, min_price, max_price, in_stock, sort)."""
+    def money(key):
+        try: return max(0.0, float(args.get(key)))
+        except (TypeError, ValueError): return None
+    sort = args.get('sort') or 'newest'
+    return {
+        'q': (args.get('q') or '').strip()[:100],
+        'min_price': money('min_price'),
+        'max_price': money('max_price'),
+        'in_stock': args.get('in_stock') in ('1', 'true', 'on'),
+        'sort': sort if sort in PRODUCT_SORTS else 'newest',
+    }
+
+def decode_product_cursor(cursor, key):
+    """[sort value, id] from a storefront cursor, or None when it is missing, garbled or tampered with."""
+    if not cursor:
+        return None
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(after, list) or len(after) != 2:
+        return None
+    value, pid = after
+    if not isinstance(pid, int) or isinstance(pid, bool) or not 0 < pid < 2 ** 31:
+        return None
+    if key and not isinstance(value, str):
+        return None
+    # Prices are encoded as their text ("12.50"); anything else would fail in SQL
+    if key == 'price' and not re.fullmatch(r'-?\d{1,12}(?:\.\d{1,4})?', value):
+        return None
+    return [value, pid]
+
+def query_products(filters, cursor=None, limit=None):
+    """
+    One page of products matching `filters` (see product_filters). Search uses the
+    search_tsv GIN index with prefix matching; pages seek past `cursor`.
+    Returns (rows, next_cursor).
+    """
+    limit = limit or PRODUCTS_PAGE_SIZE
+    key, direction = PRODUCT_SORTS[filters['sort']]
+    sql = f"SELECT {PRODUCT_COLUMNS} FROM products WHERE 1=1"
+    params = []
+    terms = re.findall(r'\w+', filters['q'])
+    if terms:
+        sql += " AND search_tsv @@ to_tsquery('simple', %s)"
+        params.append(' & '.join(f"{t}:*" for t in terms))
+    if filters['min_price'] is not None:
+        sql += " AND price >= %s"; params.append(filters['min_price'])
+    if filters['max_price'] is not None:
+        sql += " AND price <= %s"; params.append(filters['max_price'])
+    if filters['in_stock']:
+        sql += " AND stock > 0"
+
+    op = '<' if direction == 'DESC' else '>'
+    after = decode_product_cursor(cursor, key)
+    if after:
+        if key:
+            sql += f" AND ({key}, id) {op} (%s, %s)"; params += after
+        else:
+            sql += f" AND id {op} %s"; params.append(after[-1])
+    order = f"{key} {direction}, id {direction}" if key else f"id {direction}"
+    sql += f" ORDER BY {order} LIMIT %s"; params.append(limit + 1)
+
+    conn = get_conn()
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        value = str(last[key]) if key else None
+        next_cursor = base64.urlsafe_b64encode(json.dumps([value, last['id']]).encode()).decode().rstrip('=')
+    return rows, next_cursor
+
+# ---------- CATALOGUE CACHE ----------
+_catalog_cache = {'html': None, 'next_cursor': None, 'etag': None, 'last_modified': None, 'expires': 0.0}
+_catalog_lock = threading.Lock()
+
+def invalidate_catalog():
+    """Call after any product insert/update/delete or stock change."""
+    with _catalog_lock:
+        _catalog_cache['expires'] = 0.0
+
+def catalog_grid():
+    """
+    Rendered first page of the unfiltered storefront grid with its ETag and
+    Last-Modified time. Re-queried at most every CATALOG_CACHE_TTL seconds;
+    Last-Modified only moves when the rendered content actually changes.
+    """
+    with _catalog_lock:
+        if _catalog_cache['html'] is not None and _catalog_cache['expires'] > time.monotonic():
+            return dict(_catalog_cache)
+        products, next_cursor = query_products(product_filters({}))
+        html = render_template('product_grid.html', products=products)
+        etag = hashlib.sha1(html.encode()).hexdigest()
+        if etag != _catalog_cache['etag']:
+            _catalog_cache.update(etag=etag, last_modified=datetime.now(timezone.utc).replace(microsecond=0))
+        _catalog_cache.update(html=html, next_cursor=next_cursor, expires=time.monotonic() + CATALOG_CACHE_TTL)
+        return dict(_catalog_cache)
+
+def filtered_grid(filters, cursor=None):
+    """Uncached grid page for searches, filters and later pages."""
+    products, next_cursor = query_products(filters, cursor)
+    html = render_template('product_grid.html', products=products)
+    return {'html': html, 'next_cursor': next_cursor, 'etag': hashlib.sha1(html.encode()).hexdigest(),
+            'last_modified': None}
+
+def is_default_catalog_view(filters, cursor):
+    return not cursor and filters == product_filters({})
+
+def conditional_catalog_response(body, grid, cache_control, page=False):
+    """
+    304-capable response for catalogue output. Grid fragments are validated by
+    the grid's ETag; whole pages (page=True) hash their full body instead, since
+    a deploy can change the surrounding markup while the grid stays the same.
+    """
+    resp = make_response(body)
+    if page:
+        resp.set_etag(hashlib.sha1(body.encode()).hexdigest())
+    else:
+        resp.set_etag(grid['etag'])
+        if grid['last_modified']:
+            resp.last_modified = grid['last_modified']
+    resp.headers['Cache-Control'] = cache_control
+    resp.headers['X-Next-Cursor'] = grid['next_cursor'] or ''
+
+    return resp.make_conditional(request)
+
+# ---------- DAILY SALES ROLLUP ----------
+# Every write that creates, removes or re-statuses an order also adjusts the
+# daily_sales* tables in the same transaction, so admin analytics read a
+# handful of pre-aggregated rows instead of scanning orders.
+def rollup_status(cur, day, status, delta):
+    cur.execute("""
+        INSERT INTO daily_sales_status (day, status, order_count) VALUES (%s, %s, %s)
+        ON CONFLICT (day, status) DO UPDATE SET order_count = daily_sales_status.order_count + EXCLUDED.order_count
+    """, (day, status or 'Pending', delta))
+
+def rollup_order(cur, created_at, total, items, status, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) one order's contribution to its IST day.
+    Callers run invalidate_admin_stats() after committing, so a concurrent
+    dashboard request cannot re-cache the pre-commit totals.
+    """
+    day = to_ist(created_at).date()
+    amount = float(total or 0) * sign
+    cur.execute("""
+        INSERT INTO daily_sales (day, order_count, revenue) VALUES (%s, %s, %s)
+        ON CONFLICT (day) DO UPDATE SET order_count = daily_sales.order_count + EXCLUDED.order_count,
+                                        revenue = daily_sales.revenue + EXCLUDED.revenue
+    """, (day, sign, amount))
+    rollup_status(cur, day, status, sign)
+
+    per_product = defaultdict(lambda: [0, 0.0])
+    for it in parse_order_items(items or '[]')[0]:
+        if it['id'] is None: continue
+        per_product[int(it['id'])][0] += it['qty'] * sign
+        per_product[int(it['id'])][1] += it['qty'] * it['price'] * sign
+    if per_product:
+        ids = sorted(per_product)
+        cur.execute("""
+            INSERT INTO daily_product_sales (day, product_id, units, revenue)
+            SELECT %s, * FROM unnest(%s::int[], %s::int[], %s::numeric[])
+            ON CONFLICT (day, product_id) DO UPDATE SET units = daily_product_sales.units + EXCLUDED.units,
+                                                        revenue = daily_product_sales.revenue + EXCLUDED.revenue
+        """, (day, ids, [per_product[i][0] for i in ids], [per_product[i][1] for i in ids]))
+
+def rollup_status_change(cur, created_at, old_status, new_status):
+    if old_status == new_status:
+        return
+    day = to_ist(created_at).date()
+    rollup_status(cur, day, old_status, -1)
+    rollup_status(cur, day, new_status, 1)
+
+def rebuild_daily_sales():
+    """Recompute every daily_sales* row from the orders table."""
+    conn = get_conn()
+    ist_day = "((created_at AT TIME ZONE 'UTC') AT TIME ZONE 'Asia/Kolkata')::date"
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE daily_sales, daily_sales_status, daily_product_sales")
+        cur.execute(f"""
+            INSERT INTO daily_sales (day, order_count, revenue)
+            SELECT {ist_day}, COUNT(*), COALESCE(SUM(total), 0) FROM orders GROUP BY 1
+        """)
+        cur.execute(f"""
+            INSERT INTO daily_sales_status (day, status, order_count)
+            SELECT {ist_day}, COALESCE(status, 'Pending'), COUNT(*) FROM orders GROUP BY 1, 2
+        """)
+        cur.execute(f"""
+            INSERT INTO daily_product_sales (day, product_id, units, revenue)
+            SELECT {ist_day}, oi.product_id, SUM(oi.qty), SUM(oi.qty * oi.price)
+            FROM order_items oi JOIN orders o ON o.id = oi.order_id
+            WHERE oi.product_id IS NOT NULL
+            GROUP BY 1, 2
+        """)
+    conn.commit()
+    invalidate_admin_stats()
+
+@app.cli.command('rebuild-daily-sales')
+def rebuild_daily_sales_command():
+    """Backfill the daily sales rollup tables from orders."""
+    rebuild_daily_sales()
+    print("[OK] daily_sales rebuilt")
+
+def daily_sales_filter(start, end, column='day'):
+    """SQL condition + params restricting a rollup table to inclusive IST dates."""
+    sql, params = "", []
+    for value, op in ((start, '>='), (end, '<=')):
+        try: day = datetime.strptime(value, '%Y-%m-%d').date()
+        except (TypeError, ValueError): continue
+        sql += f" AND {column} {op} %s"; params.append(day)
+    return sql, params
+
+# ---------- ADMIN QUICK STATS ----------
+_admin_stats_cache = {}
+_admin_stats_lock = threading.Lock()
+
+def invalidate_admin_stats():
+    with _admin_stats_lock:
+        _admin_stats_cache.clear()
+
+def admin_quick_stats(start=None, end=None):
+    """Users/orders/revenue for an IST date range: one aggregate over the rollup, cached briefly."""
+    key = (start or '', end or '')
+    if ADMIN_STATS_TTL > 0:
+        with _admin_stats_lock:
+            hit = _admin_stats_cache.get(key)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+
+    date_sql, params = daily_sales_filter(start, end)
+    conn = get_conn()
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(f"""
+            SELECT (SELECT COUNT(*) FROM users) AS users,
+                   COALESCE(SUM(order_count), 0) AS orders,
+                   COALESCE(SUM(revenue), 0) AS revenue
+            FROM daily_sales WHERE 1=1 {date_sql}
+        """, params)
+        row = cur.fetchone()
+    stats = {'users': row['users'], 'orders': int(row['orders']), 'revenue': float(row['revenue'] or 0.0)}
+    if ADMIN_STATS_TTL > 0:
+        with _admin_stats_lock:
+            _admin_stats_cache[key] = (time.monotonic() + ADMIN_STATS_TTL, stats)
+    return stats
+
 # ---------- DECORATORS ----------
 def login_required(f):
     @wraps(f)
@@ -178,50 +1113,697 @@ def admin_required(f):
     return wrapper
 
 # ---------- EMAIL (OTP) ----------
+def mail_configured():
+    if MAIL_CONFIG['backend'] == 'memory':
+        return True
+    return bool(os.environ.get("MAIL_SENDER", "") and os.environ.get("MAIL_PASSWORD", ""))
+
 def send_otp_email(to_email, otp):
+    """Queue the OTP email for the mail workers; returns (ok, error) immediately."""
+    if not mail_configured():
+        print("❌ Email credentials not configured. Set MAIL_SENDER and MAIL_PASSWORD environment variables.")
+        return False, "Email service not configured. Please contact administrator."
+    if not to_email:
+        return False, "No email address on this account."
+
+    html = f"""
+    <html><body style="font-family:sans-serif;">
+    <h2 style="color:#059669;">Balaji Dairy Password Reset</h2>
+    <p>Your OTP: <b style="font-size:24px;color:#059669;">{otp}</b></p>
+    <p>Valid for 10 minutes.</p>
+    </body></html>
+    """
     try:
-        sender = os.environ.get("MAIL_SENDER", "")
-        password = os.environ.get("MAIL_PASSWORD", "")
-        
-        if not sender or not password:
-            print("❌ Email credentials not configured. Set MAIL_SENDER and MAIL_PASSWORD environment variables.")
-            return False, "Email service not configured. Please contact administrator."
-        
-        msg = MIMEMultipart("alternative")
-        msg["Subject"] = "Balaji Dairy — Password Reset OTP"
-        msg["From"] = sender
-        msg["To"] = to_email
-
-        html = f"""
-        <html><body style="font-family:sans-serif;">
-        <h2 style="color:#059669;">Balaji Dairy Password Reset</h2>
-        <p>Your OTP: <b style="font-size:24px;color:#059669;">{otp}</b></p>
-        <p>Valid for 10 minutes.</p>
-        </body></html>
-        """
-        msg.attach(MIMEText(html, "html"))
-
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as s:
-            s.login(sender, password)
-            s.send_message(msg)
-        print(f"✅ OTP sent to {to_email}")
-        return True, None
-    except smtplib.SMTPAuthenticationError:
-        print("❌ Email authentication failed. Check MAIL_SENDER and MAIL_PASSWORD.")
-        return False, "Email authentication failed. Please check email configuration."
+        enqueue_mail(to_email, "Balaji Dairy — Password Reset OTP", html)
+    except psycopg2.Error as e:
+        print(f"❌ Email queue failed: {e}")
+        return False, "Failed to queue email."
+    if MAIL_CONFIG['workers'] <= 0:
+        # No background workers (serverless): deliver before returning, reusing
+        # the request's connection so a one-connection pool cannot deadlock
+        deliver_pending_mail(conn=get_conn())
+    return True, None
+
+# ---------- MAIL QUEUE ----------
+# Mail is written to the mail_queue table and delivered by a small pool of
+# background threads, each keeping one authenticated SMTP connection open and
+# sending whole batches over it. Failures are retried with exponential backoff.
+MAIL_OUTBOX = []            # "memory" backend sink
+_mail_wakeup = threading.Event()
+_mail_workers = []
+_mail_workers_lock = threading.Lock()
+_mail_purged_at = 0.0
+
+def enqueue_mail(to_email, subject, html):
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO mail_queue (to_email, subject, html) VALUES (%s, %s, %s)",
+                    (to_email, subject, html))
+    conn.commit()
+    start_mail_workers()
+    _mail_wakeup.set()
+
+class SmtpSession:
+    """One reusable, authenticated SMTP connection (reconnects when stale)."""
+    def __init__(self):
+        self.smtp = None
+        self.last_used = 0.0
+
+    def _open(self):
+        self.close()
+        self.smtp = smtplib.SMTP_SSL(MAIL_CONFIG['host'], MAIL_CONFIG['port'], timeout=30)
+        self.smtp.login(os.environ.get("MAIL_SENDER", ""), os.environ.get("MAIL_PASSWORD", ""))
+
+    def send(self, msg):
+        if MAIL_CONFIG['backend'] == 'memory':
+            MAIL_OUTBOX.append(msg)
+            print(f"✅ [memory mail] {msg['Subject']} -> {msg['To']}")
+            return
+        if self.smtp is None or time.monotonic() - self.last_used > MAIL_CONFIG['smtp_idle_timeout']:
+            self._open()
+        try:
+            self.smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self._open()
+            self.smtp.send_message(msg)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self.smtp is not None:
+            try: self.smtp.quit()
+            except (smtplib.SMTPException, OSError): pass
+            self.smtp = None
+
+def _background_connection():
+    pool = get_pool()
+    return pool.getconn() if pool else psycopg2.connect(**DB_CONFIG)
+
+def _release_background_connection(conn):
+    pool = get_pool()
+    if pool: pool.putconn(conn)
+    else: conn.close()
+
+def deliver_pending_mail(session_=None, limit=None, conn=None):
+    """Send due queued mail in batches until none is left. Returns the number sent."""
+    smtp = session_ or SmtpSession()
+    limit = limit or MAIL_CONFIG['batch_size']
+    sender = os.environ.get("MAIL_SENDER", "") or "no-reply@localhost"
+    sent_total = 0
+    own_conn = conn is None
+    if own_conn:
+        conn = _background_connection()
+    try:
+        while True:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                # Claim a batch; rows stuck in 'sending' by a dead worker are reclaimed
+                cur.execute("""
+                    UPDATE mail_queue SET status='sending', attempts=attempts+1,
+                                          claimed_at=(now() AT TIME ZONE 'utc')
+                    WHERE id IN (
+                        SELECT id FROM mail_queue
+                        WHERE (status='pending' AND next_attempt_at <= (now() AT TIME ZONE 'utc'))
+                           OR (status='sending' AND claimed_at < (now() AT TIME ZONE 'utc') - INTERVAL '5 minutes')
+                        ORDER BY id LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, to_email, subject, html, attempts
+                """, (limit,))
+                batch = cur.fetchall()
+            conn.commit()
+            if not batch:
+                purge_old_mail(conn)
+                return sent_total
+
+            sent, failed = [], []
+            for m in batch:
+                msg = MIMEMultipart("alternative")
+                msg["Subject"] = m['subject']
+                msg["From"] = sender
+                msg["To"] = m['to_email']
+                msg.attach(MIMEText(m['html'], "html"))
+                try:
+                    smtp.send(msg)
+                    sent.append(m['id'])
+                    print(f"✅ Mail {m['id']} sent to {m['to_email']}")
+                except (smtplib.SMTPException, OSError) as e:
+                    smtp.close()
+                    give_up = m['attempts'] >= MAIL_CONFIG['max_attempts']
+                    delay = min(MAIL_CONFIG['retry_base'] * (2 ** (m['attempts'] - 1)), 3600)
+                    failed.append((('failed' if give_up else 'pending'), delay, str(e)[:500], m['id']))
+                    print(f"❌ Mail {m['id']} attempt {m['attempts']} failed: {e}")
+
+            with conn.cursor() as cur:
+                if sent:
+                    cur.execute("UPDATE mail_queue SET status='sent', sent_at=(now() AT TIME ZONE 'utc'), last_error=NULL "
+                                "WHERE id = ANY(%s)", (sent,))
+                if failed:
+                    cur.executemany("""
+                        UPDATE mail_queue SET status=%s,
+                               next_attempt_at=(now() AT TIME ZONE 'utc') + make_interval(secs => %s),
+                               last_error=%s
+                        WHERE id=%s
+                    """, failed)
+            conn.commit()
+            sent_total += len(sent)
+    finally:
+        if session_ is None:
+            smtp.close()
+        if own_conn:
+            _release_background_connection(conn)
+
+def purge_old_mail(conn, force=False):
+    """Delete sent/failed mail older than MAIL_CONFIG['retention'] (at most every few minutes unless forced)."""
+    global _mail_purged_at
+    if not force and time.monotonic() - _mail_purged_at < min(MAIL_CONFIG['retention'], 300):
+        return 0
+    _mail_purged_at = time.monotonic()
+    with conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM mail_queue
+            WHERE status IN ('sent', 'failed')
+              AND COALESCE(sent_at, next_attempt_at) < (now() AT TIME ZONE 'utc') - make_interval(secs => %s)
+        """, (MAIL_CONFIG['retention'],))
+        removed = cur.rowcount
+    conn.commit()
+    return removed
+
+@app.cli.command('purge-mail')
+def purge_mail_command():
+    """Delete sent and failed mail past MAIL_RETENTION (for cron on serverless deployments)."""
+    conn = _background_connection()
+    try:
+        removed = purge_old_mail(conn, force=True)
+    finally:
+        _release_background_connection(conn)
+    print(f"[OK] {removed} old mail row(s) deleted")
+
+def _mail_worker_loop():
+    smtp = SmtpSession()
+    while True:
+        _mail_wakeup.wait(MAIL_CONFIG['poll_interval'])
+        _mail_wakeup.clear()
+        try:
+            deliver_pending_mail(smtp)
+        except Exception as e:
+            print(f"❌ Mail worker error: {e}")
+            smtp.close()
+
+def start_mail_workers():
+    # Without credentials nothing can be sent, so do not poll the queue at all
+    if MAIL_CONFIG['workers'] <= 0 or len(_mail_workers) >= MAIL_CONFIG['workers'] or not mail_configured():
+        return
+    with _mail_workers_lock:
+        while len(_mail_workers) < MAIL_CONFIG['workers']:
+            t = threading.Thread(target=_mail_worker_loop, name=f"mail-worker-{len(_mail_workers)}", daemon=True)
+            t.start()
+            _mail_workers.append(t)
+
+@app.before_request
+def ensure_mail_workers():
+    # Started lazily (after any server fork) so queued mail from before a restart is picked up
+    start_mail_workers()
+
+# ---------- IMAGE VARIANTS ----------
+# Uploaded images are re-encoded into several widths (AVIF when Pillow supports
+# it, WebP, and a JPEG fallback) on background threads. Variant files are named
+# after the source content hash, and the variant list is stored on the row
+# (products.image_variants / users.avatar_variants) for srcset rendering.
+_image_executor = None
+_image_executor_lock = threading.Lock()
+VARIANT_DIR = "variants"
+
+def image_formats():
+    Image.init()  # registers every plugin so Image.SAVE reflects AVIF support
+    formats = [('jpeg', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+               ('webp', 'webp', {'quality': 80, 'method': 4})]
+    if Image is not None and 'AVIF' in Image.SAVE:
+        formats.insert(0, ('avif', 'avif', {'quality': 60}))
+    return formats
+
+def build_image_variants(filename, widths):
+    """Store resized variants of an upload. Returns {fmt: [[width, filename], ...]}."""
+    storage = get_upload_storage()
+    data = storage.read(filename)
+    digest = hashlib.sha256(data).hexdigest()[:20]
+
+    variants, formats = defaultdict(list), image_formats()
+    with Image.open(io.BytesIO(data)) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA' if 'transparency' in im.info or im.mode in ('LA', 'PA') else 'RGB')
+        # Never upscale: keep only widths below the source, plus the source width itself
+        targets = sorted({w for w in widths if w < im.width} | {min(im.width, max(widths))})
+        for w in targets:
+            h = max(1, round(im.height * w / im.width))
+            resized = im.resize((w, h), Image.LANCZOS) if w != im.width else im
+            for fmt, ext, opts in formats:
+                name = f"{VARIANT_DIR}/{digest}_{w}w.{ext}"
+                if not storage.exists(name):
+                    frame = resized
+                    if fmt == 'jpeg' and frame.mode == 'RGBA':
+                        frame = Image.new('RGB', frame.size, (255, 255, 255))
+                        frame.paste(resized, mask=resized.split()[-1])
+                    buf = io.BytesIO()
+                    frame.save(buf, format=fmt.upper(), **opts)
+                    buf.seek(0)
+                    storage.save(name, buf)
+                variants[fmt].append([w, name])
+    return dict(variants)
+
+def _process_image_variants(kind, row_id, filename, expected, conn=None):
+    """Build and attach variants; conn is the request's connection when running inline."""
+    try:
+        widths = PRODUCT_IMAGE_WIDTHS if kind == 'product' else AVATAR_IMAGE_WIDTHS
+        variants = build_image_variants(filename, widths)
+    except Exception as e:
+        # Hostile or corrupt images raise all sorts (DecompressionBombError, SyntaxError, ...);
+        # the upload is already saved, so this must never reach the request or vanish silently.
+        print(f"❌ Image variants failed for {filename}: {e}")
+        return
+    own_conn = conn is None
+    try:
+        if own_conn:
+            conn = _background_connection()
+    except Exception as e:
+        print(f"❌ Image variants not saved for {filename}: {e}")
+        return
+    try:
+        with conn.cursor() as cur:
+            # Only attach the variants if the row still points at the same image
+            if kind == 'product':
+                cur.execute("UPDATE products SET image_variants=%s WHERE id=%s AND image=%s",
+                            (json.dumps(variants), row_id, expected))
+            else:
+                cur.execute("UPDATE users SET avatar_variants=%s WHERE id=%s AND avatar=%s",
+                            (json.dumps(variants), row_id, expected))
+        conn.commit()
     except Exception as e:
-        print(f"❌ Email send failed: {e}")
-        return False, f"Failed to send email: {str(e)}"
+        print(f"❌ Image variants not saved for {filename}: {e}")
+        if not own_conn and not conn.closed:
+            conn.rollback()
+        return
+    finally:
+        if own_conn:
+            _release_background_connection(conn)
+    if kind == 'product':
+        invalidate_catalog()
+    else:
+        invalidate_user_cache(row_id)
+
+def schedule_image_variants(kind, row_id, filename, expected):
+    """Generate variants for an uploaded image off the request thread (inline when IMAGE_WORKERS=0)."""
+    global _image_executor
+    if Image is None:
+        return
+    if IMAGE_WORKERS <= 0:
+        # Inline (serverless): reuse the request's connection so a one-connection pool cannot deadlock
+        _process_image_variants(kind, row_id, filename, expected, conn=get_conn())
+        return
+    if _image_executor is None:
+        with _image_executor_lock:
+            if _image_executor is None:
+                _image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-worker")
+    _image_executor.submit(_process_image_variants, kind, row_id, filename, expected)
+
+@app.cli.command('send-mail')
+def send_mail_command():
+    """Deliver all due queued mail (for cron on serverless deployments)."""
+    print(f"[OK] {deliver_pending_mail()} message(s) sent")
+
+# ---------- UPLOAD STORAGE ----------
+# Uploads are stored as <sha256[:32]><ext>, so identical files share one copy.
+# The uploads table counts references from users.avatar and products.image
+# (kept in step inside the same transactions that change those columns), and
+# the sweeper deletes files that have been unreferenced for orphan_grace.
+# Files go through a storage backend chosen by UPLOAD_STORAGE_CONFIG.
+_upload_sweeper = None
+_upload_sweeper_lock = threading.Lock()
+_upload_storage = None
+
+class LocalStorage:
+    """Uploads in UPLOAD_DIR, served by uploaded_file()."""
+
+    @property
+    def root(self):
+        return app.config['UPLOAD_DIR']
+
+    def path(self, name):
+        return safe_join(self.root, name)
+
+    def exists(self, name):
+        path = self.path(name)
+        return path is not None and os.path.isfile(path)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def save(self, name, fileobj):
+        dest = self.path(name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(fileobj, out, 1 << 16)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def touch(self, name):
+        os.utime(self.path(name))
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def listdir(self, prefix=''):
+        """(name, mtime) for the files directly under prefix."""
+        root = os.path.join(self.root, prefix)
+        if not os.path.isdir(root):
+            return []
+        return [(prefix + e.name, e.stat().st_mtime) for e in os.scandir(root) if e.is_file()]
+
+    def url(self, name):
+        return None
+
+    def public_url(self, name):
+        return None
+
+class S3Storage:
+    """Uploads in an S3-compatible bucket; clients fetch them from the bucket directly."""
+
+    def __init__(self, config):
+        if boto3 is None:
+            raise RuntimeError("UPLOAD_STORAGE=s3 requires boto3 (pip install boto3)")
+        if not config['bucket']:
+            raise RuntimeError("UPLOAD_STORAGE=s3 requires S3_BUCKET")
+        self.bucket, self.prefix = config['bucket'], config['prefix']
+        self.base_url, self.expiry = config['public_url'], config['url_expiry']
+        self.client = boto3.client('s3', endpoint_url=config['endpoint_url'], region_name=config['region'])
+        self._signed = OrderedDict()  # name -> (url, reuse_until)
+        self._signed_lock = threading.Lock()
+
+    def key(self, name):
+        return self.prefix + name
+
+    def _object_args(self, name):
+        return {
+            'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'CacheControl': f"public, max-age={UPLOADS_CONFIG['max_age']}, immutable",
+        }
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def read(self, name):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(name))['Body'].read()
+
+    def save(self, name, fileobj):
+        # upload_fileobj streams in multipart chunks rather than reading the whole file
+        self.client.upload_fileobj(fileobj, self.bucket, self.key(name), ExtraArgs=self._object_args(name))
+
+    def touch(self, name):
+        # Copy onto itself to refresh LastModified (the sweeper's grace clock)
+        self.client.copy_object(Bucket=self.bucket, Key=self.key(name), MetadataDirective='REPLACE',
+                                CopySource={'Bucket': self.bucket, 'Key': self.key(name)},
+                                **self._object_args(name))
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def listdir(self, prefix=''):
+        files = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key(prefix), Delimiter='/'):
+            for obj in page.get('Contents', []):
+                files.append((obj['Key'][len(self.prefix):], obj['LastModified'].timestamp()))
+        return files
+
+    def public_url(self, name):
+        return f"{self.base_url}/{quote(self.key(name))}" if self.base_url else None
+
+    def url(self, name):
+        """Public URL, or a presigned GET reused for half its lifetime so browsers can cache it."""
+        if self.base_url:
+            return self.public_url(name)
+        now = time.time()
+        with self._signed_lock:
+            hit = self._signed.get(name)
+            if hit and hit[1] > now:
+                return hit[0]
+        signed = self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=self.expiry)
+        with self._signed_lock:
+            self._signed[name] = (signed, now + self.expiry / 2)
+            self._signed.move_to_end(name)
+            while len(self._signed) > 4096:
+                self._signed.popitem(last=False)
+        return signed
+
+def get_upload_storage():
+    global _upload_storage
+    if _upload_storage is None:
+        backend = UPLOAD_STORAGE_CONFIG['backend']
+        if backend == 's3':
+            _upload_storage = S3Storage(UPLOAD_STORAGE_CONFIG)
+        elif backend == 'local':
+            _upload_storage = LocalStorage()
+        else:
+            raise RuntimeError(f"Unknown UPLOAD_STORAGE backend: {backend}")
+    return _upload_storage
+
+def upload_name(image):
+    """UPLOAD_DIR filename behind a users.avatar / products.image value (None for external URLs)."""
+    if not image or '://' in image:
+        return None
+    if '/uploads/' in image:
+        return image.split('/uploads/', 1)[1]
+    return None if '/' in image else image
+
+def store_upload(file_storage):
+    """Stream an uploaded file into upload storage under its content hash. Returns the filename."""
+    storage = get_upload_storage()
+    ext = os.path.splitext(secure_filename(file_storage.filename or ''))[1].lower()
+    digest = hashlib.sha256()
+    # Hashing needs the whole file before its name is known; spool to disk past 1 MB
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as spool:
+        for chunk in iter(lambda: file_storage.stream.read(1 << 16), b''):
+            digest.update(chunk)
+            spool.write(chunk)
+        filename = digest.hexdigest()[:32] + ext
+        if storage.exists(filename):
+            storage.touch(filename)  # restarts the sweeper's grace period for a re-used orphan
+        else:
+            spool.seek(0)
+            storage.save(filename, spool)
+    return filename
+
+def upload_ref(cur, image, delta):
+    """Add delta references to the upload behind an avatar/image value."""
+    filename = upload_name(image)
+    if not filename:
+        return
+    cur.execute("""
+        INSERT INTO uploads (filename, refcount, orphaned_at)
+        VALUES (%(f)s, GREATEST(%(d)s, 0), CASE WHEN %(d)s > 0 THEN NULL ELSE now() AT TIME ZONE 'utc' END)
+        ON CONFLICT (filename) DO UPDATE
+        SET refcount = GREATEST(uploads.refcount + %(d)s, 0),
+            orphaned_at = CASE WHEN uploads.refcount + %(d)s > 0 THEN NULL
+                               ELSE COALESCE(uploads.orphaned_at, now() AT TIME ZONE 'utc') END
+    """, {'f': filename, 'd': delta})
+
+def replace_upload_ref(cur, old_image, new_image):
+    if old_image != new_image:
+        upload_ref(cur, new_image, 1)
+        upload_ref(cur, old_image, -1)
+
+def rebuild_upload_refs():
+    """Recount every upload reference from users.avatar and products.image."""
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("UPDATE uploads SET refcount = 0, orphaned_at = COALESCE(orphaned_at, now() AT TIME ZONE 'utc')")
+        cur.execute("""
+            INSERT INTO uploads (filename, refcount)
+            SELECT filename, COUNT(*) FROM (
+                SELECT avatar AS filename FROM users WHERE avatar IS NOT NULL AND avatar NOT LIKE '%/%'
+                UNION ALL
+                SELECT substring(image FROM '/uploads/(.+)$') FROM products WHERE image NOT LIKE '%://%'
+            ) refs
+            WHERE filename IS NOT NULL
+            GROUP BY filename
+            ON CONFLICT (filename) DO UPDATE SET refcount = EXCLUDED.refcount, orphaned_at = NULL
+        """)
+    conn.commit()
+
+# Names the app itself writes: content-hash uploads, image variants and LocalStorage temp files.
+# Anything else in the upload dir (legacy or operator-placed files) is never swept.
+SWEEPABLE_UPLOAD_RE = re.compile(r'^(?:[0-9a-f]{32}(?:\.[\w-]+)?|\.upload-[^/]*|'
+                                 + re.escape(VARIANT_DIR) + r'/[0-9a-f]{20}_\d+w\.[a-z0-9]+)$')
+
+def _upload_is_live(name, live):
+    """True when name, or the upload it is a precompressed sidecar of, is still referenced."""
+    if name in live:
+        return True
+    base, ext = os.path.splitext(name)
+    return ext in {e for _, e in UPLOAD_ENCODINGS} and base in live
+
+def upload_sweep_allowed():
+    """The sweeper lists and deletes by prefix, so never point it at an S3 bucket's root."""
+    return not (UPLOAD_STORAGE_CONFIG['backend'] == 's3' and not UPLOAD_STORAGE_CONFIG['prefix'].strip('/'))
+
+def sweep_orphan_uploads(grace=None):
+    """Delete uploads and image variants nothing references any more. Returns the number of files removed."""
+    if not upload_sweep_allowed():
+        raise RuntimeError("Refusing to sweep uploads: S3_PREFIX is empty, so the whole bucket would be swept")
+    grace = UPLOADS_CONFIG['orphan_grace'] if grace is None else grace
+    cutoff = time.time() - grace
+    conn = _background_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM uploads
+                WHERE refcount <= 0 AND orphaned_at < (now() AT TIME ZONE 'utc') - %s * interval '1 second'
+            """, (grace,))
+            cur.execute("SELECT filename FROM uploads")
+            tracked = {r[0] for r in cur.fetchall()}
+            cur.execute("""
+                SELECT image_variants FROM products WHERE image_variants IS NOT NULL
+                UNION ALL
+                SELECT avatar_variants FROM users WHERE avatar_variants IS NOT NULL
+            """)
+            live = tracked | {f for (variants,) in cur.fetchall() for entries in variants.values() for _, f in entries}
+        conn.commit()
+    finally:
+        _release_background_connection(conn)
+
+    removed = 0
+    storage = get_upload_storage()
+    for prefix in ('', VARIANT_DIR + '/'):
+        for name, mtime in storage.listdir(prefix):
+            if _upload_is_live(name, live) or not SWEEPABLE_UPLOAD_RE.match(name):
+                continue
+            # Expired orphans are no longer tracked; like abandoned temp files and
+            # stale variants they must also have sat untouched for the grace period.
+            if mtime >= cutoff:
+                continue
+            storage.delete(name)
+            removed += 1
+    return removed
+
+def _upload_sweeper_loop():
+    while True:
+        time.sleep(UPLOADS_CONFIG['sweep_interval'])
+        try:
+            removed = sweep_orphan_uploads()
+            if removed:
+                print(f"[OK] Upload sweeper removed {removed} orphaned file(s)")
+        except Exception as e:
+            print(f"❌ Upload sweeper failed: {e}")
+
+@app.before_request
+def ensure_upload_sweeper():
+    global _upload_sweeper
+    if UPLOADS_CONFIG['sweep_interval'] <= 0 or _upload_sweeper is not None or not upload_sweep_allowed():
+        return
+    with _upload_sweeper_lock:
+        if _upload_sweeper is None:
+            _upload_sweeper = threading.Thread(target=_upload_sweeper_loop, name="upload-sweeper", daemon=True)
+            _upload_sweeper.start()
+
+@app.cli.command('sweep-uploads')
+def sweep_uploads_command():
+    """Recount upload references and delete orphaned files (for cron on serverless deployments)."""
+    rebuild_upload_refs()
+    print(f"[OK] {sweep_orphan_uploads()} orphaned upload(s) removed")
 
 # ---------- TIME HELPERS ----------
-def to_ist_display(dt):
-    if not dt: return ''
+IST = pytz.timezone('Asia/Kolkata')
+# India has no DST, so display formatting can shift naive UTC by a constant
+IST_OFFSET = timedelta(hours=5, minutes=30)
+IST_DISPLAY_FORMAT = '%b %d, %Y %I:%M %p'
+
+def ist_date_range(start, end):
+    """
+    Turn inclusive IST 'YYYY-MM-DD' filter dates into a half-open [lo, hi)
+    range of naive UTC timestamps (how orders.created_at is stored).
+    Missing or malformed dates leave that side open (None).
+    """
+    def midnight_utc(value, add_days=0):
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d') + timedelta(days=add_days)
+        except (TypeError, ValueError):
+            return None
+        return IST.localize(day).astimezone(pytz.utc).replace(tzinfo=None)
+    return midnight_utc(start), midnight_utc(end, add_days=1)
+
+def to_ist(dt):
+    """Aware IST datetime for a naive-UTC (or aware) timestamp."""
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt.astimezone(IST)
+
+def created_at_filter(start, end, column='created_at'):
+    """Index-friendly SQL condition + params for an IST date filter, e.g. (" AND created_at >= %s", [lo])."""
+    lo, hi = ist_date_range(start, end)
+    sql, params = "", []
+    if lo is not None:
+        sql += f" AND {column} >= %s"; params.append(lo)
+    if hi is not None:
+        sql += f" AND {column} < %s"; params.append(hi)
+    return sql, params
+
+def _utc_naive(dt):
+    """Naive UTC datetime for a stored timestamp (naive values are already UTC), or None."""
     if isinstance(dt, str):
         try:
-            dt = datetime.strptime(dt, '%Y-%m-%d %H:%M:%S')
-        except: return dt
-    ist = pytz.timezone('Asia/Kolkata')
-    return dt.astimezone(ist).strftime('%b %d, %Y %I:%M %p')
+            dt = datetime.fromisoformat(dt)
+        except ValueError:
+            return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+@lru_cache(maxsize=8192)
+def _ist_minute(minute):
+    local = minute + IST_OFFSET
+    return local.strftime(IST_DISPLAY_FORMAT), local.strftime('%Y-%m-%d')
+
+def ist_display_and_day(dt):
+    """('Jan 05, 2025 09:30 AM', '2025-01-05') in IST; formatting is memoized per minute."""
+    if not dt:
+        return '', ''
+    utc = _utc_naive(dt)
+    if utc is None:
+        return str(dt), str(dt).split(' ')[0]
+    return _ist_minute(utc.replace(second=0, microsecond=0))
+
+def format_ist_many(values):
+    """ist_display_and_day() for a whole result column in one pass, formatting each minute once."""
+    seen, out = {}, []
+    for dt in values:
+        key = dt if isinstance(dt, datetime) and dt.tzinfo is None else None
+        minute = key.replace(second=0, microsecond=0) if key else None
+        if minute is not None and minute in seen:
+            out.append(seen[minute])
+            continue
+        formatted = ist_display_and_day(dt)
+        if minute is not None:
+            seen[minute] = formatted
+        out.append(formatted)
+    return out
+
+def to_ist_display(dt):
+    return ist_display_and_day(dt)[0]
 
 def parse_order_items(items_json):
     try:
@@ -268,6 +1850,206 @@ def parse_order_items(items_json):
         print(f"[ERROR] Unexpected error parsing items: {e}")
         return [], ''
 
+# ---------- ORDER ITEMS ----------
+# order_items holds the same lines as orders.items, written in the checkout
+# transaction, so listings and reports read lines with plain SQL instead of
+# parsing JSON per row.
+def summarize_items(parsed):
+    """The listing summary stored in orders.items_summary, e.g. "Milk x2, Curd x1, Ghee x1..."."""
+    names = [f"{it['name']} x{it['qty']}" for it in parsed]
+    return ", ".join(names[:3]) + ("..." if len(names) > 3 else "")
+
+def insert_order_items(cur, order_id, items):
+    """Write an order's lines ({'id','name','qty','price'} dicts) inside the caller's transaction."""
+    if not items:
+        return
+    cur.execute("""
+        INSERT INTO order_items (order_id, line_no, product_id, name, qty, price)
+        SELECT %s, * FROM unnest(%s::smallint[], %s::int[], %s::text[], %s::int[], %s::numeric[])
+    """, (order_id, list(range(1, len(items) + 1)),
+          [int(it['id']) if it['id'] is not None else None for it in items],
+          [it['name'] for it in items], [int(it['qty']) for it in items], [float(it['price']) for it in items]))
+
+def load_order_items(order_ids):
+    """{order_id: [line dicts in order]} for many orders in one query."""
+    lines = defaultdict(list)
+    if not order_ids:
+        return lines
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT order_id, product_id, name, qty, price FROM order_items
+            WHERE order_id = ANY(%s) ORDER BY order_id, line_no
+        """, (list(order_ids),))
+        for order_id, product_id, name, qty, price in cur.fetchall():
+            lines[order_id].append({'id': product_id, 'name': name, 'qty': qty, 'price': float(price)})
+    return lines
+
+def backfill_order_items():
+    """Fill order_items for orders that have no lines yet, from orders.items."""
+    conn = get_conn()
+    missing = "NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.id)"
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO order_items (order_id, line_no, product_id, name, qty, price)
+            SELECT o.id, it.line_no, (it.line->>'id')::int, it.line->>'name',
+                   COALESCE((it.line->>'qty')::int, 1), COALESCE((it.line->>'price')::numeric, 0)
+            FROM orders o, jsonb_array_elements(o.items) WITH ORDINALITY AS it(line, line_no)
+            WHERE jsonb_typeof(o.items) = 'array' AND {missing}
+        """)
+        # Legacy rows hold a Python-literal string; only parse_order_items understands them
+        cur.execute(f"SELECT o.id, o.items FROM orders o WHERE jsonb_typeof(o.items) = 'string' AND {missing}")
+        for order_id, items in cur.fetchall():
+            insert_order_items(cur, order_id, parse_order_items(items)[0])
+    conn.commit()
+
+def backfill_order_summaries():
+    """Fill orders.items_summary / item_count from order_items where they are missing."""
+    conn = get_conn()
+    with conn.cursor() as cur:
+        # Same text as summarize_items(): first three lines, "..." when there are more
+        cur.execute("""
+            UPDATE orders o SET items_summary = s.summary, item_count = s.units
+            FROM (
+                SELECT order_id,
+                       string_agg(COALESCE(name, 'None') || ' x' || qty, ', ' ORDER BY line_no)
+                           FILTER (WHERE line_no <= 3)
+                       || CASE WHEN COUNT(*) > 3 THEN '...' ELSE '' END AS summary,
+                       SUM(qty) AS units
+                FROM order_items GROUP BY order_id
+            ) s
+            WHERE o.id = s.order_id AND o.items_summary IS NULL
+        """)
+        cur.execute("UPDATE orders SET items_summary = '', item_count = 0 WHERE items_summary IS NULL")
+    conn.commit()
+
+@app.cli.command('backfill-order-items')
+def backfill_order_items_command():
+    """Copy order lines from orders.items into order_items, then fill missing order summaries."""
+    backfill_order_items()
+    backfill_order_summaries()
+    print("[OK] order_items and order summaries backfilled")
+
+# ---------- ORDER LISTING (KEYSET PAGINATION) ----------
+ORDERS_PAGE_SIZE = int(os.environ.get("ORDERS_PAGE_SIZE", "50"))
+# Rows fetched per round trip by server-side (named) cursors that stream orders
+ORDERS_STREAM_BATCH = int(os.environ.get("ORDERS_STREAM_BATCH", "500"))
+
+def encode_cursor(created_at, order_id):
+    raw = f"{created_at.isoformat()}~{order_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Returns (created_at, id) or None for a missing/garbled cursor."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        ts, oid = raw.rsplit('~', 1)
+        return datetime.fromisoformat(ts), int(oid)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def fetch_orders_page(start=None, end=None, cursor=None, user_id=None, limit=None):
+    """
+    One page of orders, newest first, seeking past `cursor` on (created_at, id)
+    so the cost does not grow with how many pages came before.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    limit = limit or ORDERS_PAGE_SIZE
+    sql = """
+        SELECT o.id, o.user_id, o.total, o.address, o.status, o.created_at,
+               o.items_summary, o.item_count, u.username
+        FROM orders o LEFT JOIN users u ON o.user_id=u.id WHERE 1=1
+    """
+    params = []
+    if user_id is not None:
+        sql += " AND o.user_id=%s"; params.append(user_id)
+    date_sql, date_params = created_at_filter(start, end, 'o.created_at')
+    sql += date_sql; params += date_params
+    after = decode_cursor(cursor)
+    if after:
+        sql += " AND (o.created_at, o.id) < (%s, %s)"; params += list(after)
+    sql += " ORDER BY o.created_at DESC, o.id DESC LIMIT %s"; params.append(limit + 1)
+
+    conn = get_conn()
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    # Summaries are stored at checkout; only orders not yet backfilled need their lines
+    pending = [r['id'] for r in rows if r['items_summary'] is None]
+    if pending:
+        lines = load_order_items(pending)
+        for r in rows:
+            if r['items_summary'] is None:
+                parsed = lines.get(r['id'], [])
+                r['items_summary'], r['item_count'] = summarize_items(parsed), sum(it['qty'] for it in parsed)
+    for r, (shown, day) in zip(rows, format_ist_many(r['created_at'] for r in rows)):
+        r['created_at_display'], r['ist_day'] = shown, day
+    return rows, next_cursor
+
+def order_entry(r):
+    """Display dict for an order row, plus its IST day key for grouping."""
+    if r.get('items_summary') is not None:
+        summary, item_count = r['items_summary'], r['item_count']
+    else:
+        parsed = parse_order_items(r['items'] or '[]')[0]
+        summary, item_count = summarize_items(parsed), sum(it['qty'] for it in parsed)
+    if 'ist_day' in r:
+        shown, day_key = r['created_at_display'], r['ist_day']
+    else:
+        shown, day_key = ist_display_and_day(r['created_at'])
+    entry = {
+        'id': r['id'], 'user_id': r['user_id'], 'username': r.get('username'),
+        'items_summary': summary, 'item_count': item_count, 'total': float(r['total']),
+        'status': r['status'], 'created_at': shown, 'address': r['address'],
+    }
+    return entry, day_key
+
+def group_orders_by_day(rows):
+    """
+    Group a page of rows into {day: [entries newest first]} and look up, in one
+    query, each day's full order count and how many of its orders are older
+    than the page (so S.No stays correct across pages).
+    Returns (daywise, day_info) with day_info[day] = {'total', 'older'}.
+    """
+    daywise, oldest = OrderedDict(), {}
+    for r in rows:
+        entry, day = order_entry(r)
+        daywise.setdefault(day, []).append(entry)
+        oldest[day] = r
+    day_info = {day: {'total': len(entries), 'older': 0} for day, entries in daywise.items()}
+    days = [d for d in oldest if isinstance(oldest[d]['created_at'], datetime)]
+    if not days:
+        return daywise, day_info
+
+    day_starts = [ist_date_range(d, None)[0] for d in days]
+    conn = get_conn()
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("""
+            SELECT v.day_lo,
+                   COUNT(o.id) AS total,
+                   COUNT(o.id) FILTER (WHERE (o.created_at, o.id) < (v.min_ts, v.min_id)) AS older
+            FROM unnest(%s::timestamp[], %s::timestamp[], %s::int[]) AS v(day_lo, min_ts, min_id)
+            LEFT JOIN orders o ON o.created_at >= v.day_lo AND o.created_at < v.day_lo + INTERVAL '1 day'
+            GROUP BY v.day_lo
+        """, (day_starts, [oldest[d]['created_at'] for d in days], [oldest[d]['id'] for d in days]))
+        counts = {row['day_lo']: row for row in cur.fetchall()}
+    for day, lo in zip(days, day_starts):
+        if lo in counts:
+            day_info[day] = {'total': counts[lo]['total'], 'older': counts[lo]['older']}
+    return daywise, day_info
+
+def order_json(r):
+    entry, day = order_entry(r)
+    entry['day'] = day
+    entry['created_at_iso'] = r['created_at'].isoformat() if isinstance(r['created_at'], datetime) else None
+    return entry
+
 # ---------- EMBEDDED TEMPLATES ----------
 _templates = {}
 
@@ -277,12 +2059,50 @@ _templates = {}
 # ---------- ROUTES ----------
 @app.route('/')
 def index():
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT * FROM products ORDER BY id DESC;")
-    products = cur.fetchall()
-    cur.close()
-    return render_template('index.html', products=products)
+    filters = product_filters(request.args)
+    grid = catalog_grid() if is_default_catalog_view(filters, None) else filtered_grid(filters)
+    html = render_template('index.html', product_grid=grid['html'], next_cursor=grid['next_cursor'], filters=filters)
+    # Anonymous visitors with nothing in their session all get the same page,
+    # so browsers can revalidate it against an ETag of the whole page.
+    if not session.get('user_id') and not session.get('cart') and not session.get('_flashes'):
+        return conditional_catalog_response(html, grid, 'no-cache', page=True)
+    return html
+
+@app.route('/products/grid')
+def product_grid():
+    """A page of storefront cards on its own (used by "Load more"), cacheable by browsers and CDNs."""
+    filters, cursor = product_filters(request.args), request.args.get('cursor')
+    grid = catalog_grid() if is_default_catalog_view(filters, cursor) else filtered_grid(filters, cursor)
+    return conditional_catalog_response(grid['html'], grid, f'public, max-age={int(CATALOG_CACHE_TTL)}')
+
+@app.route('/api/products')
+def api_products():
+    rows, next_cursor = query_products(product_filters(request.args), request.args.get('cursor'),
+                                       limit=max(1, min(request.args.get('limit', PRODUCTS_PAGE_SIZE, type=int), 100)))
+    return jsonify({
+        'products': [dict(r, price=float(r['price'])) for r in rows],
+        'next_cursor': next_cursor,
+    })
+
+# <picture> element for uploaded images: AVIF/WebP/JPEG srcsets from the stored
+# variants, falling back to a plain <img> until the image workers have run.
+_templates["image_macros.html"] = r"""
+{% macro picture(variants, src, alt='', class='', sizes='100vw', loading='lazy') -%}
+  {%- if variants -%}
+    <picture>
+      {%- for fmt in ('avif', 'webp') if variants[fmt] %}
+      <source type="image/{{ fmt }}" sizes="{{ sizes }}"
+              srcset="{% for w, f in variants[fmt] %}{{ upload_url(f) }} {{ w }}w{{ ', ' if not loop.last }}{% endfor %}">
+      {%- endfor %}
+      <img src="{{ upload_url(variants['jpeg'][-1][1]) }}" sizes="{{ sizes }}"
+           srcset="{% for w, f in variants['jpeg'] %}{{ upload_url(f) }} {{ w }}w{{ ', ' if not loop.last }}{% endfor %}"
+           alt="{{ alt }}" class="{{ class }}" loading="{{ loading }}" decoding="async">
+    </picture>
+  {%- else -%}
+    <img src="{{ src }}" alt="{{ alt }}" class="{{ class }}" loading="{{ loading }}" decoding="async">
+  {%- endif -%}
+{%- endmacro %}
+"""
 
 # ---------- BASE HTML WITH RESPONSIVE NAVBAR ----------
 _templates["base.html"] = r"""
@@ -377,7 +2197,9 @@ _templates["base.html"] = r"""
         <div class="relative">
           <button id="avatar-btn" class="flex items-center gap-2 focus:outline-none">
             {% if current_user.avatar %}
-              <img src="{{ url_for('uploaded_file', filename=current_user.avatar) }}" alt="avatar" class="avatar-img">
+              {% from 'image_macros.html' import picture %}
+              {{ picture(current_user.avatar_variants, upload_url(current_user.avatar),
+                         alt='avatar', class='avatar-img', sizes='36px', loading='eager') }}
             {% else %}
               <div class="avatar-circle" title="{{ current_user.username }}">{{ current_user.initial }}</div>
             {% endif %}
@@ -503,14 +2325,99 @@ _templates["index.html"] = r"""
   <!-- Products -->
   <h2 id="products" class="text-xl sm:text-2xl font-bold mb-4 sm:mb-6 text-gray-800">Our Products</h2>
 
-  {% if products %}
-  <div class="grid gap-6 sm:gap-8"
+  <form method="get" action="{{ url_for('index') }}#products" class="glass rounded-xl p-3 sm:p-4 mb-6 flex flex-col md:flex-row gap-2 md:items-center">
+    <input name="q" value="{{ filters.q or '' }}" placeholder="Search milk, curd, paneer…" class="flex-1 border rounded-lg px-3 py-2 focus:ring-2 focus:ring-emerald-400 focus:outline-none">
+    <div class="flex gap-2">
+      <input name="min_price" type="number" step="0.01" min="0" value="{{ filters.min_price if filters.min_price is not none else '' }}" placeholder="Min ₹" class="w-24 border rounded-lg px-2 py-2">
+      <input name="max_price" type="number" step="0.01" min="0" value="{{ filters.max_price if filters.max_price is not none else '' }}" placeholder="Max ₹" class="w-24 border rounded-lg px-2 py-2">
+    </div>
+    <select name="sort" class="border rounded-lg px-2 py-2">
+      {% for key, label in [('newest','Newest'), ('price_asc','Price: low to high'), ('price_desc','Price: high to low'), ('name','Name')] %}
+        <option value="{{ key }}" {{ 'selected' if filters.sort == key else '' }}>{{ label }}</option>
+      {% endfor %}
+    </select>
+    <label class="flex items-center gap-1 text-sm text-gray-700"><input type="checkbox" name="in_stock" value="1" {{ 'checked' if filters.in_stock else '' }}> In stock</label>
+    <button class="btn-emerald text-white px-4 py-2 rounded-lg">Search</button>
+  </form>
+
+  {% if product_grid.strip() %}
+  <div id="product-grid" class="grid gap-6 sm:gap-8"
        style="grid-template-columns: repeat(auto-fill, minmax(260px, 1fr));">
+    {{ product_grid|safe }}
+  </div>
+  <div class="mt-6 text-center">
+    <button id="load-more-products" data-next-cursor="{{ next_cursor or '' }}"
+            class="btn-ghost px-4 py-2 rounded-lg {{ '' if next_cursor else 'hidden' }}">Load more</button>
+  </div>
+  {% else %}
+    <p class="text-gray-600">No products available at the moment.</p>
+  {% endif %}
+
+  <script>
+    function showToast(msg){
+      const toast = document.createElement('div');
+      toast.innerHTML = msg;
+      toast.className = "glass px-4 py-3 rounded-lg shadow-lg fixed bottom-5 right-5 z-50";
+      document.body.appendChild(toast);
+      setTimeout(()=> toast.remove(), 2200);
+    }
+    function setCartCount(count){
+      const el = document.getElementById('cart-count-badge');
+      if(el) el.textContent = count;
+    }
+    async function addToCartAjax(productId, qty){
+      try{
+        const form = new FormData();
+        form.append('product_id', productId);
+        form.append('qty', qty);
+        const resp = await fetch('{{ url_for("api_cart_add") }}', { method: 'POST', credentials: 'same-origin', body: form });
+        const data = await resp.json();
+        if(!resp.ok){ showToast(data.error || 'Could not add to cart'); return; }
+        setCartCount(data.total_items || 0);
+        showToast(`✅ Added ${qty} × ${data.product_name || 'item'} to cart`);
+      }catch(err){ console.error(err); showToast('❌ Error adding to cart'); }
+    }
+    // Delegated so cards appended by "Load more" work without rebinding
+    document.addEventListener('click', e=>{
+      const btn = e.target.closest('.qty-add, .qty-sub, .add-cart-btn');
+      if(!btn) return;
+      const widget = btn.closest('.qty-widget') || btn.parentElement.querySelector('.qty-widget');
+      if(!widget) return;
+      const input = widget.querySelector('.qty-input');
+      e.preventDefault();
+      if(btn.classList.contains('qty-add')) input.value = (parseInt(input.value)||0) + 1;
+      else if(btn.classList.contains('qty-sub')) input.value = Math.max(1,(parseInt(input.value)||1)-1);
+      else addToCartAjax(widget.dataset.productId, parseInt(input.value)||1);
+    });
+
+    async function loadMoreProducts(btn){
+      const params = new URLSearchParams(window.location.search);
+      params.set('cursor', btn.dataset.nextCursor);
+      btn.disabled = true;
+      try{
+        const resp = await fetch('{{ url_for("product_grid") }}?' + params.toString());
+        if(!resp.ok) return;
+        document.getElementById('product-grid').insertAdjacentHTML('beforeend', await resp.text());
+        btn.dataset.nextCursor = resp.headers.get('X-Next-Cursor') || '';
+        if(!btn.dataset.nextCursor) btn.classList.add('hidden');
+      } finally { btn.disabled = false; }
+    }
+    document.addEventListener('DOMContentLoaded', ()=>{
+      const more = document.getElementById('load-more-products');
+      more?.addEventListener('click', ()=> loadMoreProducts(more));
+    });
+  </script>
+{% endblock %}
+"""
+
+# Product cards for one catalogue page; the default first page is cached by catalog_grid()
+_templates["product_grid.html"] = r"""
+    {% from 'image_macros.html' import picture %}
     {% for p in products %}
       <div class="glass rounded-xl flex flex-col overflow-hidden">
         <div class="bg-white/60 flex justify-center items-center h-[220px]">
-          <img src="{{ p.image or 'https://via.placeholder.com/300x200?text=No+Image' }}" alt="{{ p.name }}"
-               class="max-h-[210px] w-auto object-contain rounded">
+          {{ picture(p.image_variants, p.image or 'https://via.placeholder.com/300x200?text=No+Image', alt=p.name,
+                     class='max-h-[210px] w-auto object-contain rounded', sizes='(max-width: 640px) 90vw, 300px') }}
         </div>
 
         <div class="p-4 sm:p-5 flex-1 flex flex-col justify-between">
@@ -550,58 +2457,17 @@ _templates["index.html"] = r"""
         </div>
       </div>
     {% endfor %}
-  </div>
-  {% else %}
-    <p class="text-gray-600">No products available at the moment.</p>
-  {% endif %}
-
-  <script>
-    function showToast(msg){
-      const toast = document.createElement('div');
-      toast.innerHTML = msg;
-      toast.className = "glass px-4 py-3 rounded-lg shadow-lg fixed bottom-5 right-5 z-50";
-      document.body.appendChild(toast);
-      setTimeout(()=> toast.remove(), 2200);
-    }
-    function setCartCount(count){
-      const el = document.getElementById('cart-count-badge');
-      if(el) el.textContent = count;
-    }
-    async function addToCartAjax(productId, qty){
-      try{
-        const form = new FormData();
-        form.append('product_id', productId);
-        form.append('qty', qty);
-        const resp = await fetch('{{ url_for("api_cart_add") }}', { method: 'POST', credentials: 'same-origin', body: form });
-        const data = await resp.json();
-        if(!resp.ok){ showToast(data.error || 'Could not add to cart'); return; }
-        setCartCount(data.total_items || 0);
-        showToast(`✅ Added ${qty} × ${data.product_name || 'item'} to cart`);
-      }catch(err){ console.error(err); showToast('❌ Error adding to cart'); }
-    }
-    document.addEventListener('DOMContentLoaded', ()=>{
-      document.querySelectorAll('.qty-widget').forEach(widget => {
-        const input = widget.querySelector('.qty-input');
-        const btnAdd = widget.querySelector('.qty-add');
-        const btnSub = widget.querySelector('.qty-sub');
-        const productId = widget.dataset.productId;
-        const addCartBtn = widget.parentElement.querySelector('.add-cart-btn');
-        btnAdd?.addEventListener('click', e=>{ e.preventDefault(); input.value = (parseInt(input.value)||0) + 1; });
-        btnSub?.addEventListener('click', e=>{ e.preventDefault(); input.value = Math.max(1,(parseInt(input.value)||1)-1); });
-        addCartBtn?.addEventListener('click', e=>{ e.preventDefault(); addToCartAjax(productId, parseInt(input.value)||1); });
-      });
-    });
-  </script>
-{% endblock %}
 """
 
 _templates["product.html"] = r"""
 {% extends 'base.html' %}
+{% from 'image_macros.html' import picture %}
 {% block content %}
   <div class="max-w-5xl mx-auto glass p-4 sm:p-6 rounded shadow">
     <div class="grid grid-cols-1 md:grid-cols-2 gap-4 sm:gap-6">
       <div class="glass-soft rounded p-2 soft-border">
-        <img src="{{ product.image or 'https://via.placeholder.com/300x200?text=No+Image' }}" alt="{{ product.name }}" class="w-full h-72 sm:h-80 object-cover rounded">
+        {{ picture(product.image_variants, product.image or 'https://via.placeholder.com/300x200?text=No+Image', alt=product.name,
+                   class='w-full h-72 sm:h-80 object-cover rounded', sizes='(max-width: 768px) 100vw, 50vw', loading='eager') }}
       </div>
       <div>
         <h1 class="text-xl sm:text-2xl font-bold text-emerald-700">{{ product.name }}</h1>
@@ -865,7 +2731,9 @@ _templates["profile.html"] = r"""
     <h2 class="text-xl font-semibold mb-4">Change Logo / Avatar</h2>
     <div class="mb-4">
       {% if user.avatar %}
-        <img src="{{ url_for('uploaded_file', filename=user.avatar) }}" class="w-24 h-24 rounded-full object-cover">
+        {% from 'image_macros.html' import picture %}
+        {{ picture(user.avatar_variants, upload_url(user.avatar),
+                   alt='avatar', class='w-24 h-24 rounded-full object-cover', sizes='96px', loading='eager') }}
       {% else %}
         <div class="w-24 h-24 rounded-full bg-emerald-200 flex items-center justify-center text-2xl font-semibold text-emerald-700">{{ user.initial }}</div>
       {% endif %}
@@ -895,18 +2763,18 @@ _templates["dashboard_user.html"] = r"""
   <div class="grid grid-cols-1 sm:grid-cols-3 gap-3 sm:gap-4 mb-4" id="user-stats">
     <div class="p-4 rounded-2xl bg-gradient-to-br from-emerald-50 to-white shadow-sm backdrop-blur-md border border-emerald-100">
       <div class="text-sm text-gray-500">Total Orders</div>
-      <div class="text-2xl font-bold text-emerald-700">{{ orders|length }}</div>
+      <div class="text-2xl font-bold text-emerald-700">{{ stats.total_orders }}</div>
     </div>
     <div class="p-4 rounded-2xl bg-gradient-to-br from-emerald-50 to-white shadow-sm backdrop-blur-md border border-emerald-100">
       <div class="text-sm text-gray-500">Delivered Orders</div>
       <div class="text-2xl font-bold text-emerald-700">
-        {{ orders | selectattr('status','equalto','Delivered') | list | length }}
+        {{ stats.delivered_orders }}
       </div>
     </div>
     <div class="p-4 rounded-2xl bg-gradient-to-br from-emerald-50 to-white shadow-sm backdrop-blur-md border border-emerald-100">
       <div class="text-sm text-gray-500">Total Spent</div>
       <div class="text-2xl font-bold text-emerald-700">
-        ₹{{ orders | map(attribute='total') | sum | round(2) }}
+        ₹{{ '%.2f'|format(stats.total_spent) }}
       </div>
     </div>
   </div>
@@ -972,9 +2840,14 @@ _templates["dashboard_user.html"] = r"""
       </div>
     {% endif %}
   </div>
+  <div id="user-orders-sentinel" class="h-8"></div>
 
   <!-- JS: Filter Logic -->
   <script>
+  let userOrdersCursor = {{ next_cursor|tojson }};
+  let userOrdersFilter = { start: '', end: '' };
+  let userOrdersLoading = false;
+
   async function fetchUserOrdersFragment(start, end){
     const params = new URLSearchParams();
     if(start) params.set('start', start);
@@ -983,6 +2856,24 @@ _templates["dashboard_user.html"] = r"""
     if(!resp.ok) return;
     const html = await resp.text();
     document.getElementById('user-orders-wrapper').innerHTML = html;
+    userOrdersFilter = { start, end };
+    userOrdersCursor = resp.headers.get('X-Next-Cursor') || null;
+  }
+
+  // Infinite scroll: fetch the next keyset page when the sentinel comes into view
+  async function loadMoreUserOrders(){
+    if(!userOrdersCursor || userOrdersLoading) return;
+    userOrdersLoading = true;
+    const params = new URLSearchParams({ cursor: userOrdersCursor });
+    if(userOrdersFilter.start) params.set('start', userOrdersFilter.start);
+    if(userOrdersFilter.end) params.set('end', userOrdersFilter.end);
+    try{
+      const resp = await fetch('{{ url_for("user_orders_fragment") }}?' + params.toString());
+      if(resp.ok){
+        document.getElementById('user-orders-wrapper').insertAdjacentHTML('beforeend', await resp.text());
+        userOrdersCursor = resp.headers.get('X-Next-Cursor') || null;
+      }
+    } finally { userOrdersLoading = false; }
   }
 
   async function fetchUserStatsFragment(start, end){
@@ -997,6 +2888,13 @@ _templates["dashboard_user.html"] = r"""
   }
 
   document.addEventListener('DOMContentLoaded', ()=>{
+    const sentinel = document.getElementById('user-orders-sentinel');
+    if(sentinel && 'IntersectionObserver' in window){
+      new IntersectionObserver(entries => {
+        if(entries.some(e => e.isIntersecting)) loadMoreUserOrders();
+      }, { rootMargin: '400px' }).observe(sentinel);
+    }
+
     const startEl = document.getElementById('user-filter-start');
     const endEl   = document.getElementById('user-filter-end');
     const applyBtn = document.getElementById('user-filter-apply');
@@ -1055,6 +2953,8 @@ _templates["dashboard_admin.html"] = r"""
         <div class="flex gap-2">
           <button id="filter-apply" class="btn-emerald text-white px-3 py-2 rounded">Apply</button>
           <button id="filter-reset" class="px-3 py-2 rounded border">Reset</button>
+          <button class="export-btn px-3 py-2 rounded border" data-format="csv">CSV</button>
+          <button class="export-btn px-3 py-2 rounded border" data-format="xlsx">XLSX</button>
         </div>
       </div>
     </div>
@@ -1071,7 +2971,13 @@ _templates["dashboard_admin.html"] = r"""
     <div class="col-span-1 md:col-span-2 glass p-3 sm:p-4 rounded">
       <div class="flex flex-col sm:flex-row sm:justify-between sm:items-center gap-2 mb-3 sm:mb-4">
         <h3 class="font-semibold">Product Management</h3>
-        <a href="{{ url_for('admin_add_product') }}" class="btn-emerald text-white px-3 py-2 rounded text-center">Add Product</a>
+        <div class="flex gap-2">
+          <input id="admin-product-search" type="search" placeholder="Search products…" class="border rounded px-2 py-2 text-sm">
+          <a href="{{ url_for('admin_add_product') }}" class="btn-emerald text-white px-3 py-2 rounded text-center">Add Product</a>
+          <label class="btn-ghost px-3 py-2 rounded text-center cursor-pointer" title="CSV columns: id,name,description,price,image,stock">
+            Import CSV<input id="admin-product-import" type="file" accept=".csv,text/csv" class="hidden">
+          </label>
+        </div>
       </div>
 
       <div class="overflow-x-auto -mx-2 sm:mx-0">
@@ -1087,113 +2993,52 @@ _templates["dashboard_admin.html"] = r"""
             </tr>
           </thead>
           <tbody id="products-table-body" class="bg-white/40">
-            {% for p in products %}
-              <tr class="border-t hover:bg-white/70">
-                <td class="py-3 px-4"><img src="{{ p.image or 'https://via.placeholder.com/100x100?text=No' }}" class="w-12 h-12 rounded-full object-cover"></td>
-                <td class="py-3 px-4 font-medium">{{ p.name }}</td>
-                <td class="py-3 px-4 small-muted">{{ p.description }}</td>
-                <td class="py-3 px-4">₹{{ '%.2f'|format(p.price) }}</td>
-                <td class="py-3 px-4">
-                  {% if p.stock == 0 %}
-                    <span class="badge bg-red-100 text-red-700">Out of Stock</span>
-                  {% else %}
-                    {{ p.stock }}
-                  {% endif %}
-                </td>
-                <td class="py-3 px-4">
-                  <a href="{{ url_for('admin_edit_product', product_id=p.id) }}" class="text-sm underline mr-3">Edit</a>
-                  <form method="post" action="{{ url_for('admin_delete_product', product_id=p.id) }}" style="display:inline;" onsubmit="return confirm('Delete product {{ p.name }}?');">
-                    <button class="text-red-600 text-sm">Delete</button>
-                  </form>
-                </td>
-              </tr>
-            {% endfor %}
+            {% include 'admin_product_rows.html' %}
           </tbody>
         </table>
       </div>
+      <div class="mt-3 text-center">
+        <button id="load-more-admin-products" data-next-cursor="{{ products_cursor or '' }}"
+                class="btn-ghost px-3 py-1.5 rounded text-sm {{ '' if products_cursor else 'hidden' }}">Load more products</button>
+      </div>
 
     </div>
 
     <div class="glass p-4 rounded" id="quick-stats-box">
       <h3 class="font-semibold mb-3">Quick Stats</h3>
       <div class="space-y-3" id="quick-stats-content">
-        <div>Total users: <strong>{{ stats.users }}</strong></div>
-        <div>Total orders: <strong>{{ stats.orders }}</strong></div>
-        <div>Revenue: <strong>₹{{ '%.2f'|format(stats.revenue) }}</strong></div>
+        <div>Total users: <strong id="stat-users">{{ stats.users }}</strong></div>
+        <div>Total orders: <strong id="stat-orders">{{ stats.orders }}</strong></div>
+        <div>Revenue: <strong id="stat-revenue">₹{{ '%.2f'|format(stats.revenue) }}</strong></div>
       </div>
     </div>
   </div>
 
   <!-- Orders by User -->
   <div class="mt-4 sm:mt-6 glass p-3 sm:p-4 rounded" id="orders-section">
-    <h3 class="font-semibold mb-3">Orders by User</h3>
+    <div class="flex items-center justify-between mb-3">
+      <h3 class="font-semibold">Orders by User</h3>
+      <button id="orders-show-all" class="btn-ghost px-3 py-1 rounded text-sm">Show all</button>
+    </div>
+    <div class="flex flex-wrap items-center gap-2 mb-3 text-sm" id="orders-bulk">
+      <span class="text-gray-600">Mark</span>
+      <select id="bulk-from" class="border rounded px-2 py-1">
+        <option value="">selected orders</option>
+        {% for s in order_statuses %}<option value="{{ s }}">all {{ s }} in date filter</option>{% endfor %}
+      </select>
+      <span class="text-gray-600">as</span>
+      <select id="bulk-to" class="border rounded px-2 py-1">
+        {% for s in order_statuses %}<option>{{ s }}</option>{% endfor %}
+      </select>
+      <button id="bulk-apply" class="btn-emerald text-white px-3 py-1 rounded">Apply</button>
+      <span id="bulk-result" class="text-gray-600"></span>
+    </div>
     <div id="orders-wrapper">
       {% if daywise %}
         {% for day, orders in daywise.items() %}
-          <div class="mb-4 sm:mb-6 border border-white/50 rounded-lg overflow-hidden">
-            <div class="bg-emerald-50/80 px-4 py-2 text-sm font-semibold text-emerald-800 border-b border-emerald-100">
-              {{ day }} — {{ orders|length }} order{{ 's' if orders|length > 1 else '' }}
-            </div>
-            <div class="overflow-x-auto -mx-2 sm:mx-0">
-              <table class="w-full text-left text-sm border-collapse min-w-[720px] sm:min-w-0">
-                <thead class="bg-emerald-100 text-emerald-900">
-                  <tr>
-                    <th class="py-2 px-4 font-semibold text-left">Order</th>
-                    <th class="py-2 px-4 font-semibold text-left">User</th>
-                    <th class="py-2 px-4 font-semibold text-left">Items</th>
-                    <th class="py-2 px-4 font-semibold text-right">Total</th>
-                    <th class="py-2 px-4 font-semibold text-left">Status</th>
-                    <th class="py-2 px-4 font-semibold text-center">Action</th>
-                  </tr>
-                </thead>
-                <tbody class="bg-white/50">
-                  {% for o in orders %}
-                    <tr class="border-t hover:bg-white/70 transition">
-                      <td class="py-2 px-4 align-top">
-                        <div class="font-medium text-gray-800">#{{ o.id }}</div>
-                        <div class="text-xs text-gray-500">{{ o.created_at }}</div>
-                      </td>
-                      <td class="py-2 px-4 align-top">
-                        {{ o.username or ('User ' + (o.user_id|string)) }}
-                      </td>
-                      <td class="py-2 px-4 align-top text-gray-700">
-                        {{ o.items_summary }}
-                      </td>
-                      <td class="py-2 px-4 align-top text-right font-semibold text-gray-800">
-                        ₹{{ '%.2f'|format(o.total) }}
-                      </td>
-                      <td class="py-2 px-4 align-top">
-                        <span class="badge
-                          {% if o.status == 'Pending' %} bg-yellow-100 text-yellow-800
-                          {% elif o.status == 'Confirmed' %} bg-blue-100 text-blue-800
-                          {% elif o.status == 'Out for Delivery' %} bg-purple-100 text-purple-800
-                          {% elif o.status == 'Delivered' %} bg-green-100 text-green-800
-                          {% else %} bg-gray-100 text-gray-700{% endif %}
-                        ">{{ o.status }}</span>
-                      </td>
-                      <td class="py-2 px-4 text-center">
-                        <div class="flex items-center justify-center gap-2">
-                          <a href="{{ url_for('view_order', order_id=o.id) }}" class="text-sm text-emerald-700 hover:underline">View</a>
-                          <form method="post" action="{{ url_for('admin_update_order', order_id=o.id) }}" class="flex items-center gap-2">
-                            <select name="status" class="border rounded px-2 py-1 text-sm focus:ring-emerald-400 focus:border-emerald-400">
-                              <option {{ 'selected' if o.status=='Pending' else '' }}>Pending</option>
-                              <option {{ 'selected' if o.status=='Confirmed' else '' }}>Confirmed</option>
-                              <option {{ 'selected' if o.status=='Out for Delivery' else '' }}>Out for Delivery</option>
-                              <option {{ 'selected' if o.status=='Delivered' else '' }}>Delivered</option>
-                            </select>
-                            <button class="btn-emerald text-white px-2 py-1 rounded text-sm">Update</button>
-                          </form>
-                          <form method="post" action="{{ url_for('delete_order', order_id=o.id) }}" onsubmit="return confirm('Delete order #{{ o.id }}?');">
-                            <button class="text-red-600 text-sm hover:underline">Delete</button>
-                          </form>
-                        </div>
-                      </td>
-                    </tr>
-                  {% endfor %}
-                </tbody>
-              </table>
-            </div>
-          </div>
+          {% with orders=orders|reverse|list, total=day_info[day].total, first_sno=day_info[day].older + 1 %}
+            {% include 'admin_order_day_group.html' %}
+          {% endwith %}
         {% endfor %}
       {% else %}
         <div class="text-gray-600 text-center py-6 border border-gray-100 rounded">
@@ -1201,11 +3046,15 @@ _templates["dashboard_admin.html"] = r"""
         </div>
       {% endif %}
     </div>
+    <div id="orders-sentinel" class="h-8"></div>
   </div>
 
 <script>
   let salesChart = null;
   let currentPeriod = 'day';
+  let ordersCursor = {{ next_cursor|tojson }};
+  let ordersFilter = { start: '', end: '' };
+  let ordersLoading = false;
 
   async function fetchSalesAndRender(period, start, end){
     const params = new URLSearchParams();
@@ -1216,6 +3065,8 @@ _templates["dashboard_admin.html"] = r"""
     const data = await resp.json();
     const labels = data.labels || [];
     const values = data.values || [];
+    const counts = data.counts || [];
+    const avgBasket = data.avg_basket || [];
     const ctx = document.getElementById('salesChart').getContext('2d');
     if(salesChart) salesChart.destroy();
     salesChart = new Chart(ctx, {
@@ -1239,7 +3090,14 @@ _templates["dashboard_admin.html"] = r"""
           x: { display: true },
           y: { display: true, title: { display: true, text: '₹' } }
         },
-        plugins: { legend: { display: false } }
+        plugins: {
+          legend: { display: false },
+          tooltip: {
+            callbacks: {
+              afterLabel: (item) => `Orders: ${counts[item.dataIndex] ?? 0} · Avg basket: ₹${(avgBasket[item.dataIndex] ?? 0).toFixed(2)}`
+            }
+          }
+        }
       }
     });
   }
@@ -1252,27 +3110,198 @@ _templates["dashboard_admin.html"] = r"""
     if(!resp.ok) return;
     const html = await resp.text();
     document.getElementById('orders-wrapper').innerHTML = html;
+    ordersFilter = { start, end };
+    ordersCursor = resp.headers.get('X-Next-Cursor') || null;
+  }
+
+  // Day groups are oldest-first; a page that continues the last visible day
+  // holds that day's older orders, so its rows go above the existing ones.
+  function appendOrderGroups(html){
+    const wrapper = document.getElementById('orders-wrapper');
+    const temp = document.createElement('div');
+    temp.innerHTML = html;
+    temp.querySelectorAll('.day-group').forEach(group => {
+      const groups = wrapper.querySelectorAll('.day-group');
+      const last = groups[groups.length - 1];
+      if(last && last.dataset.day === group.dataset.day){
+        last.querySelector('.day-rows').prepend(...group.querySelectorAll('.day-rows > tr'));
+      } else {
+        wrapper.appendChild(group);
+      }
+    });
+  }
+
+  const STATUS_BADGES = {
+    'Pending': 'bg-yellow-100 text-yellow-800',
+    'Confirmed': 'bg-blue-100 text-blue-800',
+    'Out for Delivery': 'bg-purple-100 text-purple-800',
+    'Delivered': 'bg-green-100 text-green-800'
+  };
+
+  // Bulk status change for the ticked orders, or for every order of one status
+  // in the current date filter; rows already on the page are updated in place.
+  async function applyBulkStatus(){
+    const from = document.getElementById('bulk-from').value;
+    const status = document.getElementById('bulk-to').value;
+    const result = document.getElementById('bulk-result');
+    const body = { status };
+    if(from){
+      body.filter = { status: from, start: ordersFilter.start, end: ordersFilter.end };
+      const range = ordersFilter.start || ordersFilter.end ? `${ordersFilter.start || '…'} to ${ordersFilter.end || '…'}` : 'all dates';
+      if(!confirm(`Mark every ${from} order (${range}) as ${status}?`)) return;
+    } else {
+      body.ids = [...document.querySelectorAll('.order-select:checked')].map(c => Number(c.value));
+      if(!body.ids.length){ result.textContent = 'Tick some orders first.'; return; }
+    }
+    const resp = await fetch('{{ url_for("admin_bulk_update_orders") }}', {
+      method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body)
+    });
+    const data = await resp.json();
+    if(data.error){ result.textContent = data.error; return; }
+    data.updated.forEach(id => {
+      const row = document.querySelector(`tr[data-order-id="${id}"]`);
+      if(!row) return;
+      const badge = row.querySelector('.order-status');
+      badge.textContent = status;
+      if(badge.classList.contains('badge')) badge.className = `order-status badge ${STATUS_BADGES[status] || 'bg-gray-100 text-gray-700'}`;
+      const select = row.querySelector('select[name="status"]');
+      if(select) select.value = status;
+      const box = row.querySelector('.order-select');
+      if(box) box.checked = false;
+    });
+    result.textContent = `${data.updated.length} updated` + (data.skipped_total ? `, ${data.skipped_total} skipped` : '');
+    result.title = Object.entries(data.skipped_by_reason).map(([why, n]) => `${n} × ${why}`).join('\n');
+  }
+
+  // Streams every order in the current filter; each complete day group is
+  // appended as soon as its boundary marker arrives.
+  async function streamAllOrders(){
+    if(ordersLoading) return;
+    ordersLoading = true;
+    const boundary = '<!--/day-group-->';
+    const wrapper = document.getElementById('orders-wrapper');
+    const params = new URLSearchParams({ stream: '1' });
+    if(ordersFilter.start) params.set('start', ordersFilter.start);
+    if(ordersFilter.end) params.set('end', ordersFilter.end);
+    try{
+      const resp = await fetch('{{ url_for("admin_orders_fragment") }}?' + params.toString());
+      if(!resp.ok) return;
+      wrapper.innerHTML = '';
+      ordersCursor = null;
+      let buffered = '';
+      const flush = () => {
+        const parts = buffered.split(boundary);
+        buffered = parts.pop();
+        parts.forEach(appendOrderGroups);
+      };
+      if(resp.body && resp.body.getReader){
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        for(;;){
+          const { done, value } = await reader.read();
+          if(done) break;
+          buffered += decoder.decode(value, { stream: true });
+          flush();
+        }
+        buffered += decoder.decode();
+      } else {
+        buffered = await resp.text();
+      }
+      buffered += boundary;
+      flush();
+      if(!wrapper.querySelector('.day-group')) wrapper.innerHTML = '<div>No orders yet.</div>';
+    } finally { ordersLoading = false; }
+  }
+
+  async function fetchAdminProducts(q, cursor){
+    const params = new URLSearchParams();
+    if(q) params.set('q', q);
+    if(cursor) params.set('cursor', cursor);
+    const resp = await fetch('{{ url_for("admin_products_fragment") }}?' + params.toString());
+    if(!resp.ok) return;
+    const body = document.getElementById('products-table-body');
+    const html = await resp.text();
+    if(cursor) body.insertAdjacentHTML('beforeend', html); else body.innerHTML = html;
+    const more = document.getElementById('load-more-admin-products');
+    more.dataset.nextCursor = resp.headers.get('X-Next-Cursor') || '';
+    more.classList.toggle('hidden', !more.dataset.nextCursor);
+  }
+
+  async function loadMoreOrders(){
+    if(!ordersCursor || ordersLoading) return;
+    ordersLoading = true;
+    const params = new URLSearchParams({ cursor: ordersCursor });
+    if(ordersFilter.start) params.set('start', ordersFilter.start);
+    if(ordersFilter.end) params.set('end', ordersFilter.end);
+    try{
+      const resp = await fetch('{{ url_for("admin_orders_fragment") }}?' + params.toString());
+      if(resp.ok){
+        appendOrderGroups(await resp.text());
+        ordersCursor = resp.headers.get('X-Next-Cursor') || null;
+      }
+    } finally { ordersLoading = false; }
   }
 
   async function fetchQuickStats(start, end){
     const params = new URLSearchParams();
     if(start) params.set('start', start);
     if(end) params.set('end', end);
-    const resp = await fetch(`{{ url_for('admin_dashboard') }}?${params.toString()}`, {
-      headers: { 'X-Partial': 'stats' }
-    });
+    const resp = await fetch(`{{ url_for('admin_stats') }}?${params.toString()}`);
     if(!resp.ok) return;
-    const html = await resp.text();
-    const temp = document.createElement('div');
-    temp.innerHTML = html;
-    const newStats = temp.querySelector('.space-y-3');
-    const oldStats = document.querySelector('#quick-stats-content');
-    if(newStats && oldStats) oldStats.innerHTML = newStats.innerHTML;
+    const stats = await resp.json();
+    document.getElementById('stat-users').textContent = stats.users;
+    document.getElementById('stat-orders').textContent = stats.orders;
+    document.getElementById('stat-revenue').textContent = '₹' + Number(stats.revenue).toFixed(2);
   }
 
   document.addEventListener('DOMContentLoaded', ()=>{
     fetchSalesAndRender(currentPeriod, '', '');
 
+    const productSearch = document.getElementById('admin-product-search');
+    let productSearchTimer = null;
+    productSearch.addEventListener('input', ()=>{
+      clearTimeout(productSearchTimer);
+      productSearchTimer = setTimeout(()=> fetchAdminProducts(productSearch.value.trim(), ''), 250);
+    });
+    document.getElementById('load-more-admin-products').addEventListener('click', e=>{
+      fetchAdminProducts(productSearch.value.trim(), e.currentTarget.dataset.nextCursor);
+    });
+    document.getElementById('admin-product-import').addEventListener('change', async e=>{
+      const file = e.target.files[0];
+      if(!file) return;
+      const form = new FormData();
+      form.append('file', file);
+      const resp = await fetch('{{ url_for("admin_import_products") }}', { method: 'POST', body: form });
+      const report = await resp.json();
+      e.target.value = '';
+      if(report.error){ alert(report.error); return; }
+      const problems = report.errors.slice(0, 10).map(x => `Line ${x.line}: ${x.error}`).join('\n');
+      alert(`Imported: ${report.inserted} added, ${report.updated} updated` +
+            (report.errors.length ? `\n${report.errors.length} row(s) skipped:\n${problems}` : ''));
+      fetchAdminProducts(productSearch.value.trim(), '');
+    });
+
+    document.getElementById('orders-show-all').addEventListener('click', streamAllOrders);
+    document.getElementById('bulk-apply').addEventListener('click', applyBulkStatus);
+
+    document.querySelectorAll('.export-btn').forEach(b => {
+      b.addEventListener('click', ()=>{
+        const params = new URLSearchParams({ format: b.dataset.format });
+        const s = document.getElementById('filter-start').value;
+        const e = document.getElementById('filter-end').value;
+        if(s) params.set('start', s);
+        if(e) params.set('end', e);
+        window.location = '{{ url_for("admin_export_orders") }}?' + params.toString();
+      });
+    });
+
+    const sentinel = document.getElementById('orders-sentinel');
+    if(sentinel && 'IntersectionObserver' in window){
+      new IntersectionObserver(entries => {
+        if(entries.some(e => e.isIntersecting)) loadMoreOrders();
+      }, { rootMargin: '400px' }).observe(sentinel);
+    }
+
     document.querySelectorAll('.period-btn').forEach(b => {
       b.addEventListener('click', ()=>{
         document.querySelectorAll('.period-btn').forEach(x => {
@@ -1310,6 +3339,105 @@ _templates["dashboard_admin.html"] = r"""
 {% endblock %}
 """
 
+# One day of orders, oldest first and numbered from first_sno (admin dashboard, pages and streaming)
+_templates["admin_order_day_group.html"] = r"""
+<div class="day-group mb-4 sm:mb-6 border border-white/50 rounded-lg overflow-hidden" data-day="{{ day }}">
+  <div class="bg-emerald-50/80 px-4 py-2 text-sm font-semibold text-emerald-800 border-b border-emerald-100">
+    {{ day }} — {{ total }} order{{ 's' if total > 1 else '' }}
+  </div>
+  <div class="overflow-x-auto -mx-2 sm:mx-0">
+    <table class="w-full text-left text-sm border-collapse min-w-[720px] sm:min-w-0">
+      <thead class="bg-emerald-100 text-emerald-900">
+        <tr>
+          <th class="py-2 px-3 font-semibold text-center">S.No</th>
+          <th class="py-2 px-4 font-semibold text-left">Order</th>
+          <th class="py-2 px-4 font-semibold text-left">User</th>
+          <th class="py-2 px-4 font-semibold text-left">Items</th>
+          <th class="py-2 px-4 font-semibold text-right">Total</th>
+          <th class="py-2 px-4 font-semibold text-left">Status</th>
+          <th class="py-2 px-4 font-semibold text-center">Action</th>
+        </tr>
+      </thead>
+      <tbody class="day-rows bg-white/50">
+        {% for o in orders %}
+          <tr class="border-t hover:bg-white/70 transition" data-order-id="{{ o.id }}">
+            <td class="py-2 px-3 align-top text-center">
+              <div class="font-semibold text-emerald-700">{{ first_sno + loop.index0 }}</div>
+            </td>
+            <td class="py-2 px-4 align-top">
+              <label class="flex items-center gap-2 font-medium text-gray-800">
+                <input type="checkbox" class="order-select" value="{{ o.id }}">#{{ o.id }}
+              </label>
+              <div class="text-xs text-gray-500">{{ o.created_at }}</div>
+            </td>
+            <td class="py-2 px-4 align-top">
+              {{ o.username or ('User ' + (o.user_id|string)) }}
+            </td>
+            <td class="py-2 px-4 align-top text-gray-700">
+              {{ o.items_summary }}
+            </td>
+            <td class="py-2 px-4 align-top text-right font-semibold text-gray-800">
+              ₹{{ '%.2f'|format(o.total) }}
+            </td>
+            <td class="py-2 px-4 align-top">
+              <span class="order-status badge
+                {% if o.status == 'Pending' %} bg-yellow-100 text-yellow-800
+                {% elif o.status == 'Confirmed' %} bg-blue-100 text-blue-800
+                {% elif o.status == 'Out for Delivery' %} bg-purple-100 text-purple-800
+                {% elif o.status == 'Delivered' %} bg-green-100 text-green-800
+                {% else %} bg-gray-100 text-gray-700{% endif %}
+              ">{{ o.status }}</span>
+            </td>
+            <td class="py-2 px-4 text-center">
+              <div class="flex items-center justify-center gap-2">
+                <a href="{{ url_for('view_order', order_id=o.id) }}" class="text-sm text-emerald-700 hover:underline">View</a>
+                <form method="post" action="{{ url_for('admin_update_order', order_id=o.id) }}" class="flex items-center gap-2">
+                  <select name="status" class="border rounded px-2 py-1 text-sm focus:ring-emerald-400 focus:border-emerald-400">
+                    <option {{ 'selected' if o.status=='Pending' else '' }}>Pending</option>
+                    <option {{ 'selected' if o.status=='Confirmed' else '' }}>Confirmed</option>
+                    <option {{ 'selected' if o.status=='Out for Delivery' else '' }}>Out for Delivery</option>
+                    <option {{ 'selected' if o.status=='Delivered' else '' }}>Delivered</option>
+                  </select>
+                  <button class="btn-emerald text-white px-2 py-1 rounded text-sm">Update</button>
+                </form>
+                <form method="post" action="{{ url_for('delete_order', order_id=o.id) }}" onsubmit="return confirm('Delete order #{{ o.id }}?');">
+                  <button class="text-red-600 text-sm hover:underline">Delete</button>
+                </form>
+              </div>
+            </td>
+          </tr>
+        {% endfor %}
+      </tbody>
+    </table>
+  </div>
+</div>
+"""
+
+# Product table rows for one catalogue page (admin dashboard + load more/search)
+_templates["admin_product_rows.html"] = r"""
+            {% for p in products %}
+              <tr class="border-t hover:bg-white/70">
+                <td class="py-3 px-4"><img src="{{ p.image or 'https://via.placeholder.com/100x100?text=No' }}" class="w-12 h-12 rounded-full object-cover"></td>
+                <td class="py-3 px-4 font-medium">{{ p.name }}</td>
+                <td class="py-3 px-4 small-muted">{{ p.description }}</td>
+                <td class="py-3 px-4">₹{{ '%.2f'|format(p.price) }}</td>
+                <td class="py-3 px-4">
+                  {% if p.stock == 0 %}
+                    <span class="badge bg-red-100 text-red-700">Out of Stock</span>
+                  {% else %}
+                    {{ p.stock }}
+                  {% endif %}
+                </td>
+                <td class="py-3 px-4">
+                  <a href="{{ url_for('admin_edit_product', product_id=p.id) }}" class="text-sm underline mr-3">Edit</a>
+                  <form method="post" action="{{ url_for('admin_delete_product', product_id=p.id) }}" style="display:inline;" onsubmit="return confirm('Delete product {{ p.name }}?');">
+                    <button class="text-red-600 text-sm">Delete</button>
+                  </form>
+                </td>
+              </tr>
+            {% endfor %}
+"""
+
 _templates["order_detail.html"] = r"""
 {% extends 'base.html' %}
 {% block content %}
@@ -1366,23 +3494,297 @@ _templates["order_detail.html"] = r"""
 {% endblock %}
 """
 
+# ---------------- Password Reset (OTP) ----------------
+_templates["forgot_password.html"] = r"""
+{% extends 'base.html' %}{% block content %}
+<div class="max-w-md mx-auto glass p-6 rounded shadow-lg">
+  <h2 class="text-2xl font-bold text-emerald-700 mb-4 text-center">Forgot Password 🔑</h2>
+  <p class="text-sm text-gray-600 text-center mb-6">Enter your registered email or username to receive an OTP</p>
+  <form method="post" class="space-y-4">
+    <div>
+      <label class="block text-sm font-medium mb-1">Email or Username</label>
+      <input name="identifier" required class="w-full border border-gray-300 rounded p-2 focus:ring-2 focus:ring-emerald-400">
+    </div>
+    <button class="w-full btn-emerald py-2.5 rounded-lg font-semibold shadow">Send OTP</button>
+  </form>
+  <div class="text-center text-sm mt-4"><a href="{{ url_for('login') }}" class="text-gray-600 hover:underline">← Back to Login</a></div>
+</div>
+{% endblock %}
+"""
+
+_templates["verify_otp.html"] = r"""
+{% extends 'base.html' %}{% block content %}
+<div class="max-w-md mx-auto glass p-6 rounded shadow-lg">
+  <h2 class="text-2xl font-bold text-emerald-700 mb-4 text-center">Verify OTP</h2>
+  <p class="text-sm text-gray-600 text-center mb-6">Enter the 6-digit OTP sent to your email</p>
+  <form method="post" class="space-y-4">
+    <input name="otp" maxlength="6" class="w-full border border-gray-300 p-2 rounded text-center tracking-widest text-lg focus:ring-2 focus:ring-emerald-400" required>
+    <button class="w-full btn-emerald py-2.5 rounded-lg font-semibold shadow">Verify OTP</button>
+  </form>
+</div>
+{% endblock %}
+"""
+
+_templates["reset_with_otp.html"] = r"""
+{% extends 'base.html' %}{% block content %}
+<div class="max-w-md mx-auto glass p-6 rounded shadow-lg">
+  <h2 class="text-2xl font-bold text-emerald-700 mb-4 text-center">Set New Password</h2>
+  <p class="text-sm text-gray-600 text-center mb-6">Choose a strong password for your account</p>
+  <form method="post" class="space-y-4">
+    <div>
+      <label class="block text-sm mb-1 font-medium">New Password</label>
+      <input id="password" name="password" type="password" required class="w-full border border-gray-300 p-2 rounded focus:ring-2 focus:ring-emerald-400">
+      <div id="password-strength" class="mt-1 h-2 bg-gray-200 rounded overflow-hidden">
+        <div id="strength-bar" class="h-2 bg-red-400 w-0 transition-all duration-300"></div>
+      </div>
+      <p id="strength-text" class="text-xs text-gray-500 mt-1">Enter a strong password</p>
+      
+      <!-- Password Requirements Checklist -->
+      <div class="mt-2 text-xs space-y-1">
+        <div id="req-length" class="flex items-center gap-1 text-gray-500">
+          <span class="req-icon">○</span> At least 8 characters
+        </div>
+        <div id="req-upper" class="flex items-center gap-1 text-gray-500">
+          <span class="req-icon">○</span> One uppercase letter
+        </div>
+        <div id="req-lower" class="flex items-center gap-1 text-gray-500">
+          <span class="req-icon">○</span> One lowercase letter
+        </div>
+        <div id="req-number" class="flex items-center gap-1 text-gray-500">
+          <span class="req-icon">○</span> One number
+        </div>
+        <div id="req-special" class="flex items-center gap-1 text-gray-500">
+          <span class="req-icon">○</span> One special character
+        </div>
+      </div>
+    </div>
+    <div>
+      <label class="block text-sm mb-1 font-medium">Confirm Password</label>
+      <input name="confirm" type="password" required class="w-full border border-gray-300 p-2 rounded focus:ring-2 focus:ring-emerald-400">
+    </div>
+    <button class="w-full btn-emerald py-2.5 rounded-lg font-semibold shadow">Reset Password</button>
+  </form>
+  
+  <script>
+    const passwordInput = document.getElementById('password');
+    const strengthBar = document.getElementById('strength-bar');
+    const strengthText = document.getElementById('strength-text');
+    
+    const reqLength = document.getElementById('req-length');
+    const reqUpper = document.getElementById('req-upper');
+    const reqLower = document.getElementById('req-lower');
+    const reqNumber = document.getElementById('req-number');
+    const reqSpecial = document.getElementById('req-special');
+
+    function updateRequirement(element, met) {
+      const icon = element.querySelector('.req-icon');
+      if (met) {
+        element.className = 'flex items-center gap-1 text-green-600';
+        icon.textContent = '✓';
+      } else {
+        element.className = 'flex items-center gap-1 text-gray-500';
+        icon.textContent = '○';
+      }
+    }
+
+    passwordInput.addEventListener('input', () => {
+      const val = passwordInput.value;
+      let strength = 0;
+      
+      const hasLength = val.length >= 8;
+      const hasUpper = /[A-Z]/.test(val);
+      const hasLower = /[a-z]/.test(val);
+      const hasNumber = /[0-9]/.test(val);
+      const hasSpecial = /[^A-Za-z0-9]/.test(val);
+      
+      updateRequirement(reqLength, hasLength);
+      updateRequirement(reqUpper, hasUpper);
+      updateRequirement(reqLower, hasLower);
+      updateRequirement(reqNumber, hasNumber);
+      updateRequirement(reqSpecial, hasSpecial);
+      
+      if (hasLength) strength++;
+      if (hasUpper) strength++;
+      if (hasLower) strength++;
+      if (hasNumber) strength++;
+      if (hasSpecial) strength++;
+
+      const percent = (strength / 5) * 100;
+      strengthBar.style.width = percent + '%';
+
+      if (strength <= 2) {
+        strengthBar.className = 'h-2 bg-red-400 transition-all duration-300';
+        strengthText.textContent = 'Weak password';
+        strengthText.className = 'text-xs text-red-500 mt-1';
+      } else if (strength === 3 || strength === 4) {
+        strengthBar.className = 'h-2 bg-yellow-400 transition-all duration-300';
+        strengthText.textContent = 'Medium strength';
+        strengthText.className = 'text-xs text-yellow-500 mt-1';
+      } else {
+        strengthBar.className = 'h-2 bg-green-500 transition-all duration-300';
+        strengthText.textContent = 'Strong password ✓';
+        strengthText.className = 'text-xs text-green-600 mt-1';
+      }
+    });
+  </script>
+</div>
+{% endblock %}
+"""
+
+# ---------------- Admin: Quick Stats Partial / Product Forms ----------------
+_templates["admin_quick_stats.html"] = r"""
+<div class="space-y-3">
+  <div>Total users: <strong>{{ stats.users }}</strong></div>
+  <div>Total orders: <strong>{{ stats.orders }}</strong></div>
+  <div>Revenue: <strong>₹{{ '%.2f'|format(stats.revenue) }}</strong></div>
+</div>
+"""
+
+_templates["admin_product_add.html"] = r"""
+<!doctype html><html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><script src="https://cdn.tailwindcss.com"></script></head>
+<body class="min-h-screen flex items-center justify-center p-4" style="background:linear-gradient(180deg,#f8fafc,#fff)">
+  <div class="bg-white/75 backdrop-blur p-6 rounded-xl shadow w-full max-w-md">
+    <h2 class="text-2xl font-bold text-emerald-700 mb-5 text-center">Add Product</h2>
+    <form method="post" enctype="multipart/form-data" class="space-y-4">
+      <div><label class="block text-sm mb-1">Name</label><input name="name" required class="w-full border rounded px-3 py-2"></div>
+      <div><label class="block text-sm mb-1">Description</label><textarea name="description" rows="3" class="w-full border rounded px-3 py-2"></textarea></div>
+      <div><label class="block text-sm mb-1">Price (₹)</label><input name="price" type="number" step="0.01" required class="w-full border rounded px-3 py-2"></div>
+      <div><label class="block text-sm mb-1">Stock</label><input name="stock" type="number" value="0" class="w-full border rounded px-3 py-2"></div>
+      <div><label class="block text-sm mb-1">Image Upload (optional)</label><input type="file" name="image_file" accept="image/*" class="w-full text-sm"></div>
+      <div><label class="block text-sm mb-1">or Image URL</label><input name="image_url" placeholder="https://..." class="w-full border rounded px-3 py-2"></div>
+      <button class="w-full bg-emerald-600 text-white rounded py-2">Add Product</button>
+      <div class="text-center mt-3"><a href="{{ url_for('admin_dashboard') }}" class="text-emerald-700 text-sm underline">← Back</a></div>
+    </form>
+  </div>
+</body></html>
+"""
+
+_templates["admin_product_edit.html"] = r"""
+<!doctype html><html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><script src="https://cdn.tailwindcss.com"></script></head>
+<body class="min-h-screen flex items-center justify-center p-4" style="background:linear-gradient(180deg,#f8fafc,#fff)">
+  <div class="bg-white/75 backdrop-blur p-6 rounded-xl shadow w-full max-w-md">
+    <h2 class="text-2xl font-bold text-emerald-700 mb-5 text-center">Edit Product</h2>
+    <form method="post" enctype="multipart/form-data" class="space-y-4">
+      <div><label class="block text-sm mb-1">Name</label>
+        <input name="name" value="{{ p.name }}" required class="w-full border rounded px-3 py-2">
+      </div>
+      <div><label class="block text-sm mb-1">Description</label>
+        <textarea name="description" rows="3" class="w-full border rounded px-3 py-2">{{ p.description or '' }}</textarea>
+      </div>
+      <div><label class="block text-sm mb-1">Price (₹)</label>
+        <input name="price" type="number" step="0.01" value="{{ p.price }}" required class="w-full border rounded px-3 py-2">
+      </div>
+      <div><label class="block text-sm mb-1">Change Image (Upload)</label>
+        <input type="file" name="image_file" accept="image/*" class="w-full text-sm">
+      </div>
+      <div><label class="block text-sm mb-1">or Image URL</label>
+        <input name="image_url" value="{{ p.image or '' }}" class="w-full border rounded px-3 py-2">
+      </div>
+      <div><label class="block text-sm mb-1">Stock</label>
+        <input name="stock" type="number" value="{{ p.stock }}" class="w-full border rounded px-3 py-2">
+      </div>
+      <button class="w-full bg-emerald-600 text-white rounded py-2">Update Product</button>
+      <div class="text-center mt-3"><a href="{{ url_for('admin_dashboard') }}" class="text-emerald-700 text-sm underline">← Back</a></div>
+    </form>
+  </div>
+</body></html>
+"""
+
 try:
     _templates  # noqa: F401
     app.jinja_loader = DictLoader(_templates)
 except NameError:
     pass
 
+# Jinja compiles each registry template once per process; JINJA_BYTECODE_CACHE_DIR
+# also persists the compiled bytecode so new workers/cold starts skip compilation.
+if os.environ.get("JINJA_BYTECODE_CACHE_DIR"):
+    os.makedirs(os.environ["JINJA_BYTECODE_CACHE_DIR"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ["JINJA_BYTECODE_CACHE_DIR"])
+
 # ---------- STATIC/UPLOADS ----------
+UPLOAD_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+_upload_etags = OrderedDict()  # (path, mtime_ns, size) -> content hash
+_upload_etags_lock = threading.Lock()
+
+def upload_etag(path, st):
+    """Strong ETag from the file content, hashed once per (path, mtime, size)."""
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _upload_etags_lock:
+        if key in _upload_etags:
+            _upload_etags.move_to_end(key)
+            return _upload_etags[key]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()[:32]
+    with _upload_etags_lock:
+        _upload_etags[key] = etag
+        while len(_upload_etags) > 4096:
+            _upload_etags.popitem(last=False)
+    return etag
+
+@app.template_global()
+def upload_url(filename):
+    """Stable URL for an upload: the bucket's public URL when there is one, else /uploads/."""
+    return get_upload_storage().public_url(filename) or url_for('uploaded_file', filename=filename)
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_DIR'], filename)
+    storage = get_upload_storage()
+    remote = storage.url(filename)
+    if remote:
+        # Object storage: send the client to the bucket so the bytes bypass the app
+        resp = redirect(remote)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = UPLOAD_STORAGE_CONFIG['url_expiry'] // 4
+        return resp
+    path = storage.path(filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    if UPLOADS_CONFIG['accel'] == 'nginx':
+        # nginx serves the bytes (Range, sendfile, gzip_static); we only answer
+        # revalidations and pass the caching headers it keeps from upstream.
+        st = os.stat(path)
+        resp = make_response('')
+        resp.set_etag(upload_etag(path, st))
+        resp.last_modified = datetime.fromtimestamp(st.st_mtime, timezone.utc)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = UPLOADS_CONFIG['max_age']
+        resp.cache_control.immutable = True
+        resp = resp.make_conditional(request)
+        if resp.status_code == 200:
+            resp.headers['X-Accel-Redirect'] = UPLOADS_CONFIG['accel_prefix'] + quote(filename)
+            resp.mimetype = mimetype
+        return resp
+
+    encoding = None
+    if UPLOADS_CONFIG['precompressed']:
+        for enc, ext in UPLOAD_ENCODINGS:
+            if request.accept_encodings[enc] and os.path.isfile(path + ext):
+                path, encoding = path + ext, enc
+                break
+    st = os.stat(path)
+    # conditional=True gives If-None-Match / If-Modified-Since / Range handling;
+    # USE_X_SENDFILE (UPLOADS_ACCEL=sendfile) swaps the body for an X-Sendfile header.
+    resp = send_file(path, mimetype=mimetype, etag=upload_etag(path, st),
+                     last_modified=st.st_mtime, max_age=UPLOADS_CONFIG['max_age'], conditional=True)
+    resp.cache_control.immutable = True
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    if UPLOADS_CONFIG['precompressed']:
+        resp.vary.add('Accept-Encoding')
+    return resp
 
 # ---------- PRODUCT ----------
 @app.route('/product/<int:product_id>')
 def product_detail(product_id):
     conn = get_conn()
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM products WHERE id=%s;", (product_id,))
+        cur.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id=%s;", (product_id,))
         product = cur.fetchone()
     if not product:
         flash('Product not found', 'error')
@@ -1416,6 +3818,7 @@ def register():
                     (username, generate_password_hash(password), email, address, phone)
                 )
             conn.commit()
+            invalidate_admin_stats()
             flash('Registration successful. Please log in.', 'success')
             return redirect(url_for('login'))
         except psycopg2.Error as e:
@@ -1438,8 +3841,10 @@ def login():
             cur.execute("SELECT * FROM users WHERE username=%s OR email=%s", (identifier, identifier))
             user = cur.fetchone()
         if user and check_password_hash(user['password'], password):
+            invalidate_user_cache(user['id'])
             session['user_id'] = user['id']
             session['username'] = user['username']
+            merge_session_cart(user['id'])
             flash('Logged in successfully', 'success')
             return redirect(request.args.get('next') or url_for('index'))
         flash('Invalid credentials', 'error')
@@ -1448,6 +3853,7 @@ def login():
 
 @app.route('/logout')
 def logout():
+    invalidate_user_cache(session.get('user_id'))
     session.clear()
     flash('Logged out', 'info')
     return redirect(url_for('index'))
@@ -1462,22 +3868,27 @@ def profile():
             flash('No file uploaded', 'error'); return redirect(url_for('profile'))
         file = request.files['avatar']
         if file and allowed_file(file.filename):
-            filename = secure_filename(f"user_{session['user_id']}_{int(datetime.utcnow().timestamp())}_{file.filename}")
-            path = os.path.join(app.config['UPLOAD_DIR'], filename)
-            file.save(path)
+            filename = store_upload(file)
             with conn.cursor() as cur:
-                cur.execute("UPDATE users SET avatar=%s WHERE id=%s", (filename, session['user_id']))
+                # Lock the row so a concurrent change cannot release the same old avatar twice
+                cur.execute("SELECT avatar FROM users WHERE id=%s FOR UPDATE", (session['user_id'],))
+                old = cur.fetchone()
+                if old:
+                    cur.execute("UPDATE users SET avatar=%s, avatar_variants=NULL WHERE id=%s",
+                                (filename, session['user_id']))
+                    replace_upload_ref(cur, old[0], filename)
             conn.commit()
+            invalidate_user_cache(session['user_id'])
+            schedule_image_variants('avatar', session['user_id'], filename, filename)
             flash('Avatar uploaded', 'success')
             return redirect(url_for('profile'))
         flash('Invalid file', 'error')
 
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT id, username, full_name, avatar FROM users WHERE id=%s", (session['user_id'],))
-        user = cur.fetchone()
+    user = get_current_user()
     class U: pass
     u = U()
     u.id = user['id']; u.username = user['username']; u.full_name = user.get('full_name'); u.avatar = user.get('avatar')
+    u.avatar_variants = user.get('avatar_variants')
     u.initial = (u.username[0].upper() if u.username else '?')
     return render_template('profile.html', user=u)
 
@@ -1485,15 +3896,15 @@ def profile():
 @login_required
 def profile_remove():
     conn = get_conn()
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT avatar FROM users WHERE id=%s", (session['user_id'],))
-        user = cur.fetchone()
-    if user and user.get('avatar'):
-        try: os.remove(os.path.join(app.config['UPLOAD_DIR'], user['avatar']))
-        except (OSError, FileNotFoundError): pass
+    # The file itself is reclaimed by the upload sweeper once nothing references it
     with conn.cursor() as cur:
-        cur.execute("UPDATE users SET avatar=NULL WHERE id=%s", (session['user_id'],))
+        cur.execute("SELECT avatar FROM users WHERE id=%s FOR UPDATE", (session['user_id'],))
+        old = cur.fetchone()
+        if old:
+            cur.execute("UPDATE users SET avatar=NULL, avatar_variants=NULL WHERE id=%s", (session['user_id'],))
+            upload_ref(cur, old[0], -1)
     conn.commit()
+    invalidate_user_cache(session['user_id'])
     flash('Avatar removed', 'success')
     return redirect(url_for('profile'))
 
@@ -1528,22 +3939,7 @@ def forgot_password():
         flash('Failed to send OTP. Please try again later.', 'error')
         return redirect(url_for('forgot_password'))
 
-    return render_template_string("""
-    {% extends 'base.html' %}{% block content %}
-    <div class="max-w-md mx-auto glass p-6 rounded shadow-lg">
-      <h2 class="text-2xl font-bold text-emerald-700 mb-4 text-center">Forgot Password 🔑</h2>
-      <p class="text-sm text-gray-600 text-center mb-6">Enter your registered email or username to receive an OTP</p>
-      <form method="post" class="space-y-4">
-        <div>
-          <label class="block text-sm font-medium mb-1">Email or Username</label>
-          <input name="identifier" required class="w-full border border-gray-300 rounded p-2 focus:ring-2 focus:ring-emerald-400">
-        </div>
-        <button class="w-full btn-emerald py-2.5 rounded-lg font-semibold shadow">Send OTP</button>
-      </form>
-      <div class="text-center text-sm mt-4"><a href="{{ url_for('login') }}" class="text-gray-600 hover:underline">← Back to Login</a></div>
-    </div>
-    {% endblock %}
-    """)
+    return render_template('forgot_password.html')
 
 @app.route('/verify_otp', methods=['GET', 'POST'])
 def verify_otp():
@@ -1570,18 +3966,7 @@ def verify_otp():
         flash('OTP verified! You can now reset your password.', 'success')
         return redirect(url_for('reset_with_otp'))
 
-    return render_template_string("""
-    {% extends 'base.html' %}{% block content %}
-    <div class="max-w-md mx-auto glass p-6 rounded shadow-lg">
-      <h2 class="text-2xl font-bold text-emerald-700 mb-4 text-center">Verify OTP</h2>
-      <p class="text-sm text-gray-600 text-center mb-6">Enter the 6-digit OTP sent to your email</p>
-      <form method="post" class="space-y-4">
-        <input name="otp" maxlength="6" class="w-full border border-gray-300 p-2 rounded text-center tracking-widest text-lg focus:ring-2 focus:ring-emerald-400" required>
-        <button class="w-full btn-emerald py-2.5 rounded-lg font-semibold shadow">Verify OTP</button>
-      </form>
-    </div>
-    {% endblock %}
-    """)
+    return render_template('verify_otp.html')
 
 @app.route('/reset_with_otp', methods=['GET', 'POST'])
 def reset_with_otp():
@@ -1606,153 +3991,34 @@ def reset_with_otp():
             cur.execute("UPDATE users SET password=%s WHERE id=%s", (generate_password_hash(new_pass), uid))
             cur.execute("DELETE FROM reset_otps WHERE user_id=%s", (uid,))
         conn.commit()
+        invalidate_user_cache(uid)
         session.pop('reset_user', None); session.pop('otp_verified', None)
         flash('Password reset successful! You can now log in.', 'success')
         return redirect(url_for('login'))
 
-    return render_template_string("""
-    {% extends 'base.html' %}{% block content %}
-    <div class="max-w-md mx-auto glass p-6 rounded shadow-lg">
-      <h2 class="text-2xl font-bold text-emerald-700 mb-4 text-center">Set New Password</h2>
-      <p class="text-sm text-gray-600 text-center mb-6">Choose a strong password for your account</p>
-      <form method="post" class="space-y-4">
-        <div>
-          <label class="block text-sm mb-1 font-medium">New Password</label>
-          <input id="password" name="password" type="password" required class="w-full border border-gray-300 p-2 rounded focus:ring-2 focus:ring-emerald-400">
-          <div id="password-strength" class="mt-1 h-2 bg-gray-200 rounded overflow-hidden">
-            <div id="strength-bar" class="h-2 bg-red-400 w-0 transition-all duration-300"></div>
-          </div>
-          <p id="strength-text" class="text-xs text-gray-500 mt-1">Enter a strong password</p>
-          
-          <!-- Password Requirements Checklist -->
-          <div class="mt-2 text-xs space-y-1">
-            <div id="req-length" class="flex items-center gap-1 text-gray-500">
-              <span class="req-icon">○</span> At least 8 characters
-            </div>
-            <div id="req-upper" class="flex items-center gap-1 text-gray-500">
-              <span class="req-icon">○</span> One uppercase letter
-            </div>
-            <div id="req-lower" class="flex items-center gap-1 text-gray-500">
-              <span class="req-icon">○</span> One lowercase letter
-            </div>
-            <div id="req-number" class="flex items-center gap-1 text-gray-500">
-              <span class="req-icon">○</span> One number
-            </div>
-            <div id="req-special" class="flex items-center gap-1 text-gray-500">
-              <span class="req-icon">○</span> One special character
-            </div>
-          </div>
-        </div>
-        <div>
-          <label class="block text-sm mb-1 font-medium">Confirm Password</label>
-          <input name="confirm" type="password" required class="w-full border border-gray-300 p-2 rounded focus:ring-2 focus:ring-emerald-400">
-        </div>
-        <button class="w-full btn-emerald py-2.5 rounded-lg font-semibold shadow">Reset Password</button>
-      </form>
-      
-      <script>
-        const passwordInput = document.getElementById('password');
-        const strengthBar = document.getElementById('strength-bar');
-        const strengthText = document.getElementById('strength-text');
-        
-        const reqLength = document.getElementById('req-length');
-        const reqUpper = document.getElementById('req-upper');
-        const reqLower = document.getElementById('req-lower');
-        const reqNumber = document.getElementById('req-number');
-        const reqSpecial = document.getElementById('req-special');
-
-        function updateRequirement(element, met) {
-          const icon = element.querySelector('.req-icon');
-          if (met) {
-            element.className = 'flex items-center gap-1 text-green-600';
-            icon.textContent = '✓';
-          } else {
-            element.className = 'flex items-center gap-1 text-gray-500';
-            icon.textContent = '○';
-          }
-        }
-
-        passwordInput.addEventListener('input', () => {
-          const val = passwordInput.value;
-          let strength = 0;
-          
-          const hasLength = val.length >= 8;
-          const hasUpper = /[A-Z]/.test(val);
-          const hasLower = /[a-z]/.test(val);
-          const hasNumber = /[0-9]/.test(val);
-          const hasSpecial = /[^A-Za-z0-9]/.test(val);
-          
-          updateRequirement(reqLength, hasLength);
-          updateRequirement(reqUpper, hasUpper);
-          updateRequirement(reqLower, hasLower);
-          updateRequirement(reqNumber, hasNumber);
-          updateRequirement(reqSpecial, hasSpecial);
-          
-          if (hasLength) strength++;
-          if (hasUpper) strength++;
-          if (hasLower) strength++;
-          if (hasNumber) strength++;
-          if (hasSpecial) strength++;
-
-          const percent = (strength / 5) * 100;
-          strengthBar.style.width = percent + '%';
-
-          if (strength <= 2) {
-            strengthBar.className = 'h-2 bg-red-400 transition-all duration-300';
-            strengthText.textContent = 'Weak password';
-            strengthText.className = 'text-xs text-red-500 mt-1';
-          } else if (strength === 3 || strength === 4) {
-            strengthBar.className = 'h-2 bg-yellow-400 transition-all duration-300';
-            strengthText.textContent = 'Medium strength';
-            strengthText.className = 'text-xs text-yellow-500 mt-1';
-          } else {
-            strengthBar.className = 'h-2 bg-green-500 transition-all duration-300';
-            strengthText.textContent = 'Strong password ✓';
-            strengthText.className = 'text-xs text-green-600 mt-1';
-          }
-        });
-      </script>
-    </div>
-    {% endblock %}
-    """)
+    return render_template('reset_with_otp.html')
 
 # ---------- CART ----------
 @app.route('/cart')
 def cart():
-    cart = session.get('cart', {})
+    cart = get_cart(fresh=True)
     if not cart:
         return render_template('cart.html', items=[], total=0.0)
 
-    conn = get_conn()
-    items, total = [], 0.0
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        for pid_str, qty in cart.items():
-            try: pid = int(pid_str)
-            except ValueError: continue
-            cur.execute("SELECT * FROM products WHERE id=%s", (pid,))
-            p = cur.fetchone()
-            if p:
-                subtotal = float(p['price']) * int(qty)
-                items.append({'product': p, 'qty': qty, 'subtotal': subtotal})
-                total += subtotal
-    return render_template('cart.html', items=items, total=total)
+    priced = price_cart(cart)
+    return render_template('cart.html', items=priced['items'], total=priced['total'])
 
 @app.route('/cart/add/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
     try: qty = max(1, int(request.form.get('qty', 1)))
     except (ValueError, TypeError): qty = 1
-    conn = get_conn()
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM products WHERE id=%s", (product_id,))
-        p = cur.fetchone()
+    p = load_products([product_id]).get(product_id)
     if not p:
         flash('Product not found', 'error'); return redirect(url_for('index'))
     if int(p['stock']) < qty:
         flash(f"Not enough stock. Only {p['stock']} left.", 'error')
         return redirect(url_for('product_detail', product_id=product_id))
-    cart = session.get('cart', {})
-    cart[str(product_id)] = cart.get(str(product_id), 0) + qty
-    session['cart'] = cart
+    cart_add(product_id, qty)
     flash('Added to cart', 'success')
     return redirect(url_for('cart'))
 
@@ -1762,25 +4028,18 @@ def api_cart_add():
     qty        = request.form.get('qty', type=int)
     if not product_id or not qty:
         return jsonify({'error': 'Invalid input'}), 400
-    conn = get_conn()
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM products WHERE id=%s", (product_id,))
-        product = cur.fetchone()
+    product = load_products([product_id]).get(product_id)
     if not product:
         return jsonify({'error': 'Product not found'}), 404
     if int(product['stock']) < int(qty):
         return jsonify({'error': 'Not enough stock'}), 400
-    cart = session.get('cart', {})
-    cart[str(product_id)] = cart.get(str(product_id), 0) + qty
-    session['cart'] = cart
+    cart = cart_add(product_id, qty)
     total_items = sum(cart.values())
     return jsonify({'success': True, 'product_name': product['name'], 'total_items': total_items})
 
 @app.route('/cart/remove/<int:product_id>', methods=['POST'])
 def remove_from_cart(product_id):
-    cart = session.get('cart', {})
-    cart.pop(str(product_id), None)
-    session['cart'] = cart
+    cart_remove(product_id)
     flash('Removed from cart', 'info')
     return redirect(url_for('cart'))
 
@@ -1788,25 +4047,17 @@ def remove_from_cart(product_id):
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
-    cart = session.get('cart', {})
+    cart = get_cart(fresh=True)
     if not cart:
         flash('Cart is empty', 'error'); return redirect(url_for('index'))
 
     conn = get_conn()
-    items, total = [], 0.0
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        for pid_str, qty in cart.items():
-            try: pid = int(pid_str)
-            except ValueError: continue
-            cur.execute("SELECT * FROM products WHERE id=%s", (pid,))
-            p = cur.fetchone()
-            if not p: continue
-            if int(p['stock']) < int(qty):
-                flash(f"Not enough stock for {p['name']}. Only {p['stock']} left.", 'error')
-                return redirect(url_for('cart'))
-            subtotal = float(p['price']) * int(qty)
-            items.append({'product': dict(p), 'qty': int(qty), 'subtotal': subtotal})
-            total += subtotal
+    priced = price_cart(cart)
+    if priced['short']:
+        p = priced['short'][0]['product']
+        flash(f"Not enough stock for {p['name']}. Only {p['stock']} left.", 'error')
+        return redirect(url_for('cart'))
+    items, total = priced['items'], priced['total']
 
     if request.method == 'POST':
         address = request.form.get('address') or ''
@@ -1818,25 +4069,31 @@ def checkout():
                 ]
         with conn.cursor() as cur:
                 try:
+                    # Reserve stock first so a short line rejects the whole order
+                    short_ids = reserve_stock(cur, [(it['product']['id'], it['qty']) for it in items])
+                    if short_ids:
+                        conn.rollback()
+                        names = ", ".join(it['product']['name'] for it in items if it['product']['id'] in short_ids)
+                        flash(f"Not enough stock for {names}. Please update your cart.", 'error')
+                        return redirect(url_for('cart'))
+
                     cur.execute(
-                        "INSERT INTO orders (user_id, items, total, address) VALUES (%s, %s, %s, %s) RETURNING id",
-                        (session['user_id'], json.dumps(order_items), total, address)
+                        "INSERT INTO orders (user_id, items, total, address, items_summary, item_count) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id, created_at, status",
+                        (session['user_id'], json.dumps(order_items), total, address,
+                         summarize_items(order_items), sum(it['qty'] for it in order_items))
                     )
                     res = cur.fetchone()
                     # 🧠 Handle both tuple and dict cursor results
                     if not res:
                         raise Exception("No ID returned from INSERT.")
-                    order_id = res['id'] if isinstance(res, dict) else res[0]
-
-                    # ✅ Update product stock safely
-                    for it in items:
-                        cur.execute(
-                            "UPDATE products SET stock = stock - %s WHERE id=%s AND stock >= %s",
-                            (it['qty'], it['product']['id'], it['qty'])
-                        )
+                    order_id, created_at, status = (res['id'], res['created_at'], res['status']) if isinstance(res, dict) else res
+                    insert_order_items(cur, order_id, order_items)
+                    rollup_order(cur, created_at, total, order_items, status)
 
                     conn.commit()
-                    session['cart'] = {}
+                    invalidate_catalog()
+                    invalidate_admin_stats()
+                    clear_cart()
                     flash(f'Order #{order_id} placed successfully. Admin will confirm delivery.', 'success')
                     return redirect(url_for('user_dashboard'))
 
@@ -1847,51 +4104,45 @@ def checkout():
                     return redirect(url_for('checkout'))
 
 
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM users WHERE id=%s", (session['user_id'],))
-        user = cur.fetchone()
+    user = get_current_user()
     return render_template('checkout.html', items=items, total=total, user=user)
 
 # ---------- USER DASHBOARD ----------
 @app.route('/dashboard')
 @login_required
 def user_dashboard():
+    rows, next_cursor = fetch_orders_page(user_id=session['user_id'])
+    orders = [order_entry(r)[0] for r in rows]
+    stats = user_order_stats(session['user_id'])
+    return render_template('dashboard_user.html', orders=orders, stats=stats, next_cursor=next_cursor)
+
+def user_order_stats(user_id, start=None, end=None):
     conn = get_conn()
+    base = """
+        SELECT COUNT(*) AS total_orders,
+               COUNT(*) FILTER (WHERE status = 'Delivered') AS delivered_orders,
+               COALESCE(SUM(total), 0) AS total_spent
+        FROM orders WHERE user_id=%s
+    """
+    params = [user_id]
+    date_sql, date_params = created_at_filter(start, end)
+    base += date_sql; params += date_params
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM orders WHERE user_id=%s ORDER BY created_at DESC", (session['user_id'],))
-        rows = cur.fetchall()
-    print(f"[DEBUG user_dashboard] Found {len(rows)} orders for user {session['user_id']}")
-    orders = []
-    for r in rows:
-        print(f"[DEBUG] Order {r['id']}: items type = {type(r['items'])}, items = {r['items'][:100] if r['items'] else 'None'}")
-        parsed, summary = parse_order_items(r['items'] or '[]')
-        print(f"[DEBUG] Parsed: {len(parsed)} items, summary = {summary}")
-        created = to_ist_display(r['created_at'])
-        orders.append({
-            'id': r['id'], 'created_at': created, 'status': r['status'],
-            'total': float(r['total']), 'items_parsed': parsed, 'items_summary': summary, 'address': r['address']
-        })
-    print(f"[DEBUG] Returning {len(orders)} orders to template")
-    return render_template('dashboard_user.html', orders=orders)
+        cur.execute(base, params); row = cur.fetchone()
+    return {
+        'total_orders': row['total_orders'],
+        'delivered_orders': row['delivered_orders'],
+        'total_spent': float(row['total_spent'] or 0),
+    }
 
 @app.route('/user/stats_fragment')
 @login_required
 def user_stats_fragment():
     start = request.args.get('start'); end = request.args.get('end')
-    conn = get_conn()
-    base = "SELECT status, total FROM orders WHERE user_id=%s"
-    params = [session['user_id']]
-    if start and end:
-        base += " AND DATE(created_at) BETWEEN %s AND %s"; params += [start, end]
-    elif start:
-        base += " AND DATE(created_at) >= %s"; params += [start]
-    elif end:
-        base += " AND DATE(created_at) <= %s"; params += [end]
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(base, params); rows = cur.fetchall()
-    total_orders = len(rows)
-    delivered_orders = sum(1 for r in rows if r['status'] == 'Delivered')
-    total_spent = sum(float(r['total'] or 0) for r in rows)
+    stats = user_order_stats(session['user_id'], start, end)
+    total_orders = stats['total_orders']
+    delivered_orders = stats['delivered_orders']
+    total_spent = stats['total_spent']
     return f"""
       <div class='p-4 rounded-2xl bg-gradient-to-br from-emerald-50 to-white shadow-sm backdrop-blur-md border border-emerald-100'>
         <div class='text-sm text-gray-500'>Total Orders</div>
@@ -1911,44 +4162,45 @@ def user_stats_fragment():
 @login_required
 def user_orders_fragment():
     start = request.args.get('start'); end = request.args.get('end')
-    conn = get_conn()
-    base = "SELECT * FROM orders WHERE user_id=%s"
-    params = [session['user_id']]
-    if start and end:
-        base += " AND DATE(created_at) BETWEEN %s AND %s"; params += [start, end]
-    elif start:
-        base += " AND DATE(created_at) >= %s"; params += [start]
-    elif end:
-        base += " AND DATE(created_at) <= %s"; params += [end]
-    base += " ORDER BY created_at DESC"
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(base, params); rows = cur.fetchall()
+    cursor = request.args.get('cursor')
+    rows, next_cursor = fetch_orders_page(start, end, cursor, user_id=session['user_id'])
 
     if not rows:
+        if cursor:
+            return ''
         return '<div class="bg-white p-6 rounded shadow">No orders yet.</div>'
 
     out = []
     for r in rows:
-        parsed, summary = parse_order_items(r['items'] or '[]')
-        created = to_ist_display(r['created_at'])
+        o, _ = order_entry(r)
         out.append(f'''
         <div class="border rounded p-3 mb-3">
           <div class="flex justify-between items-start">
             <div>
-              <div class="text-sm font-medium">Order #{r['id']} — {created}</div>
-              <div class="text-xs small-muted mt-1">Status: {r['status']}</div>
-              <div class="text-xs small-muted mt-1">Items: {summary}</div>
+              <div class="text-sm font-medium">Order #{o['id']} — {o['created_at']}</div>
+              <div class="text-xs small-muted mt-1">Status: {o['status']}</div>
+              <div class="text-xs small-muted mt-1">Items: {o['items_summary']}</div>
             </div>
             <div class="text-right">
-              <div class="text-sm font-semibold">₹{float(r['total'] or 0):.2f}</div>
+              <div class="text-sm font-semibold">₹{o['total']:.2f}</div>
               <div class="mt-2">
-                <a href="{url_for('view_order', order_id=r['id'])}" class="text-sm underline">View</a>
+                <a href="{url_for('view_order', order_id=o['id'])}" class="text-sm underline">View</a>
               </div>
             </div>
           </div>
         </div>
         ''')
-    return '\n'.join(out)
+    resp = make_response('\n'.join(out))
+    resp.headers['X-Next-Cursor'] = next_cursor or ''
+    return resp
+
+@app.route('/api/orders')
+@login_required
+def api_user_orders():
+    limit = max(1, min(request.args.get('limit', ORDERS_PAGE_SIZE, type=int), 200))
+    rows, next_cursor = fetch_orders_page(request.args.get('start'), request.args.get('end'),
+                                          request.args.get('cursor'), user_id=session['user_id'], limit=limit)
+    return jsonify({'orders': [order_json(r) for r in rows], 'next_cursor': next_cursor})
 
 # ---------- ADMIN ----------
 @app.route('/admin')
@@ -1956,214 +4208,285 @@ def user_orders_fragment():
 def admin_dashboard():
     start = request.args.get('start')
     end = request.args.get('end')
-    conn = get_conn()
+    stats = admin_quick_stats(start, end)
 
-    sql = """
-        SELECT o.*, u.username
-        FROM orders o
-        LEFT JOIN users u ON o.user_id = u.id
-        WHERE 1=1
-    """
-    params = []
-    if start and end:
-        sql += " AND DATE(o.created_at) BETWEEN %s AND %s"
-        params += [start, end]
-    elif start:
-        sql += " AND DATE(o.created_at) >= %s"
-        params += [start]
-    elif end:
-        sql += " AND DATE(o.created_at) <= %s"
-        params += [end]
-    sql += " ORDER BY o.created_at DESC"
+    # Partial render (AJAX fragment) — kept for older clients of X-Partial
+    if request.headers.get('X-Partial') == 'stats':
+        return render_template('admin_quick_stats.html', stats=stats)
 
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        # Fetch orders
-        cur.execute(sql, params)
-        rows = cur.fetchall()
+    # First page of orders; the rest is loaded by infinite scroll
+    rows, next_cursor = fetch_orders_page(start, end)
 
-        # Fetch all products
-        cur.execute("SELECT * FROM products ORDER BY id DESC")
-        products = cur.fetchall()
-
-        # 🧩 Fetch summary stats safely
-        stats_sql = """
-            SELECT 
-                COUNT(*) AS order_count, 
-                COALESCE(SUM(total),0) AS revenue 
-            FROM orders WHERE 1=1
-        """
-        stats_params = []
-        if start and end:
-            stats_sql += " AND DATE(created_at) BETWEEN %s AND %s"
-            stats_params += [start, end]
-        elif start:
-            stats_sql += " AND DATE(created_at) >= %s"
-            stats_params += [start]
-        elif end:
-            stats_sql += " AND DATE(created_at) <= %s"
-            stats_params += [end]
-
-        cur.execute(stats_sql, stats_params)
-        stats_row = cur.fetchone() or {'order_count': 0, 'revenue': 0}
-        orders_count = stats_row.get('order_count', 0)
-        revenue = float(stats_row.get('revenue', 0) or 0.0)
-
-        # 🧩 Fetch users count safely (works with RealDictCursor)
-        cur.execute("SELECT COUNT(*) AS user_count FROM users")
-        user_row = cur.fetchone() or {'user_count': 0}
-        users_count = user_row.get('user_count', 0)
+    # First page of products; search and further pages come from admin_products_fragment
+    products, products_cursor = query_products(product_filters({}), limit=ADMIN_PRODUCTS_PAGE_SIZE)
 
     # Group orders by day
-    daywise = defaultdict(list)
-    for r in rows:
-        parsed, summary = parse_order_items(r['items'] or '[]')
-        entry = {
-            'id': r['id'],
-            'user_id': r['user_id'],
-            'username': r.get('username'),
-            'items_parsed': parsed,
-            'items_summary': summary,
-            'total': float(r['total']),
-            'status': r['status'],
-            'created_at': to_ist_display(r['created_at']),
-        }
-        date_key = (
-            r['created_at'].astimezone(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d')
-            if isinstance(r['created_at'], datetime)
-            else str(r['created_at']).split(' ')[0]
-        )
-        daywise[date_key].append(entry)
+    daywise, day_info = group_orders_by_day(rows)
 
-    stats = {'users': users_count, 'orders': orders_count, 'revenue': float(revenue or 0.0)}
+    # Full dashboard render
+    return render_template('dashboard_admin.html', daywise=daywise, day_info=day_info, products=products,
+                           products_cursor=products_cursor, stats=stats, next_cursor=next_cursor,
+                           order_statuses=list(ORDER_STATUS_TRANSITIONS))
 
-    # Partial render (AJAX fragment)
-    if request.headers.get('X-Partial') == 'stats':
-        return render_template_string('''
-        <div class="space-y-3">
-          <div>Total users: <strong>{{ stats.users }}</strong></div>
-          <div>Total orders: <strong>{{ stats.orders }}</strong></div>
-          <div>Revenue: <strong>₹{{ '%.2f'|format(stats.revenue) }}</strong></div>
-        </div>
-        ''', stats=stats)
+@app.route('/admin/products_fragment')
+@admin_required
+def admin_products_fragment():
+    products, next_cursor = query_products(product_filters(request.args), request.args.get('cursor'),
+                                           limit=ADMIN_PRODUCTS_PAGE_SIZE)
+    resp = make_response(render_template('admin_product_rows.html', products=products))
+    resp.headers['X-Next-Cursor'] = next_cursor or ''
+    return resp
+
+@app.route('/admin/stats')
+@admin_required
+def admin_stats():
+    return jsonify(admin_quick_stats(request.args.get('start'), request.args.get('end')))
 
-    # Full dashboard render
-    return render_template('dashboard_admin.html', daywise=daywise, products=products, stats=stats)
+# Ends every streamed day group so the page can append complete groups as they arrive
+ORDER_GROUP_BOUNDARY = "\n<!--/day-group-->\n"
+
+def render_order_day_group(day, orders, total, first_sno):
+    """HTML for one admin day group; orders are oldest first and numbered from first_sno."""
+    return app.jinja_env.get_template('admin_order_day_group.html').render(
+        day=day, orders=orders, total=total, first_sno=first_sno)
+
+def stream_order_day_groups(start=None, end=None):
+    """
+    Yield rendered day groups, newest day first, for every order in the range.
+    Rows come from a server-side cursor in ORDERS_STREAM_BATCH batches, so only
+    one day's orders are held in memory at a time.
+    """
+    conn = get_conn()
+    date_sql, params = created_at_filter(start, end, 'o.created_at')
+    try:
+        with conn.cursor(name='admin_orders_stream', cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.itersize = ORDERS_STREAM_BATCH
+            cur.execute(f"""
+                SELECT o.id, o.user_id, o.total, o.address, o.status, o.created_at,
+                       COALESCE(o.items_summary, '') AS items_summary, COALESCE(o.item_count, 0) AS item_count,
+                       u.username
+                FROM orders o LEFT JOIN users u ON o.user_id=u.id
+                WHERE 1=1{date_sql}
+                ORDER BY o.created_at DESC, o.id DESC
+            """, params)
+            day, orders = None, []
+            for r in cur:
+                entry, row_day = order_entry(r)
+                if row_day != day and orders:
+                    # Rows arrive newest first; a day is shown oldest first with S.No from 1
+                    yield render_order_day_group(day, orders[::-1], len(orders), 1) + ORDER_GROUP_BOUNDARY
+                    orders = []
+                day = row_day
+                orders.append(entry)
+            if orders:
+                yield render_order_day_group(day, orders[::-1], len(orders), 1) + ORDER_GROUP_BOUNDARY
+    finally:
+        conn.rollback()  # ends the read-only transaction the named cursor lives in
 
 @app.route('/admin/orders_fragment')
 @admin_required
 def admin_orders_fragment():
     start = request.args.get('start'); end = request.args.get('end')
-    conn = get_conn()
-    sql = "SELECT o.*, u.username FROM orders o LEFT JOIN users u ON o.user_id=u.id"
-    params = []
-    if start and end: sql += " WHERE DATE(o.created_at) BETWEEN %s AND %s"; params = [start, end]
-    elif start:       sql += " WHERE DATE(o.created_at) >= %s"; params = [start]
-    elif end:         sql += " WHERE DATE(o.created_at) <= %s"; params = [end]
-    sql += " ORDER BY o.created_at DESC"
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(sql, params); rows = cur.fetchall()
+    if request.args.get('stream'):
+        # Whole range, sent group by group as it is read
+        resp = Response(stream_with_context(stream_order_day_groups(start, end)), mimetype='text/html')
+        resp.headers['X-Next-Cursor'] = ''
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
 
-    daywise = defaultdict(list)
-    for r in rows:
-        parsed, summary = parse_order_items(r['items'] or '[]')
-        entry = {
-            'id': r['id'], 'user_id': r['user_id'], 'username': r.get('username'),
-            'items_parsed': parsed, 'items_summary': summary, 'total': float(r['total']),
-            'status': r['status'], 'created_at': to_ist_display(r['created_at'])
-        }
-        date_key = (r['created_at'].astimezone(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d')
-                    if isinstance(r['created_at'], datetime) else str(r['created_at']).split(' ')[0])
-        daywise[date_key].append(entry)
+    cursor = request.args.get('cursor')
+    rows, next_cursor = fetch_orders_page(start, end, cursor)
+    daywise, day_info = group_orders_by_day(rows)
 
     if not daywise:
-        return '<div>No orders yet.</div>'
-
-    parts = []
-    for day, orders in daywise.items():
-        # Reverse the orders list so oldest order gets S.No 1
-        orders_reversed = list(reversed(orders))
-        parts.append(f'''
-        <div class="mb-6 border border-white/50 rounded-lg overflow-hidden">
-          <div class="bg-emerald-50/80 px-4 py-2 text-sm font-semibold text-emerald-800 border-b border-emerald-100">
-            {day} — {len(orders)} order{'s' if len(orders)>1 else ''}
-          </div>
-          <div class="overflow-x-auto">
-            <table class="w-full text-left text-sm border-collapse min-w-[720px]">
-              <thead class="bg-emerald-100 text-emerald-900">
-                <tr>
-                  <th class="py-2 px-3 font-semibold text-center">S.No</th>
-                  <th class="py-2 px-4 font-semibold text-left">Order</th>
-                  <th class="py-2 px-4 font-semibold text-left">User</th>
-                  <th class="py-2 px-4 font-semibold text-left">Items</th>
-                  <th class="py-2 px-4 font-semibold text-right">Total</th>
-                  <th class="py-2 px-4 font-semibold text-left">Status</th>
-                  <th class="py-2 px-4 font-semibold text-center">Action</th>
-                </tr>
-              </thead>
-              <tbody class="bg-white/50">
-        ''')
-        for idx, o in enumerate(orders_reversed, start=1):
-            parts.append(f'''
-                <tr class="border-t hover:bg-white/70 transition">
-                  <td class="py-2 px-3 align-top text-center">
-                    <div class="font-semibold text-emerald-700">{idx}</div>
-                  </td>
-                  <td class="py-2 px-4 align-top">
-                    <div class="font-medium text-gray-800">#{o["id"]}</div>
-                    <div class="text-xs text-gray-500">{o["created_at"]}</div>
-                  </td>
-                  <td class="py-2 px-4 align-top">{o.get("username") or ("User " + str(o["user_id"]))}</td>
-                  <td class="py-2 px-4 align-top text-gray-700">{o["items_summary"]}</td>
-                  <td class="py-2 px-4 align-top text-right font-semibold text-gray-800">₹{o["total"]:.2f}</td>
-                  <td class="py-2 px-4 align-top">{o["status"]}</td>
-                  <td class="py-2 px-4 text-center">
-                    <a href="{url_for("view_order", order_id=o["id"])}" class="text-sm text-emerald-700 hover:underline">View</a>
-                  </td>
-                </tr>
-            ''')
-        parts.append('''
-              </tbody>
-            </table>
-          </div>
-        </div>
-        ''')
-    return '\n'.join(parts)
+        return '' if cursor else '<div>No orders yet.</div>'
+
+    # Reverse each day's orders so the oldest order gets S.No 1
+    html = '\n'.join(render_order_day_group(day, list(reversed(orders)), day_info[day]['total'],
+                                             day_info[day]['older'] + 1)
+                     for day, orders in daywise.items())
+    resp = make_response(html)
+    resp.headers['X-Next-Cursor'] = next_cursor or ''
+    return resp
+
+@app.route('/admin/api/orders')
+@admin_required
+def admin_api_orders():
+    limit = max(1, min(request.args.get('limit', ORDERS_PAGE_SIZE, type=int), 200))
+    rows, next_cursor = fetch_orders_page(request.args.get('start'), request.args.get('end'),
+                                          request.args.get('cursor'), limit=limit)
+    return jsonify({'orders': [order_json(r) for r in rows], 'next_cursor': next_cursor})
+
+# ---------- ADMIN: ORDER EXPORT ----------
+# Exports stream from a server-side cursor, one row per order line, so memory
+# stays flat however many orders the date range covers.
+ORDER_EXPORT_COLUMNS = ['Order ID', 'Placed (IST)', 'User ID', 'Username', 'Status', 'Address',
+                        'Line', 'Product ID', 'Product', 'Qty', 'Unit Price', 'Line Total', 'Order Total']
+XLSX_MAX_ROWS = 1048576  # Excel's per-sheet limit; larger exports continue on the next sheet
+
+def iter_order_export_rows(start=None, end=None):
+    """Export tuples (see ORDER_EXPORT_COLUMNS), newest order first; orders without lines get one row."""
+    conn = get_conn()
+    date_sql, params = created_at_filter(start, end, 'o.created_at')
+    try:
+        with conn.cursor(name='orders_export') as cur:
+            cur.itersize = ORDERS_STREAM_BATCH
+            cur.execute(f"""
+                SELECT o.id, o.created_at, o.user_id, u.username, o.status, o.address,
+                       oi.line_no, oi.product_id, oi.name, oi.qty, oi.price, o.total
+                FROM orders o
+                LEFT JOIN users u ON u.id = o.user_id
+                LEFT JOIN order_items oi ON oi.order_id = o.id
+                WHERE 1=1{date_sql}
+                ORDER BY o.created_at DESC, o.id DESC, oi.line_no
+            """, params)
+            for (order_id, created_at, user_id, username, status, address,
+                 line_no, product_id, name, qty, price, total) in cur:
+                placed = (_utc_naive(created_at) + IST_OFFSET).strftime('%Y-%m-%d %H:%M:%S') if created_at else ''
+                yield (order_id, placed, user_id, username or '', status or 'Pending', address or '',
+                       line_no, product_id, name or '', qty,
+                       float(price) if price is not None else None,
+                       float(price * qty) if price is not None else None,
+                       float(total or 0))
+    finally:
+        conn.rollback()  # ends the read-only transaction the named cursor lives in
+
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def csv_safe(value):
+    """Quote user text that a spreadsheet would otherwise evaluate as a formula."""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def stream_orders_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write('\ufeff')  # lets Excel detect UTF-8
+    writer.writerow(ORDER_EXPORT_COLUMNS)
+    for n, row in enumerate(rows, 1):
+        writer.writerow([csv_safe(v) for v in row])
+        if n % 1000 == 0:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+def stream_orders_xlsx(rows):
+    """
+    XLSX is a zip, so the workbook is finished in a temp file before the first byte
+    is sent; constant_memory mode flushes each row to disk as soon as it is written.
+    """
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        # User text is written verbatim: never as a formula or a hyperlink
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_formulas': False,
+                                              'strings_to_urls': False})
+        bold = workbook.add_format({'bold': True})
+        sheet, r = None, XLSX_MAX_ROWS
+        for row in rows:
+            if r >= XLSX_MAX_ROWS:
+                sheet = workbook.add_worksheet(f"Orders {len(workbook.worksheets()) + 1}")
+                sheet.write_row(0, 0, ORDER_EXPORT_COLUMNS, bold)
+                r = 1
+            sheet.write_row(r, 0, row)
+            r += 1
+        if sheet is None:
+            workbook.add_worksheet("Orders 1").write_row(0, 0, ORDER_EXPORT_COLUMNS, bold)
+        workbook.close()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                yield chunk
+    finally:
+        os.remove(path)
+
+@app.route('/admin/orders/export')
+@admin_required
+def admin_export_orders():
+    fmt = (request.args.get('format') or 'csv').lower()
+    start, end = request.args.get('start'), request.args.get('end')
+    valid = lambda v: v if v and re.fullmatch(r'\d{4}-\d{2}-\d{2}', v) else None
+    filename = f"orders_{valid(start) or 'all'}_{valid(end) or 'latest'}.{'xlsx' if fmt == 'xlsx' else 'csv'}"
+    rows = iter_order_export_rows(start, end)
+    if fmt == 'xlsx':
+        if xlsxwriter is None:
+            flash('XLSX export needs the XlsxWriter package; exporting CSV instead.', 'error')
+            return redirect(url_for('admin_export_orders', format='csv', start=start, end=end))
+        body = stream_orders_xlsx(rows)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body, mimetype = stream_orders_csv(rows), 'text/csv'
+    resp = Response(stream_with_context(body), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+# period -> (date_trunc unit, chart label format)
+SALES_PERIODS = {
+    'day':   ('day',   '%d %b'),
+    'week':  ('week',  '%Y-%m-%d'),
+    'month': ('month', '%b %Y'),
+    'year':  ('year',  '%Y'),
+}
+
+# Buckets the daily rollup by IST calendar unit inside PostgreSQL and gap-fills
+# empty buckets with generate_series, so only one row per bucket is returned.
+SALES_SERIES_SQL = """
+    WITH buckets AS (
+        SELECT date_trunc(%(unit)s, day::timestamp) AS bucket,
+               SUM(order_count) AS order_count,
+               SUM(revenue) AS revenue
+        FROM daily_sales
+        WHERE order_count > 0 {date_filter}
+        GROUP BY 1
+    ), bounds AS (
+        SELECT COALESCE(date_trunc(%(unit)s, %(first)s::timestamp), MIN(bucket)) AS lo,
+               COALESCE(date_trunc(%(unit)s, %(last)s::timestamp), MAX(bucket)) AS hi
+        FROM buckets
+    )
+    SELECT s.bucket, COALESCE(b.order_count, 0) AS order_count, COALESCE(b.revenue, 0) AS revenue
+    FROM bounds
+    CROSS JOIN generate_series(bounds.lo, bounds.hi, ('1 ' || %(unit)s)::interval) AS s(bucket)
+    LEFT JOIN buckets b ON b.bucket = s.bucket
+    ORDER BY s.bucket
+"""
 
 @app.route('/admin/sales_data')
 @admin_required
 def admin_sales_data():
     period = request.args.get('period', 'day')
     start = request.args.get('start'); end = request.args.get('end')
+    unit, label_fmt = SALES_PERIODS.get(period, SALES_PERIODS['year'])
+
+    def ist_day(value):
+        try: return datetime.strptime(value, '%Y-%m-%d')
+        except (TypeError, ValueError): return None
+
+    first, last = ist_day(start), ist_day(end)
+    date_filter, params = "", {'unit': unit, 'first': first, 'last': last}
+    if first is not None:
+        date_filter += " AND day >= %(first)s::date"
+    if last is not None:
+        date_filter += " AND day <= %(last)s::date"
+
     conn = get_conn()
-    base = "SELECT total, created_at FROM orders WHERE 1=1"
-    params = []
-    if start and end: base += " AND DATE(created_at) BETWEEN %s AND %s"; params = [start, end]
-    elif start:       base += " AND DATE(created_at) >= %s"; params = [start]
-    elif end:         base += " AND DATE(created_at) <= %s"; params = [end]
-    base += " ORDER BY created_at ASC"
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(base, params); rows = cur.fetchall()
-
-    data_map = OrderedDict()
-    def week_key(dt):
-        iso = dt.isocalendar(); return f"{iso[0]}-W{iso[1]:02d}"
+        cur.execute(SALES_SERIES_SQL.format(date_filter=date_filter), params)
+        rows = cur.fetchall()
 
+    labels, values, counts, averages = [], [], [], []
     for r in rows:
-        dt = r['created_at'] if isinstance(r['created_at'], datetime) else datetime.utcnow()
-        if period == 'day':
-            key = dt.strftime('%Y-%m-%d'); label = dt.strftime('%d %b')
-        elif period == 'week':
-            key = week_key(dt); monday = dt - timedelta(days=dt.weekday()); label = monday.strftime('%Y-%m-%d')
-        elif period == 'month':
-            key = dt.strftime('%Y-%m'); label = dt.strftime('%b %Y')
-        else:
-            key = dt.strftime('%Y'); label = dt.strftime('%Y')
-        if key not in data_map: data_map[key] = {'label': label, 'total': 0.0}
-        data_map[key]['total'] += float(r['total'] or 0)
-
-    labels = [v['label'] for v in data_map.values()]
-    values = [round(v['total'], 2) for v in data_map.values()]
-    return jsonify({'labels': labels, 'values': values})
+        revenue = float(r['revenue'] or 0)
+        labels.append(r['bucket'].strftime(label_fmt))
+        values.append(round(revenue, 2))
+        counts.append(r['order_count'])
+        averages.append(round(revenue / r['order_count'], 2) if r['order_count'] else 0.0)
+    return jsonify({'labels': labels, 'values': values, 'counts': counts, 'avg_basket': averages})
+
+@app.route('/admin/db_pool')
+@admin_required
+def admin_db_pool_stats():
+    return jsonify(pool_stats())
 
 # ---------- ADMIN: ORDER ACTIONS ----------
 @app.route('/admin/order/<int:order_id>')
@@ -2177,18 +4500,156 @@ def admin_update_order(order_id):
     status = request.form.get('status') or 'Pending'
     conn = get_conn()
     with conn.cursor() as cur:
-        cur.execute("UPDATE orders SET status=%s WHERE id=%s", (status, order_id))
+        cur.execute("""
+            UPDATE orders o SET status=%s
+            FROM (SELECT id, status FROM orders WHERE id=%s FOR UPDATE) old
+            WHERE o.id = old.id
+            RETURNING o.created_at, old.status
+        """, (status, order_id))
+        row = cur.fetchone()
+        if row:
+            rollup_status_change(cur, row[0], row[1], status)
     conn.commit()
+    invalidate_admin_stats()
     flash('Order updated', 'success')
     return redirect(url_for('admin_dashboard'))
 
+# Statuses an order may move to from each status. Delivered can only step back
+# one stage, to correct a mistaken delivery.
+ORDER_STATUS_TRANSITIONS = {
+    'Pending': ('Confirmed', 'Out for Delivery', 'Delivered'),
+    'Confirmed': ('Pending', 'Out for Delivery', 'Delivered'),
+    'Out for Delivery': ('Confirmed', 'Delivered'),
+    'Delivered': ('Out for Delivery',),
+}
+BULK_STATUS_MAX_IDS = int(os.environ.get("BULK_STATUS_MAX_IDS", "5000"))
+BULK_STATUS_SKIPPED_LIMIT = 100  # skipped orders listed individually; the rest are only counted
+
+def bulk_status_selection(data):
+    """SQL condition + params for the orders a bulk status request names, or ValueError."""
+    ids, flt = data.get('ids'), data.get('filter')
+    if (ids is None) == (flt is None):
+        raise ValueError('Give either "ids" or "filter"')
+    if ids is not None:
+        if not isinstance(ids, list) or any(isinstance(i, bool) for i in ids):
+            raise ValueError('"ids" must be a list of order ids')
+        try:
+            ids = sorted({int(i) for i in ids})
+        except (TypeError, ValueError):
+            raise ValueError('"ids" must be a list of order ids')
+        if not ids:
+            raise ValueError('"ids" is empty')
+        if len(ids) > BULK_STATUS_MAX_IDS:
+            raise ValueError(f'At most {BULK_STATUS_MAX_IDS} ids per request; use a filter instead')
+        return " AND o.id = ANY(%s)", [ids]
+    if not isinstance(flt, dict) or not any(flt.get(k) for k in ('status', 'start', 'end', 'user_id')):
+        raise ValueError('"filter" needs at least one of status, start, end, user_id')
+    # A bad date must not silently widen the selection to an open-ended range
+    for key in ('start', 'end'):
+        if flt.get(key):
+            try:
+                datetime.strptime(flt[key], '%Y-%m-%d')
+            except (TypeError, ValueError):
+                raise ValueError(f'"{key}" must be a YYYY-MM-DD date')
+    sql, params = created_at_filter(flt.get('start'), flt.get('end'), 'o.created_at')
+    if flt.get('status'):
+        if flt['status'] not in ORDER_STATUS_TRANSITIONS:
+            raise ValueError(f"Unknown status {flt['status']!r}")
+        sql += " AND COALESCE(o.status, 'Pending') = %s"; params.append(flt['status'])
+    if flt.get('user_id'):
+        try:
+            sql += " AND o.user_id = %s"; params.append(int(flt['user_id']))
+        except (TypeError, ValueError):
+            raise ValueError('"user_id" must be an integer')
+    return sql, params
+
+@app.route('/admin/api/orders/status', methods=['POST'])
+@admin_required
+def admin_bulk_update_orders():
+    """
+    Body: {"status": "Delivered", "ids": [101, 102]} or
+          {"status": "Delivered", "filter": {"status": "Out for Delivery", "start": "2026-10-18", "end": "2026-10-18"}}
+    Every selected order that may move to the new status is updated in one
+    statement. The rest are counted by reason in "skipped_by_reason", and the
+    first BULK_STATUS_SKIPPED_LIMIT of them are listed in "skipped".
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    status = data.get('status')
+    if status not in ORDER_STATUS_TRANSITIONS:
+        return jsonify({'error': f'status must be one of {", ".join(ORDER_STATUS_TRANSITIONS)}'}), 400
+    try:
+        where, params = bulk_status_selection(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    allowed_from = [s for s, nxt in ORDER_STATUS_TRANSITIONS.items() if status in nxt]
+
+    conn = get_conn()
+    with conn.cursor() as cur:
+        # Lock in id order, then update and read back each row's previous status
+        cur.execute(f"""
+            WITH target AS (
+                SELECT o.id, o.created_at, COALESCE(o.status, 'Pending') AS status
+                FROM orders o
+                WHERE COALESCE(o.status, 'Pending') = ANY(%s){where}
+                ORDER BY o.id
+                FOR UPDATE
+            )
+            UPDATE orders o SET status = %s
+            FROM target t
+            WHERE o.id = t.id
+            RETURNING o.id, t.created_at, t.status
+        """, [allowed_from] + params + [status])
+        changed = cur.fetchall()
+
+        per_day = defaultdict(int)
+        for _, created_at, old_status in changed:
+            per_day[(to_ist(created_at).date(), old_status)] += 1
+        for (day, old_status), n in sorted(per_day.items()):
+            rollup_status(cur, day, old_status, -n)
+            rollup_status(cur, day, status, n)
+
+        updated = sorted(r[0] for r in changed)
+        reason = lambda old: f'already {old}' if old == status else f'cannot go from {old} to {status}'
+        # A wide filter can leave thousands of orders behind: count them all, list only a few
+        cur.execute(f"""
+            SELECT COALESCE(o.status, 'Pending'), COUNT(*) FROM orders o
+            WHERE NOT (o.id = ANY(%s)){where}
+            GROUP BY 1
+        """, [updated] + params)
+        by_reason = {reason(old): n for old, n in cur.fetchall()}
+        cur.execute(f"""
+            SELECT o.id, COALESCE(o.status, 'Pending') FROM orders o
+            WHERE NOT (o.id = ANY(%s)){where}
+            ORDER BY o.id LIMIT %s
+        """, [updated] + params + [BULK_STATUS_SKIPPED_LIMIT])
+        skipped = [{'id': oid, 'status': old, 'error': reason(old)} for oid, old in cur.fetchall()]
+        if data.get('ids') is not None:
+            cur.execute("SELECT id FROM orders WHERE id = ANY(%s)", (params[0],))
+            existing = {r[0] for r in cur.fetchall()}
+            missing = [oid for oid in params[0] if oid not in existing]
+            if missing:
+                by_reason['no order with this id'] = len(missing)
+                room = BULK_STATUS_SKIPPED_LIMIT - len(skipped)
+                skipped += [{'id': oid, 'status': None, 'error': 'no order with this id'} for oid in missing[:max(room, 0)]]
+    conn.commit()
+    if changed:
+        invalidate_admin_stats()
+    return jsonify({'status': status, 'updated': updated, 'skipped': skipped,
+                    'skipped_total': sum(by_reason.values()), 'skipped_by_reason': by_reason})
+
 @app.route('/admin/order/<int:order_id>/delete', methods=['POST'])
 @admin_required
 def delete_order(order_id):
     conn = get_conn()
     with conn.cursor() as cur:
-        cur.execute("DELETE FROM orders WHERE id=%s", (order_id,))
+        cur.execute("DELETE FROM orders WHERE id=%s RETURNING created_at, total, items, status", (order_id,))
+        row = cur.fetchone()
+        if row:
+            rollup_order(cur, *row, sign=-1)
     conn.commit()
+    invalidate_admin_stats()
     flash('Order deleted', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -2208,7 +4669,7 @@ def view_order(order_id):
     if not r:
         flash('Order not found', 'error')
         return redirect(url_for('index'))
-    parsed, _ = parse_order_items(r['items'] or '[]')
+    parsed = load_order_items([order_id]).get(order_id) or parse_order_items(r['items'] or '[]')[0]
     order_obj = dict(r)
     order_obj['created_at'] = to_ist_display(r['created_at'])
     return render_template('order_detail.html', order=order_obj, parsed_items=parsed)
@@ -2218,19 +4679,29 @@ def view_order(order_id):
 def cancel_order(order_id):
     conn = get_conn()
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM orders WHERE id=%s AND user_id=%s", (order_id, session['user_id']))
+        # Locked until commit, so a concurrent cancel waits and then finds the order gone
+        cur.execute("SELECT * FROM orders WHERE id=%s AND user_id=%s FOR UPDATE", (order_id, session['user_id']))
         r = cur.fetchone()
     if not r:
         flash('Order not found or access denied', 'error'); return redirect(url_for('user_dashboard'))
     if r['status'] != 'Pending':
         flash('Only pending orders can be cancelled', 'error'); return redirect(url_for('user_dashboard'))
 
-    parsed, _ = parse_order_items(r['items'] or '[]')
     with conn.cursor() as cur:
-        for it in parsed:
-            cur.execute("UPDATE products SET stock = stock + %s WHERE id=%s", (it['qty'], it['id']))
-        cur.execute("DELETE FROM orders WHERE id=%s", (order_id,))
+        cur.execute("SELECT product_id, qty FROM order_items WHERE order_id=%s", (order_id,))
+        lines = cur.fetchall()
+        if not lines:
+            # Placed by older code after the order_items backfill ran: only the JSON copy exists
+            lines = [(it['id'], it['qty']) for it in parse_order_items(r['items'] or '[]')[0]]
+        cur.execute("DELETE FROM orders WHERE id=%s RETURNING id", (order_id,))
+        if cur.fetchone() is None:
+            conn.rollback()
+            flash('Order not found or access denied', 'error'); return redirect(url_for('user_dashboard'))
+        restock(cur, lines)
+        rollup_order(cur, r['created_at'], r['total'], r['items'], r['status'], sign=-1)
     conn.commit()
+    invalidate_catalog()
+    invalidate_admin_stats()
     flash('Order cancelled and stock restored', 'success')
     return redirect(url_for('user_dashboard'))
 
@@ -2247,11 +4718,9 @@ def admin_add_product():
 
         image_url  = (request.form.get('image_url') or '').strip()
         image_file = request.files.get('image_file')
-        image_path = ''
+        image_path, filename = '', None
         if image_file and allowed_file(image_file.filename):
-            filename = secure_filename(f"product_{int(datetime.utcnow().timestamp())}_{image_file.filename}")
-            dest = os.path.join(app.config['UPLOAD_DIR'], filename)
-            image_file.save(dest)
+            filename = store_upload(image_file)
             image_path = url_for('uploaded_file', filename=filename)
         elif image_url:
             image_path = image_url
@@ -2262,42 +4731,30 @@ def admin_add_product():
             # PostgreSQL requires %s placeholders, NOT ? placeholders
             postgres_insert_query = """
                 INSERT INTO products (name, description, price, image, stock) 
-                VALUES (%s, %s, %s, %s, %s)
+                VALUES (%s, %s, %s, %s, %s) RETURNING id
             """
             product_data_tuple = (name, desc, price, image_path, stock)
             print(f"[DEBUG] Query: {postgres_insert_query.strip()}")
             print(f"[DEBUG] Data: {product_data_tuple}")
             cur.execute(postgres_insert_query, product_data_tuple)
+            product_id = cur.fetchone()[0]
+            upload_ref(cur, image_path, 1)
         conn.commit()
+        invalidate_catalog()
+        if filename:
+            schedule_image_variants('product', product_id, filename, image_path)
         flash('Product added successfully!', 'success')
         return redirect(url_for('admin_dashboard'))
 
     # Render add form (kept minimal since full UI is in your templates)
-    return render_template_string("""
-      <!doctype html><html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><script src="https://cdn.tailwindcss.com"></script></head>
-      <body class="min-h-screen flex items-center justify-center p-4" style="background:linear-gradient(180deg,#f8fafc,#fff)">
-        <div class="bg-white/75 backdrop-blur p-6 rounded-xl shadow w-full max-w-md">
-          <h2 class="text-2xl font-bold text-emerald-700 mb-5 text-center">Add Product</h2>
-          <form method="post" enctype="multipart/form-data" class="space-y-4">
-            <div><label class="block text-sm mb-1">Name</label><input name="name" required class="w-full border rounded px-3 py-2"></div>
-            <div><label class="block text-sm mb-1">Description</label><textarea name="description" rows="3" class="w-full border rounded px-3 py-2"></textarea></div>
-            <div><label class="block text-sm mb-1">Price (₹)</label><input name="price" type="number" step="0.01" required class="w-full border rounded px-3 py-2"></div>
-            <div><label class="block text-sm mb-1">Stock</label><input name="stock" type="number" value="0" class="w-full border rounded px-3 py-2"></div>
-            <div><label class="block text-sm mb-1">Image Upload (optional)</label><input type="file" name="image_file" accept="image/*" class="w-full text-sm"></div>
-            <div><label class="block text-sm mb-1">or Image URL</label><input name="image_url" placeholder="https://..." class="w-full border rounded px-3 py-2"></div>
-            <button class="w-full bg-emerald-600 text-white rounded py-2">Add Product</button>
-            <div class="text-center mt-3"><a href="{{ url_for('admin_dashboard') }}" class="text-emerald-700 text-sm underline">← Back</a></div>
-          </form>
-        </div>
-      </body></html>
-    """)
+    return render_template('admin_product_add.html')
 
 @app.route('/admin/product/<int:product_id>/edit', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_product(product_id):
     conn = get_conn()
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute("SELECT * FROM products WHERE id=%s", (product_id,))
+        cur.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id=%s", (product_id,))
         p = cur.fetchone()
     if not p:
         flash('Product not found', 'error'); return redirect(url_for('admin_dashboard'))
@@ -2312,67 +4769,293 @@ def admin_edit_product(product_id):
 
         image_url  = (request.form.get('image_url') or '').strip()
         image_file = request.files.get('image_file')
-        image_path = p['image']
+        image_path, filename = p['image'], None
         if image_file and allowed_file(image_file.filename):
-            filename = secure_filename(f"product_{product_id}_{int(datetime.utcnow().timestamp())}_{image_file.filename}")
-            dest = os.path.join(app.config['UPLOAD_DIR'], filename)
-            image_file.save(dest)
+            filename = store_upload(image_file)
             image_path = url_for('uploaded_file', filename=filename)
         elif image_url:
             image_path = image_url
 
         conn = get_conn()
         with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE products SET name=%s, description=%s, price=%s, image=%s, stock=%s WHERE id=%s",
-                (name, desc, price, image_path, stock, product_id)
-            )
+            # Lock the row so a concurrent edit cannot release the same old image twice
+            cur.execute("SELECT image FROM products WHERE id=%s FOR UPDATE", (product_id,))
+            old = cur.fetchone()
+            if old:
+                image_changed = old[0] != image_path
+                cur.execute("""
+                    UPDATE products SET name=%s, description=%s, price=%s, image=%s, stock=%s,
+                                        image_variants=CASE WHEN %s THEN NULL ELSE image_variants END
+                    WHERE id=%s
+                """, (name, desc, price, image_path, stock, image_changed, product_id))
+                if image_changed:
+                    replace_upload_ref(cur, old[0], image_path)
         conn.commit()
+        invalidate_catalog()
+        if filename:
+            schedule_image_variants('product', product_id, filename, image_path)
         flash('Product updated successfully!', 'success')
         return redirect(url_for('admin_dashboard'))
 
     # Simple edit form (the full pretty UI remains in your templates)
-    return render_template_string(f"""
-    <!doctype html><html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><script src="https://cdn.tailwindcss.com"></script></head>
-    <body class="min-h-screen flex items-center justify-center p-4" style="background:linear-gradient(180deg,#f8fafc,#fff)">
-      <div class="bg-white/75 backdrop-blur p-6 rounded-xl shadow w-full max-w-md">
-        <h2 class="text-2xl font-bold text-emerald-700 mb-5 text-center">Edit Product</h2>
-        <form method="post" enctype="multipart/form-data" class="space-y-4">
-          <div><label class="block text-sm mb-1">Name</label>
-            <input name="name" value="{p['name']}" required class="w-full border rounded px-3 py-2">
-          </div>
-          <div><label class="block text-sm mb-1">Description</label>
-            <textarea name="description" rows="3" class="w-full border rounded px-3 py-2">{p['description'] or ''}</textarea>
-          </div>
-          <div><label class="block text-sm mb-1">Price (₹)</label>
-            <input name="price" type="number" step="0.01" value="{p['price']}" required class="w-full border rounded px-3 py-2">
-          </div>
-          <div><label class="block text-sm mb-1">Change Image (Upload)</label>
-            <input type="file" name="image_file" accept="image/*" class="w-full text-sm">
-          </div>
-          <div><label class="block text-sm mb-1">or Image URL</label>
-            <input name="image_url" value="{p['image'] or ''}" class="w-full border rounded px-3 py-2">
-          </div>
-          <div><label class="block text-sm mb-1">Stock</label>
-            <input name="stock" type="number" value="{p['stock']}" class="w-full border rounded px-3 py-2">
-          </div>
-          <button class="w-full bg-emerald-600 text-white rounded py-2">Update Product</button>
-          <div class="text-center mt-3"><a href="{{{{ url_for('admin_dashboard') }}}}" class="text-emerald-700 text-sm underline">← Back</a></div>
-        </form>
-      </div>
-    </body></html>
-    """)
+    return render_template('admin_product_edit.html', p=p)
 
 @app.route('/admin/product/<int:product_id>/delete', methods=['POST'])
 @admin_required
 def admin_delete_product(product_id):
     conn = get_conn()
     with conn.cursor() as cur:
-        cur.execute("DELETE FROM products WHERE id=%s", (product_id,))
+        cur.execute("DELETE FROM products WHERE id=%s RETURNING image", (product_id,))
+        old = cur.fetchone()
+        if old:
+            upload_ref(cur, old[0], -1)
     conn.commit()
+    invalidate_catalog()
     flash('Product deleted', 'success')
     return redirect(url_for('admin_dashboard'))
 
+# ---------- ADMIN: BULK PRODUCTS ----------
+PRODUCT_IMPORT_FIELDS = ('id', 'name', 'description', 'price', 'image', 'stock')
+INT4_MAX = 2 ** 31 - 1        # products.id / products.stock are INTEGER
+PRODUCT_NAME_MAX = 200        # products.name is VARCHAR(200)
+
+# Same lock-in-id-order shape as RESERVE_STOCK_SQL, so it cannot deadlock with checkout.
+# Rows whose new stock would be negative or overflow INTEGER are left untouched and not returned.
+ADJUST_STOCK_SQL = """
+    WITH wanted(id, delta, target) AS (
+        SELECT * FROM unnest(%s::int[], %s::int[], %s::int[])
+    ), locked AS (
+        SELECT p.id, p.stock
+        FROM products p JOIN wanted w ON w.id = p.id
+        ORDER BY p.id
+        FOR UPDATE OF p
+    )
+    UPDATE products p
+    SET stock = COALESCE(w.target, l.stock::bigint + w.delta)
+    FROM wanted w JOIN locked l ON l.id = w.id
+    WHERE p.id = w.id AND COALESCE(w.target, l.stock::bigint + w.delta) BETWEEN 0 AND %s
+    RETURNING p.id, p.stock
+"""
+
+def read_product_import():
+    """[(line, row)] from an uploaded CSV ('file', header row required) or a JSON list body."""
+    upload = request.files.get('file')
+    if upload:
+        text = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        return list(enumerate(csv.DictReader(text), start=2))
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('products')
+    if not isinstance(data, list):
+        raise ValueError('Send a CSV file as "file" or a JSON list of products')
+    return list(enumerate(data, start=1))
+
+def clean_product_row(row):
+    """(id, name, description, price, image, stock) with None for blank cells, or ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError('expected an object with product fields')
+    values = {}
+    for key in PRODUCT_IMPORT_FIELDS:
+        v = row.get(key)
+        v = '' if v is None else str(v).strip()
+        values[key] = v or None
+    if values['id'] is None and values['name'] is None:
+        raise ValueError('id or name is required')
+    if values['name'] is not None and len(values['name']) > PRODUCT_NAME_MAX:
+        raise ValueError(f'name is longer than {PRODUCT_NAME_MAX} characters')
+    try:
+        pid = int(values['id']) if values['id'] is not None else None
+    except ValueError:
+        raise ValueError(f"invalid id {values['id']!r}")
+    if pid is not None and not 1 <= pid <= INT4_MAX:
+        raise ValueError(f'id must be between 1 and {INT4_MAX}')
+    try:
+        price = round(float(values['price']), 2) if values['price'] is not None else None
+    except ValueError:
+        raise ValueError(f"invalid price {values['price']!r}")
+    if price is not None and not 0 <= price < 10 ** 8:
+        raise ValueError('price must be between 0 and 99999999.99')
+    try:
+        stock = int(values['stock']) if values['stock'] is not None else None
+    except ValueError:
+        raise ValueError(f"invalid stock {values['stock']!r}")
+    if stock is not None and not 0 <= stock <= INT4_MAX:
+        raise ValueError(f'stock must be between 0 and {INT4_MAX}')
+    return pid, values['name'], values['description'], price, values['image'], stock
+
+def merge_product_import(cur, rows):
+    """
+    COPY validated rows into a temp staging table and merge them in the caller's
+    transaction: rows with an id (or matching an existing name) update that
+    product, blank cells keep the current value, the rest are inserted.
+    Returns (inserted, updated, errors).
+    """
+    cur.execute("""
+        CREATE TEMP TABLE products_import (
+            line INTEGER, given_id INTEGER, id INTEGER, name TEXT, description TEXT,
+            price NUMERIC(10,2), image TEXT, stock INTEGER
+        ) ON COMMIT DROP
+    """)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for line, pid, name, desc, price, image, stock in rows:
+        writer.writerow([line, pid, pid, name, desc, price, image, stock])  # None -> unquoted empty -> NULL
+    buf.seek(0)
+    cur.copy_expert("COPY products_import (line, given_id, id, name, description, price, image, stock) "
+                    "FROM STDIN WITH (FORMAT csv)", buf)
+
+    errors = []
+    cur.execute("""
+        DELETE FROM products_import s
+        WHERE s.given_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM products p WHERE p.id = s.given_id)
+        RETURNING s.line
+    """)
+    errors += [{'line': line, 'error': 'no product with this id'} for (line,) in cur.fetchall()]
+    # Rows without an id update the oldest product with the same name, if there is one
+    cur.execute("""
+        UPDATE products_import s SET id = p.id
+        FROM (SELECT name, MIN(id) AS id FROM products GROUP BY name) p
+        WHERE s.id IS NULL AND p.name = s.name
+    """)
+    cur.execute("DELETE FROM products_import WHERE id IS NULL AND price IS NULL RETURNING line")
+    errors += [{'line': line, 'error': 'price is required for a new product'} for (line,) in cur.fetchall()]
+    cur.execute("""
+        DELETE FROM products_import s USING products_import t
+        WHERE s.id = t.id AND s.line > t.line
+        RETURNING s.line, t.line
+    """)
+    dupes = {}
+    for line, first in cur.fetchall():
+        dupes[line] = min(first, dupes.get(line, first))
+    errors += [{'line': line, 'error': f'same product as line {first}'} for line, first in dupes.items()]
+
+    cur.execute("SELECT p.id FROM products p JOIN products_import s ON s.id = p.id ORDER BY p.id FOR UPDATE OF p")
+    cur.execute("""
+        UPDATE products p
+        SET name = COALESCE(s.name, old.name),
+            description = COALESCE(s.description, old.description),
+            price = COALESCE(s.price, old.price),
+            stock = COALESCE(s.stock, old.stock),
+            image = COALESCE(s.image, old.image),
+            image_variants = CASE WHEN s.image IS NULL OR s.image = old.image THEN old.image_variants END
+        FROM products_import s JOIN products old ON old.id = s.id
+        WHERE p.id = s.id
+        RETURNING old.image, p.image
+    """)
+    changed = cur.fetchall()
+    for old_image, new_image in changed:
+        replace_upload_ref(cur, old_image, new_image)
+    cur.execute("""
+        INSERT INTO products (name, description, price, image, stock)
+        SELECT name, COALESCE(description, ''), price, COALESCE(image, ''), COALESCE(stock, 0)
+        FROM products_import WHERE id IS NULL ORDER BY line
+        RETURNING image
+    """)
+    added = cur.fetchall()
+    for (image,) in added:
+        upload_ref(cur, image, 1)
+    return len(added), len(changed), errors
+
+@app.route('/admin/products/import', methods=['POST'])
+@admin_required
+def admin_import_products():
+    """
+    Bulk upsert products from CSV (columns id,name,description,price,image,stock)
+    or JSON. Invalid rows are reported by line and skipped; ?strict=1 imports
+    nothing unless every row is valid.
+    """
+    try:
+        raw = read_product_import()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': str(e)}), 400
+
+    rows, errors, seen = [], [], {}
+    for line, row in raw:
+        try:
+            clean = clean_product_row(row)
+        except ValueError as e:
+            errors.append({'line': line, 'error': str(e)}); continue
+        key = ('id', clean[0]) if clean[0] is not None else ('name', clean[1])
+        if key in seen:
+            errors.append({'line': line, 'error': f'same product as line {seen[key]}'}); continue
+        seen[key] = line
+        rows.append((line,) + clean)
+    strict = request.args.get('strict') == '1'
+    if strict and errors:
+        return jsonify({'inserted': 0, 'updated': 0, 'errors': errors}), 400
+
+    inserted = updated = 0
+    if rows:
+        conn = get_conn()
+        with conn.cursor() as cur:
+            inserted, updated, merge_errors = merge_product_import(cur, rows)
+        errors += merge_errors
+        if strict and merge_errors:
+            conn.rollback()
+            return jsonify({'inserted': 0, 'updated': 0, 'errors': sorted(errors, key=lambda e: e['line'])}), 400
+        conn.commit()
+        invalidate_catalog()
+    return jsonify({'inserted': inserted, 'updated': updated, 'errors': sorted(errors, key=lambda e: e['line'])})
+
+@app.route('/admin/api/stock', methods=['POST'])
+@admin_required
+def admin_adjust_stock():
+    """
+    Body: {"adjustments": [{"id": 3, "delta": 12}, {"id": 5, "stock": 40}, ...]}
+    (a bare list works too). Applied in one statement; entries that would take
+    stock below zero, or name an unknown product, are reported and skipped.
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('adjustments')
+    if not isinstance(data, list):
+        return jsonify({'error': 'Send {"adjustments": [{"id", "delta" | "stock"}, ...]}'}), 400
+
+    ids, deltas, targets, errors, index_of = [], [], [], [], {}
+    for n, adj in enumerate(data):
+        try:
+            pid = int(adj['id'])
+            delta = int(adj['delta']) if adj.get('delta') is not None else None
+            target = int(adj['stock']) if adj.get('stock') is not None else None
+        except (KeyError, TypeError, ValueError, AttributeError):
+            errors.append({'index': n, 'error': 'expected an integer id with an integer delta or stock'}); continue
+        if (delta is None) == (target is None):
+            errors.append({'index': n, 'error': 'give exactly one of delta or stock'}); continue
+        if not 1 <= pid <= INT4_MAX:
+            errors.append({'index': n, 'error': 'no product with this id'}); continue
+        if target is not None and not 0 <= target <= INT4_MAX:
+            errors.append({'index': n, 'error': f'stock must be between 0 and {INT4_MAX}'}); continue
+        if delta is not None and not -INT4_MAX <= delta <= INT4_MAX:
+            errors.append({'index': n, 'error': f'delta must be between -{INT4_MAX} and {INT4_MAX}'}); continue
+        if pid in index_of:
+            errors.append({'index': n, 'error': f'product {pid} already adjusted at index {index_of[pid]}'}); continue
+        index_of[pid] = n
+        ids.append(pid); deltas.append(delta); targets.append(target)
+
+    updated = []
+    if ids:
+        conn = get_conn()
+        with conn.cursor() as cur:
+            cur.execute(ADJUST_STOCK_SQL, (ids, deltas, targets, INT4_MAX))
+            updated = [{'id': pid, 'stock': stock} for pid, stock in cur.fetchall()]
+            missing = set(ids) - {u['id'] for u in updated}
+            if missing:
+                cur.execute("SELECT id, stock FROM products WHERE id = ANY(%s)", (list(missing),))
+                current = dict(cur.fetchall())
+                delta_of = dict(zip(ids, deltas))
+                for pid in sorted(missing, key=index_of.get):
+                    if pid not in current:
+                        error = 'no product with this id'
+                    elif current[pid] + (delta_of[pid] or 0) > INT4_MAX:
+                        error = f'stock would exceed {INT4_MAX}'
+                    else:
+                        error = 'stock would go negative'
+                    errors.append({'index': index_of[pid], 'error': error})
+        conn.commit()
+        invalidate_catalog()
+    return jsonify({'updated': sorted(updated, key=lambda u: u['id']),
+                    'errors': sorted(errors, key=lambda e: e['index'])})
+
 
 # Load templates at module level (required for Vercel)
 app.jinja_loader = DictLoader(_templates)
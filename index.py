@@ -4,6 +4,9 @@ import os
 # Add parent directory to path so we can import app
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# Keep at most one warm pooled connection per serverless instance
+os.environ.setdefault("DB_POOL_MODE", "serverless")
+
 from app import app, _templates, init_db
 from jinja2 import DictLoader
 
@@ -0,0 +1,23 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.mark.parametrize("flt", [
+    {"start": "2026-10-01", "end": "garbage"},
+    {"start": "01/10/2026"},
+    {"end": 20261001},
+])
+def test_any_bad_filter_date_is_rejected(flt):
+    with pytest.raises(ValueError):
+        app_module.bulk_status_selection({"filter": flt})
+
+
+def test_ids_must_be_a_list():
+    with pytest.raises(ValueError):
+        app_module.bulk_status_selection({"ids": "123"})
+
+
+def test_valid_filter_keeps_both_bounds():
+    sql, params = app_module.bulk_status_selection({"filter": {"start": "2026-10-01", "end": "2026-10-02"}})
+    assert sql.count("o.created_at") == 2 and len(params) == 2
@@ -0,0 +1,82 @@
+import json
+
+import psycopg2
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import app as app_module
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((" ".join(sql.split()), params))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+@pytest.fixture
+def serverless(monkeypatch, tmp_path):
+    """One-connection pool, inline image work and local uploads in tmp_path (as on Vercel)."""
+    connections = []
+
+    def connect(**kwargs):
+        conn = FakeConnection()
+        connections.append(conn)
+        return conn
+
+    monkeypatch.setattr(app_module.psycopg2, "connect", connect)
+    monkeypatch.setitem(app_module.DB_POOL_CONFIG, "mode", "serverless")
+    monkeypatch.setattr(app_module, "_pool", app_module.ConnectionPool(
+        0, 1, timeout=1, max_lifetime=0, health_check_after=60))
+    monkeypatch.setattr(app_module, "IMAGE_WORKERS", 0)
+    monkeypatch.setitem(app_module.UPLOAD_STORAGE_CONFIG, "backend", "local")
+    monkeypatch.setattr(app_module, "_upload_storage", None)
+    monkeypatch.setitem(app_module.app.config, "UPLOAD_DIR", str(tmp_path))
+    return connections
+
+
+def test_inline_variants_use_the_request_connection(serverless):
+    Image.new("RGB", (800, 600), "white").save(app_module.app.config["UPLOAD_DIR"] + "/a.png")
+
+    with app_module.app.test_request_context():
+        request_conn = app_module.get_conn()  # the pool's only connection
+        app_module.schedule_image_variants("product", 7, "a.png", "/uploads/a.png")
+
+    assert serverless == [request_conn]
+    updates = [(sql, params) for sql, params in request_conn.executed
+               if sql.startswith("UPDATE products SET image_variants")]
+    assert len(updates) == 1
+    variants, row_id, expected = updates[0][1]
+    assert (row_id, expected) == (7, "/uploads/a.png")
+    assert json.loads(variants)["jpeg"]
+    assert request_conn.commits == 1
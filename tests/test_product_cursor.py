@@ -0,0 +1,33 @@
+import base64
+import json
+
+import pytest
+
+import app as app_module
+
+
+def encode(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize("key, after", [
+    ("price", ["12.50", 7]),
+    ("name", ["Curd", 3]),
+    (None, [None, 42]),
+])
+def test_cursors_the_app_issues_round_trip(key, after):
+    assert app_module.decode_product_cursor(encode(after), key) == after
+
+
+@pytest.mark.parametrize("key, cursor", [
+    ("price", encode(["abc", 7])),
+    ("price", encode([12.5, 7])),
+    ("name", encode(["Curd", "7"])),
+    ("name", encode(["Curd", True])),
+    ("name", encode([{"x": 1}, 7])),
+    (None, encode([None, 2 ** 40])),
+    (None, encode({"id": 1})),
+    (None, "not-base64!"),
+])
+def test_tampered_cursors_are_ignored(key, cursor):
+    assert app_module.decode_product_cursor(cursor, key) is None
@@ -0,0 +1,20 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.mark.parametrize("row, message", [
+    ({"id": "1", "stock": "3000000000"}, "stock must be between"),
+    ({"id": "3000000000"}, "id must be between"),
+    ({"name": "x" * 201, "price": "10"}, "name is longer than"),
+    ({"name": "Milk", "price": "-1"}, "price must be between"),
+    ({"price": "10"}, "id or name is required"),
+])
+def test_rows_the_database_would_reject_are_row_errors(row, message):
+    with pytest.raises(ValueError, match=message):
+        app_module.clean_product_row(row)
+
+
+def test_limits_are_inclusive():
+    row = {"id": str(app_module.INT4_MAX), "name": "x" * 200, "stock": str(app_module.INT4_MAX)}
+    assert app_module.clean_product_row(row) == (app_module.INT4_MAX, "x" * 200, None, None, None, app_module.INT4_MAX)
@@ -0,0 +1,83 @@
+"""
+Concurrency check for reserve_stock(): many buyers racing for one low-stock
+product must never take it below zero or sell more than was in stock.
+Needs the PostgreSQL server from DB_CONFIG; skipped when it is unreachable.
+"""
+import threading
+import uuid
+
+import psycopg2
+import pytest
+
+import app as app_module
+
+INITIAL_STOCK = 5
+BUYERS = 40
+
+
+@pytest.fixture
+def pg_schema():
+    try:
+        admin = psycopg2.connect(connect_timeout=3, **app_module.DB_CONFIG)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL not available: {e}")
+    admin.autocommit = True
+    schema = f"test_stock_{uuid.uuid4().hex[:8]}"
+    with admin.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"CREATE TABLE {schema}.products (id SERIAL PRIMARY KEY, stock INTEGER NOT NULL)")
+    try:
+        yield schema
+    finally:
+        with admin.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
+
+
+def connect(schema):
+    return psycopg2.connect(options=f"-c search_path={schema}", **app_module.DB_CONFIG)
+
+
+def test_concurrent_checkouts_never_oversell(pg_schema):
+    conn = connect(pg_schema)
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO products (stock) VALUES (%s), (100) RETURNING id", (INITIAL_STOCK,))
+        scarce, plenty = [r[0] for r in cur.fetchall()]
+    conn.commit()
+
+    sold, failures = [], []
+    start = threading.Barrier(BUYERS)
+
+    def buy():
+        c = connect(pg_schema)
+        try:
+            start.wait()
+            with c.cursor() as cur:
+                # Two lines per order, as a real cart would lock more than one row
+                short = app_module.reserve_stock(cur, [(plenty, 1), (scarce, 1)])
+            if short:
+                c.rollback()
+            else:
+                c.commit()
+                sold.append(1)
+        except Exception as e:  # surfaced below; a deadlock would land here
+            failures.append(e)
+        finally:
+            c.close()
+
+    threads = [threading.Thread(target=buy) for _ in range(BUYERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, stock FROM products")
+        stock = dict(cur.fetchall())
+    conn.close()
+
+    assert not failures
+    assert stock[scarce] >= 0
+    assert len(sold) <= INITIAL_STOCK
+    assert len(sold) + stock[scarce] == INITIAL_STOCK
+    assert stock[plenty] == 100 - len(sold)